@@ -14,9 +14,13 @@ from langsmith import traceable
 from dotenv import load_dotenv
 import logging
 import os
+from omnitool.gradio.settle_detector import SettleDetector, frame_hash
 
 load_dotenv()
 
+# wait for the screen to stop changing after an action (at most the old 3 s) instead of always sleeping 3 s
+settle = SettleDetector(lambda: frame_hash(pyautogui.screenshot()), stable_ms=300, timeout_s=3.0, poll_ms=50)
+
 
 
 @traceable
@@ -72,10 +76,10 @@ def execute_action(state: MessagesState):
         if key_value in ["enter", "space"]:
             if key_value == "enter":
                 pyautogui.press("enter")
-                time.sleep(3)
+                settle.wait()
             elif key_value == "space":
                 pyautogui.press("space")
-                time.sleep(3)
+                settle.wait()
             logging.info(f"Pressed key: {key_value}")
             return {"messages": [AIMessage(content=f"Pressed key: {key_value}")]}
 
@@ -83,7 +87,7 @@ def execute_action(state: MessagesState):
         x, y = action_data.get("x_coordinate"), action_data.get("y_coordinate")
         if x is not None and y is not None:
             pyautogui.click(x, y)
-            time.sleep(3)
+            settle.wait()
             logging.info(f"Performed left click at ({x}, {y})")
             return {"messages": [AIMessage(content=f"Performed left click at ({x}, {y})")]}
         else:
@@ -93,7 +97,7 @@ def execute_action(state: MessagesState):
         x, y = action_data.get("x_coordinate"), action_data.get("y_coordinate")
         if x is not None and y is not None:
             pyautogui.rightClick(x, y)
-            time.sleep(3)
+            settle.wait()
             logging.info(f"Performed right click at ({x}, {y})")
             return {"messages": [AIMessage(content=f"Performed right click at ({x}, {y})")]}
 
@@ -101,7 +105,7 @@ def execute_action(state: MessagesState):
         text = action_data.get("value")
         if text:
             pyautogui.typewrite(text)
-            time.sleep(3)
+            settle.wait()
             logging.info(f"Typed text: {text}")
             return {"messages": [AIMessage(content=f"Typed text: {text}")]}
         
@@ -109,7 +113,7 @@ def execute_action(state: MessagesState):
         x, y = action_data.get("x_coordinate"), action_data.get("y_coordinate")
         if x is not None and y is not None:
             pyautogui.doubleClick(x, y)
-            time.sleep(3)
+            settle.wait()
             logging.info(f"Performed double click at ({x}, {y})")
             return {"messages": [AIMessage(content=f"Performed double click at ({x}, {y})")]}
 
@@ -120,7 +124,7 @@ def execute_action(state: MessagesState):
     
     elif action == "scroll":
         pyautogui.scroll(-500)  # Scroll up by 100 units
-        time.sleep(3)
+        settle.wait()
         logging.info("Scrolled up by 100 units.")
         return {"messages": [AIMessage(content="Scrolled down by 100 units.")]}
 
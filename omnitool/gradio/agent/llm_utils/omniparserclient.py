@@ -1,21 +1,42 @@
 import requests
 import base64
+import json
 from pathlib import Path
 from tools.screen_capture import get_screenshot
+from tools.vm_session import VMSession
 from agent.llm_utils.utils import encode_image
 
 OUTPUT_DIR = "./tmp/outputs"
 
 class OmniParserClient:
     def __init__(self, 
-                 url: str) -> None:
+                 url: str,
+                 binary_upload: bool = True,
+                 vm: VMSession | None = None) -> None:
         self.url = url
+        # screenshots are taken through the agent session's VM connection
+        self.vm = vm or VMSession()
+        # send the screenshot as raw PNG bytes to /parse_image/ instead of base64 JSON to /parse/
+        self.binary_upload = binary_upload
+        # keep-alive connection reused across agent steps
+        self.session = requests.Session()
+
+    def _endpoint(self, name: str) -> str:
+        """URL of another parser server endpoint, derived from the /parse/ url"""
+        return self.url.rstrip('/').rsplit('/', 1)[0] + f'/{name}/'
 
     def __call__(self,):
-        screenshot, screenshot_path = get_screenshot()
+        screenshot, screenshot_path = get_screenshot(vm=self.vm)
         screenshot_path = str(screenshot_path)
-        image_base64 = encode_image(screenshot_path)
-        response = requests.post(self.url, json={"base64_image": image_base64})
+        if self.binary_upload:
+            image_bytes = Path(screenshot_path).read_bytes()
+            response = self.session.post(self._endpoint('parse_image'), data=image_bytes, headers={'Content-Type': 'image/png'})
+            # the agents still send the original screenshot to the LLM as base64
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        else:
+            image_base64 = encode_image(screenshot_path)
+            response = self.session.post(self.url, json={"base64_image": image_base64})
+        response.raise_for_status()
         response_json = response.json()
         print('omniparser latency:', response_json['latency'])
 
@@ -32,6 +53,20 @@ class OmniParserClient:
         response_json = self.reformat_messages(response_json)
         return response_json
     
+    def stream(self):
+        """
+        Parse a fresh screenshot through the streaming endpoint, yielding the server events
+        (ocr, icons, captions, som, done) as they arrive so callers can start building the
+        prompt from the OCR elements, or stop early.
+        """
+        screenshot, screenshot_path = get_screenshot(vm=self.vm)
+        image_base64 = encode_image(str(screenshot_path))
+        with self.session.post(self._endpoint('parse_stream'), json={"base64_image": image_base64}, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
     def reformat_messages(self, response_json: dict):
         screen_info = ""
         for idx, element in enumerate(response_json["parsed_content_list"]):
@@ -12,7 +12,8 @@ from anthropic.types.beta import (
 )
 from anthropic.types import TextBlock
 from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock
-from tools import ComputerTool, ToolCollection, ToolResult
+from tools import ComputerTool, ToolCollection, ToolResult, VMSession
+from tools.base import ToolError, ToolFailure
 
 
 class AnthropicExecutor:
@@ -20,9 +21,11 @@ class AnthropicExecutor:
         self, 
         output_callback: Callable[[BetaContentBlockParam], None], 
         tool_output_callback: Callable[[Any, str], None],
+        vm: VMSession | None = None,
     ):
+        self.computer_tool = ComputerTool(vm=vm)
         self.tool_collection = ToolCollection(
-            ComputerTool()
+            self.computer_tool
         )
         self.output_callback = output_callback
         self.tool_output_callback = tool_output_callback
@@ -38,33 +41,49 @@ class AnthropicExecutor:
             print("new_message already in messages, there are duplicates.")
         
         tool_result_content: list[BetaToolResultBlockParam] = []
-        for content_block in cast(list[BetaContentBlock], response.content):
-            self.output_callback(content_block, sender="bot")
-            # Execute the tool
-            if content_block.type == "tool_use":
-                # Run the asynchronous tool execution in a synchronous context
-                result = asyncio.run(self.tool_collection.run(
-                    name=content_block.name,
-                    tool_input=cast(dict[str, Any], content_block.input),
-                ))
-                
-                self.output_callback(result, sender="bot")
-                
-                tool_result_content.append(
-                    _make_api_tool_result(result, content_block.id)
-                )
-                # self.tool_output_callback(result, content_block.id)
+        # the input actions of all tool_use blocks of this step go to the VM in one batch, screenshots
+        # and cursor queries in between flush what is queued before them. Nothing is yielded inside the
+        # batch, a consumer that stops iterating can't leave it half sent
+        tool_uses = []
+        try:
+            with self.computer_tool.batch():
+                for content_block in cast(list[BetaContentBlock], response.content):
+                    self.output_callback(content_block, sender="bot")
+                    # Execute the tool
+                    if content_block.type == "tool_use":
+                        first_action = self.computer_tool.actions_sent
+                        # Run the asynchronous tool execution in a synchronous context
+                        result = asyncio.run(self.tool_collection.run(
+                            name=content_block.name,
+                            tool_input=cast(dict[str, Any], content_block.input),
+                        ))
+                        tool_uses.append((content_block.id, result, first_action, self.computer_tool.actions_sent))
+        except ToolError:
+            # reported below on the tool results whose actions did not all run
+            pass
+
+        failed_action = self.computer_tool.failed_action
+        for tool_use_id, result, first_action, end_action in tool_uses:
+            # the results of queued actions were written before they ran, the ones from the failed
+            # action on are replaced
+            if failed_action is not None and end_action > failed_action:
+                if first_action <= failed_action:
+                    result = ToolFailure(error=self.computer_tool.failure)
+                else:
+                    result = ToolFailure(error=f"Not executed, an earlier action failed: {self.computer_tool.failure}")
+            self.output_callback(result, sender="bot")
+            tool_result_content.append(_make_api_tool_result(result, tool_use_id))
+            # self.tool_output_callback(result, tool_use_id)
+
+        # Craft messages based on the content_block
+        # Note: to display the messages in the gradio, you should organize the messages in the following way (user message, bot message)
+        display_messages = _message_display_callback(messages)
+        # display_messages = []
 
-            # Craft messages based on the content_block
-            # Note: to display the messages in the gradio, you should organize the messages in the following way (user message, bot message)
-            
-            display_messages = _message_display_callback(messages)
-            # display_messages = []
-            
-            # Send the messages to the gradio
-            for user_msg, bot_msg in display_messages:
-                # yield [user_msg, bot_msg], tool_result_content
-                yield [None, None], tool_result_content
+        # Send the messages to the gradio
+        for user_msg, bot_msg in display_messages:
+            # yield [user_msg, bot_msg], tool_result_content
+            yield [None, None], tool_result_content
 
         if not tool_result_content:
             return messages
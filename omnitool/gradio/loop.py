@@ -13,7 +13,7 @@ from anthropic.types.beta import (
     BetaMessage,
     BetaMessageParam
 )
-from tools import ToolResult
+from tools import ToolResult, VMSession
 
 from agent.llm_utils.omniparserclient import OmniParserClient
 from agent.anthropic_agent import AnthropicActor
@@ -55,7 +55,9 @@ def sampling_loop_sync(
     Synchronous agentic sampling loop for the assistant/tool interaction of computer use.
     """
     print('in sampling_loop_sync, model:', model)
-    omniparser_client = OmniParserClient(url=f"http://{omniparser_url}/parse/")
+    # one VM connection pool, control channel and display probe for the client, actor and executor
+    vm = VMSession(channel=True)
+    omniparser_client = OmniParserClient(url=f"http://{omniparser_url}/parse/", vm=vm)
     if model == "claude-3-5-sonnet-20241022":
         # Register Actor and Executor
         actor = AnthropicActor(
@@ -64,7 +66,8 @@ def sampling_loop_sync(
             api_key=api_key, 
             api_response_callback=api_response_callback,
             max_tokens=max_tokens,
-            only_n_most_recent_images=only_n_most_recent_images
+            only_n_most_recent_images=only_n_most_recent_images,
+            vm=vm
         )
     elif model in set(["omniparser + gpt-4o", "omniparser + o1", "omniparser + o3-mini", "omniparser + R1", "omniparser + qwen2.5vl"]):
         actor = VLMAgent(
@@ -92,6 +95,7 @@ def sampling_loop_sync(
     executor = AnthropicExecutor(
         output_callback=output_callback,
         tool_output_callback=tool_output_callback,
+        vm=vm
     )
     print(f"Model Inited: {model}, Provider: {provider}")
     
@@ -0,0 +1,89 @@
+"""
+Frame hashing and settle detection, with no dependencies beyond PIL so scripts driving the local screen
+(computer_agent.py) can use them without loading the tools package.
+"""
+import hashlib
+import statistics
+import time
+from collections import deque
+from typing import Callable
+
+from PIL import Image
+
+
+def frame_hash(image: Image.Image, size: int = 32, bits: int = 3) -> str:
+    """
+    Hash of a tiny grayscale thumbnail (`size` pixels wide) with `bits` bits per pixel, so a blinking
+    caret or anti-aliasing noise doesn't count as a change but a window, menu or page load does.
+    Same hash as the VM server's /screen_hash.
+    """
+    w, h = image.size
+    thumb = image.convert('L').resize((size, max(1, size * h // w)), Image.BOX)
+    data = bytes(v >> (8 - bits) for v in thumb.tobytes())
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+class SettleDetector:
+    """
+    Waits until the screen stops changing after an action, instead of a fixed sleep.
+
+    Polls a cheap frame hash and returns once it has been unchanged for `stable_ms`, or after `timeout_s`.
+    Every settle time is recorded, see stats().
+
+    Attributes:
+        frame_hash (Callable[[], str]): returns the hash of the current screen
+        stable_ms (float): how long the screen has to stay unchanged to count as settled
+        timeout_s (float): upper bound of a wait, the old fixed sleep
+        poll_ms (float): pause between two polls
+    """
+
+    def __init__(self, frame_hash: Callable[[], str], stable_ms: float = 150, timeout_s: float = 3.0, poll_ms: float = 30):
+        self.frame_hash = frame_hash
+        self.stable_ms = stable_ms
+        self.timeout_s = timeout_s
+        self.poll_ms = poll_ms
+        self.settle_times = deque(maxlen=1000)
+        self.timeouts = 0
+
+    def wait(self) -> float:
+        """Block until the screen is settled, returns the time it took in seconds"""
+        start = time.perf_counter()
+        last_hash = self.frame_hash()
+        stable_since = time.perf_counter()
+        while True:
+            now = time.perf_counter()
+            if now - stable_since >= self.stable_ms / 1000:
+                break
+            if now - start >= self.timeout_s:
+                break
+            time.sleep(self.poll_ms / 1000)
+            current_hash = self.frame_hash()
+            if current_hash != last_hash:
+                last_hash = current_hash
+                stable_since = time.perf_counter()
+        settle_time = time.perf_counter() - start
+        self.record(settle_time, timed_out=now - stable_since < self.stable_ms / 1000)
+        return settle_time
+
+    def record(self, settle_time: float, timed_out: bool = False):
+        """Record a settle time measured elsewhere, e.g. by the VM over the control channel"""
+        self.settle_times.append(settle_time)
+        if timed_out:
+            self.timeouts += 1
+
+    def params(self) -> dict:
+        """Settle parameters for the VM server's control channel"""
+        return {'stable_ms': self.stable_ms, 'timeout_s': self.timeout_s, 'poll_ms': self.poll_ms}
+
+    def stats(self):
+        times = sorted(self.settle_times)
+        if not times:
+            return {'count': 0, 'timeouts': self.timeouts}
+        return {
+            'count': len(times),
+            'timeouts': self.timeouts,
+            'mean_ms': 1000 * statistics.mean(times),
+            'p50_ms': 1000 * times[len(times) // 2],
+            'p90_ms': 1000 * times[int(len(times) * 0.9)],
+            'max_ms': 1000 * times[-1],
+        }
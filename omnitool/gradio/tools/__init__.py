@@ -2,10 +2,16 @@ from .base import ToolResult
 from .collection import ToolCollection
 from .computer import ComputerTool
 from .screen_capture import get_screenshot
+from .settle import SettleDetector
+from .vm_channel import VMChannel
+from .vm_session import VMSession
 
 __ALL__ = [
     ComputerTool,
     ToolCollection,
     ToolResult,
     get_screenshot,
+    SettleDetector,
+    VMChannel,
+    VMSession,
 ]
@@ -1,5 +1,6 @@
 import base64
 import time
+from contextlib import contextmanager
 from enum import StrEnum
 from typing import Literal, TypedDict
 
@@ -9,14 +10,18 @@ from anthropic.types.beta import BetaToolComputerUse20241022Param
 
 from .base import BaseAnthropicTool, ToolError, ToolResult
 from .screen_capture import get_screenshot
+from .settle import SettleDetector, vm_frame_hash
+from .vm_session import VMSession
 import requests
-import re
 
 OUTPUT_DIR = "./tmp/outputs"
 
 TYPING_DELAY_MS = 12
 TYPING_GROUP_SIZE = 50
 
+# actions whose result is needed right away, they flush the pending batch
+QUERY_ACTIONS = ("position", "size")
+
 Action = Literal[
     "key",
     "type",
@@ -88,7 +93,7 @@ class ComputerTool(BaseAnthropicTool):
     def to_params(self) -> BetaToolComputerUse20241022Param:
         return {"name": self.name, "type": self.api_type, **self.options}
 
-    def __init__(self, is_scaling: bool = False):
+    def __init__(self, is_scaling: bool = False, vm: VMSession | None = None):
         super().__init__()
 
         # Get screen width and height using Windows command
@@ -96,6 +101,18 @@ class ComputerTool(BaseAnthropicTool):
         self.offset_x = 0
         self.offset_y = 0
         self.is_scaling = is_scaling
+        # shared with the other tools of the agent session, holds the connections and the display profile
+        self.vm = vm or VMSession()
+        # actions queued by send_action inside a batch() block, sent together to /actions
+        self._pending_actions = []
+        self._batch_depth = 0
+        # actions sent so far (queued ones included), the number of the one that failed on the VM in the
+        # current outermost batch and its error
+        self.actions_sent = 0
+        self.failed_action = None
+        self.failure = None
+        # after input actions, wait for the screen to stop changing instead of a fixed sleep
+        self.settle = SettleDetector(vm_frame_hash(self.vm))
         self.width, self.height = self.get_screen_size()
         print(f"screen size: {self.width}, {self.height}")
 
@@ -114,6 +131,17 @@ class ComputerTool(BaseAnthropicTool):
         **kwargs,
     ):
         print(f"action: {action}, text: {text}, coordinate: {coordinate}, is_scaling: {self.is_scaling}")
+        with self.batch():
+            return await self._run(action=action, text=text, coordinate=coordinate, **kwargs)
+
+    async def _run(
+        self,
+        *,
+        action: Action,
+        text: str | None = None,
+        coordinate: tuple[int, int] | None = None,
+        **kwargs,
+    ):
         if action in ("mouse_move", "left_click_drag"):
             if coordinate is None:
                 raise ToolError(f"coordinate is required for {action}")
@@ -141,11 +169,12 @@ class ComputerTool(BaseAnthropicTool):
             print(f"mouse move to {x}, {y}")
             
             if action == "mouse_move":
-                self.send_to_vm(f"pyautogui.moveTo({x}, {y})")
+                self.send_action("move", x=x, y=y)
                 return ToolResult(output=f"Moved mouse to ({x}, {y})")
             elif action == "left_click_drag":
-                current_x, current_y = self.send_to_vm("pyautogui.position()")
-                self.send_to_vm(f"pyautogui.dragTo({x}, {y}, duration=0.5)")
+                position = self.send_action("position")
+                current_x, current_y = position["x"], position["y"]
+                self.send_action("drag", x=x, y=y, duration=0.5)
                 return ToolResult(output=f"Dragged mouse from ({current_x}, {current_y}) to ({x}, {y})")
 
         if action in ("key", "type"):
@@ -157,23 +186,16 @@ class ComputerTool(BaseAnthropicTool):
                 raise ToolError(output=f"{text} must be a string")
 
             if action == "key":
-                # Handle key combinations
-                keys = text.split('+')
-                for key in keys:
-                    key = self.key_conversion.get(key.strip(), key.strip())
-                    key = key.lower()
-                    self.send_to_vm(f"pyautogui.keyDown('{key}')")  # Press down each key
-                for key in reversed(keys):
-                    key = self.key_conversion.get(key.strip(), key.strip())
-                    key = key.lower()
-                    self.send_to_vm(f"pyautogui.keyUp('{key}')")    # Release each key in reverse order
+                # Handle key combinations, the server presses each key down and releases them in reverse order
+                keys = [self.key_conversion.get(key.strip(), key.strip()).lower() for key in text.split('+')]
+                self.send_action("key", keys=keys)
                 return ToolResult(output=f"Pressed keys: {text}")
             
             elif action == "type":
                 # default click before type TODO: check if this is needed
-                self.send_to_vm("pyautogui.click()")
-                self.send_to_vm(f"pyautogui.typewrite('{text}', interval={TYPING_DELAY_MS / 1000})")
-                self.send_to_vm("pyautogui.press('enter')")
+                self.send_action("click")
+                self.send_action("type", text=text, interval=TYPING_DELAY_MS / 1000)
+                self.send_action("press", key="enter")
                 screenshot_base64 = (await self.screenshot()).base64_image
                 return ToolResult(output=text, base64_image=screenshot_base64)
 
@@ -194,75 +216,142 @@ class ComputerTool(BaseAnthropicTool):
             if action == "screenshot":
                 return await self.screenshot()
             elif action == "cursor_position":
-                x, y = self.send_to_vm("pyautogui.position()")
-                x, y = self.scale_coordinates(ScalingSource.COMPUTER, x, y)
+                position = self.send_action("position")
+                x, y = self.scale_coordinates(ScalingSource.COMPUTER, position["x"], position["y"])
                 return ToolResult(output=f"X={x},Y={y}")
             else:
                 if action == "left_click":
-                    self.send_to_vm("pyautogui.click()")
+                    self.send_action("click")
                 elif action == "right_click":
-                    self.send_to_vm("pyautogui.rightClick()")
+                    self.send_action("click", button="right")
                 elif action == "middle_click":
-                    self.send_to_vm("pyautogui.middleClick()")
+                    self.send_action("click", button="middle")
                 elif action == "double_click":
-                    self.send_to_vm("pyautogui.doubleClick()")
+                    self.send_action("click", clicks=2)
                 elif action == "left_press":
-                    self.send_to_vm("pyautogui.mouseDown()")
-                    time.sleep(1)
-                    self.send_to_vm("pyautogui.mouseUp()")
+                    self.send_action("mouse_down", delay=1)
+                    self.send_action("mouse_up")
                 return ToolResult(output=f"Performed {action}")
         if action in ("scroll_up", "scroll_down"):
             if action == "scroll_up":
-                self.send_to_vm("pyautogui.scroll(100)")
+                self.send_action("scroll", clicks=100)
             elif action == "scroll_down":
-                self.send_to_vm("pyautogui.scroll(-100)")
+                self.send_action("scroll", clicks=-100)
             return ToolResult(output=f"Performed {action}")
         if action == "hover":
             return ToolResult(output=f"Performed {action}")
         if action == "wait":
+            self.flush_or_raise()
             time.sleep(1)
             return ToolResult(output=f"Performed {action}")
         raise ToolError(f"Invalid action: {action}")
 
-    def send_to_vm(self, action: str):
+    @contextmanager
+    def batch(self):
         """
-        Executes a python command on the server. Only return tuple of x,y when action is "pyautogui.position()"
+        Queue the actions sent inside the block and run them on the VM in one /actions round trip when
+        the outermost block exits. Queries (position, size) and screenshots flush the queue first.
+        If an action fails on the VM, failed_action tells which one, the actions sent after it in the block
+        are not run and the outermost block raises ToolError. An exception inside the outermost block drops
+        the queued actions.
         """
-        prefix = "import pyautogui; pyautogui.FAILSAFE = False;"
-        command_list = ["python", "-c", f"{prefix} {action}"]
-        parse = action == "pyautogui.position()"
-        if parse:
-            command_list[-1] = f"{prefix} print({action})"
-
+        if self._batch_depth == 0:
+            self.failed_action = self.failure = None
+        self._batch_depth += 1
         try:
-            print(f"sending to vm: {command_list}")
-            response = requests.post(
-                f"http://localhost:5000/execute", 
-                headers={'Content-Type': 'application/json'},
-                json={"command": command_list},
-                timeout=90
-            )
-            time.sleep(0.7) # avoid async error as actions take time to complete
-            print(f"action executed")
-            if response.status_code != 200:
-                raise ToolError(f"Failed to execute command. Status code: {response.status_code}")
-            if parse:
-                output = response.json()['output'].strip()
-                match = re.search(r'Point\(x=(\d+),\s*y=(\d+)\)', output)
-                if not match:
-                    raise ToolError(f"Could not parse coordinates from output: {output}")
-                x, y = map(int, match.groups())
-                return x, y
+            yield
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._pending_actions.clear()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            # the agent loop takes a screenshot next
+            self.flush(want_frame=True)
+            if self.failed_action is not None:
+                raise ToolError(self.failure)
+
+    def send_action(self, action: str, delay: float | None = None, **params):
+        """
+        Runs a typed action (move, click, mouse_down, mouse_up, key, press, type, scroll, drag, position, size)
+        in the VM server process, `delay` seconds are waited on the VM before the next action. Inside a
+        batch() block input actions are only queued. Returns the action result, e.g. {"x": .., "y": ..}
+        for "position".
+        """
+        if self._batch_depth > 0 and self.failed_action is not None:
+            raise ToolError(f"Not executed, an earlier action failed: {self.failure}")
+        self._pending_actions.append({"action": action, **params, **({"delay": delay} if delay else {})})
+        self.actions_sent += 1
+        if self._batch_depth > 0 and action not in QUERY_ACTIONS:
+            return None
+        return self.flush_or_raise()[-1]
+
+    def flush_or_raise(self, want_frame: bool = False) -> list:
+        """flush(), raising ToolError when an action failed on the VM"""
+        results, failed_index = self.flush(want_frame)
+        if failed_index is not None:
+            raise ToolError(self.failure)
+        return results
+
+    def flush(self, want_frame: bool = False) -> tuple[list, int | None]:
+        """
+        Run the queued actions in one request. Returns their results and the index of the action that failed
+        on the VM, None when all of them ran; the results stop before the failed action. A failure is also
+        recorded in failed_action (counted like actions_sent) and failure. Over the control channel the VM
+        also waits for the screen to settle and, with `want_frame`, pushes the screenshot taken afterwards.
+        """
+        if not self._pending_actions:
+            return [], None
+        actions, self._pending_actions = self._pending_actions, []
+        first_action = self.actions_sent - len(actions)
+        is_input = any(action["action"] not in QUERY_ACTIONS for action in actions)
+        channel = self.vm.channel
+        if channel is not None:
+            print(f"sending to vm channel: {actions}")
+            try:
+                reply = channel.run_actions(actions, settle=self.settle.params() if is_input else None, frame=want_frame and is_input)
+            except ToolError as e:
+                # whether any action ran is unknown, report the batch as failed from its first action
+                return self._failed(first_action, 0, e.message)
+            if reply["error"] is not None:
+                return self._failed(first_action, reply["failed_index"], f"Failed to execute {actions[reply['failed_index']]}. {reply['error']}", reply["results"])
+            if reply["settle_s"] is not None:
+                self.settle.record(reply["settle_s"], reply["timed_out"])
+                print(f"screen settled in {reply['settle_s'] * 1000:.0f} ms")
+            return reply["results"], None
+        try:
+            print(f"sending to vm: {actions}")
+            response = self.vm.post("/actions", json={"actions": actions})
         except requests.exceptions.RequestException as e:
-            raise ToolError(f"An error occurred while trying to execute the command: {str(e)}")
+            return self._failed(first_action, 0, f"An error occurred while trying to execute the command: {str(e)}")
+        if response.status_code != 200:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            failed_index = body.get("failed_index", 0)
+            return self._failed(first_action, failed_index, f"Failed to execute {actions[failed_index]}. Status code: {response.status_code}, {response.text}", body.get("results", []))
+        if is_input:
+            # avoid async error as actions take time to complete
+            settle_time = self.settle.wait()
+            print(f"screen settled in {settle_time * 1000:.0f} ms")
+        print(f"actions executed")
+        return response.json()['results'], None
+
+    def _failed(self, first_action: int, failed_index: int, message: str, results: list | None = None):
+        """Record the action of a flushed batch that failed on the VM, returns flush()'s result for it"""
+        print(message)
+        self.failed_action, self.failure = first_action + failed_index, message
+        return results or [], failed_index
 
     async def screenshot(self):
+        self.flush_or_raise(want_frame=True)
         if not hasattr(self, 'target_dimension'):
             screenshot = self.padding_image(screenshot)
             self.target_dimension = MAX_SCALING_TARGETS["WXGA"]
         width, height = self.target_dimension["width"], self.target_dimension["height"]
-        screenshot, path = get_screenshot(resize=True, target_width=width, target_height=height)
-        time.sleep(0.7) # avoid async error as actions take time to complete
+        screenshot, path = get_screenshot(resize=True, target_width=width, target_height=height, vm=self.vm)
         return ToolResult(base64_image=base64.b64encode(path.read_bytes()).decode())
 
     def padding_image(self, screenshot):
@@ -308,22 +397,6 @@ class ComputerTool(BaseAnthropicTool):
         return round(x * x_scaling_factor), round(y * y_scaling_factor)
 
     def get_screen_size(self):
-        """Return width and height of the screen"""
-        try:
-            response = requests.post(
-                f"http://localhost:5000/execute",
-                headers={'Content-Type': 'application/json'},
-                json={"command": ["python", "-c", "import pyautogui; print(pyautogui.size())"]},
-                timeout=90
-            )
-            if response.status_code != 200:
-                raise ToolError(f"Failed to get screen size. Status code: {response.status_code}")
-            
-            output = response.json()['output'].strip()
-            match = re.search(r'Size\(width=(\d+),\s*height=(\d+)\)', output)
-            if not match:
-                raise ToolError(f"Could not parse screen size from output: {output}")
-            width, height = map(int, match.groups())
-            return width, height
-        except requests.exceptions.RequestException as e:
-            raise ToolError(f"An error occurred while trying to get screen size: {str(e)}")
\ No newline at end of file
+        """Return width and height of the screen, from the display profile cached by the VM session"""
+        display = self.vm.display()
+        return display["width"], display["height"]
@@ -3,23 +3,28 @@ from uuid import uuid4
 import requests
 from PIL import Image
 from .base import BaseAnthropicTool, ToolError
+from .vm_session import VMSession
 from io import BytesIO
 
 OUTPUT_DIR = "./tmp/outputs"
 
-def get_screenshot(resize: bool = False, target_width: int = 1920, target_height: int = 1080):
+def get_screenshot(resize: bool = False, target_width: int = 1920, target_height: int = 1080, vm: VMSession | None = None):
     """Capture screenshot by requesting from HTTP endpoint - returns native resolution unless resized"""
     output_dir = Path(OUTPUT_DIR)
     output_dir.mkdir(parents=True, exist_ok=True)
     path = output_dir / f"screenshot_{uuid4().hex}.png"
     
     try:
-        response = requests.get('http://localhost:5000/screenshot')
-        if response.status_code != 200:
-            raise ToolError(f"Failed to capture screenshot: HTTP {response.status_code}")
+        if vm is not None and vm.channel is not None:
+            content = vm.channel.screenshot()
+        else:
+            response = vm.get('/screenshot') if vm is not None else requests.get('http://localhost:5000/screenshot')
+            if response.status_code != 200:
+                raise ToolError(f"Failed to capture screenshot: HTTP {response.status_code}")
+            content = response.content
         
         # (1280, 800)
-        screenshot = Image.open(BytesIO(response.content))
+        screenshot = Image.open(BytesIO(content))
         
         if resize and screenshot.size != (target_width, target_height):
             screenshot = screenshot.resize((target_width, target_height))
@@ -0,0 +1,22 @@
+from typing import Callable
+
+import requests
+
+from settle_detector import SettleDetector, frame_hash
+from .base import ToolError
+from .vm_session import VMSession
+
+
+def vm_frame_hash(vm: VMSession, size: int = 32, bits: int = 3) -> Callable[[], str]:
+    """Frame hash source polling the VM server's /screen_hash endpoint"""
+
+    def poll():
+        try:
+            response = vm.get("/screen_hash", params={"size": size, "bits": bits}, timeout=10)
+        except requests.exceptions.RequestException as e:
+            raise ToolError(f"Failed to poll the screen hash: {e}")
+        if response.status_code != 200:
+            raise ToolError(f"Failed to poll the screen hash: HTTP {response.status_code}")
+        return response.json()["hash"]
+
+    return poll
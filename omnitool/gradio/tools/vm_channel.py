@@ -0,0 +1,104 @@
+import itertools
+import json
+import threading
+import time
+
+import websocket
+
+from .base import ToolError
+
+
+class VMChannel:
+    """
+    Persistent WebSocket to the VM server's /ws control channel.
+
+    An action batch, its settle wait and the screenshot taken after it go over one warm connection, in one
+    request and its pushed replies (ack, settled, frame), instead of an HTTP request each. The frame pushed
+    after a batch is kept until the next screenshot() and is dropped when new actions are sent.
+
+    Attributes:
+        url (str): websocket url, e.g. ws://localhost:5000/ws
+        timeout (float): connect and receive timeout in seconds
+    """
+
+    def __init__(self, url: str, timeout: float = 90):
+        self.url = url
+        self.timeout = timeout
+        self.last_frame = None
+        self._ws = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self._ws is None:
+            self._ws = websocket.create_connection(self.url, timeout=self.timeout)
+        return self._ws
+
+    def close(self):
+        if self._ws is not None:
+            self._ws.close()
+            self._ws = None
+
+    def _exchange(self, message: dict, expected: set) -> dict:
+        """Send a request and collect its replies by type until all `expected` ones arrived"""
+        message_id = next(self._ids)
+        replies = {}
+        with self._lock:
+            try:
+                ws = self.connect()
+                ws.send(json.dumps({"id": message_id, **message}))
+                while not expected <= replies.keys():
+                    reply = json.loads(ws.recv())
+                    if reply["type"] == "frame":
+                        # the PNG follows its header as a binary message
+                        reply["png"] = ws.recv()
+                    if reply.get("id") != message_id:
+                        continue
+                    if reply["type"] == "error":
+                        raise ToolError(f"VM channel error: {reply['message']}")
+                    replies[reply["type"]] = reply
+                    if reply["type"] == "ack" and reply["status"] != "success":
+                        break
+            except (websocket.WebSocketException, OSError) as e:
+                # close the socket so late replies of this request don't pile up in it, reconnect on the next request
+                try:
+                    self.close()
+                except (websocket.WebSocketException, OSError):
+                    pass
+                self._ws = None
+                raise ToolError(f"VM channel failed: {e}")
+        return replies
+
+    def run_actions(self, actions: list, settle: dict | None = None, frame: bool = False) -> dict:
+        """
+        Run a batch of typed actions on the VM, same semantics as POST /actions. With `settle` (stable_ms,
+        timeout_s, poll_ms) the VM waits for the screen to settle before replying, with `frame` it pushes a
+        screenshot afterwards. Returns {"results": [...], "settle_s": float | None, "timed_out": bool,
+        "failed_index": int | None, "error": str | None}, a batch that failed on the VM is reported in
+        failed_index and error (the results stop before the failed action) instead of raised.
+        """
+        self.last_frame = None
+        expected = {"ack"} | ({"settled"} if settle else set()) | ({"frame"} if frame else set())
+        replies = self._exchange({"type": "actions", "actions": actions, "settle": settle, "frame": frame}, expected)
+        ack = replies["ack"]
+        if ack["status"] != "success":
+            return {"results": ack.get("results", []), "settle_s": None, "timed_out": False,
+                    "failed_index": ack.get("failed_index", 0), "error": f"Status code: {ack['code']}, {ack['message']}"}
+        if "frame" in replies:
+            self.last_frame = replies["frame"]["png"]
+        settled = replies.get("settled", {})
+        return {"results": ack["results"], "settle_s": settled.get("seconds"), "timed_out": settled.get("timed_out", False),
+                "failed_index": None, "error": None}
+
+    def screenshot(self) -> bytes:
+        """PNG of the screen, the frame pushed after the last action batch if there is one"""
+        if self.last_frame is not None:
+            png, self.last_frame = self.last_frame, None
+            return png
+        return self._exchange({"type": "screenshot"}, {"frame"})["frame"]["png"]
+
+    def ping(self) -> float:
+        """Round trip time of the channel in seconds"""
+        start = time.perf_counter()
+        self._exchange({"type": "ping"}, {"pong"})
+        return time.perf_counter() - start
@@ -0,0 +1,81 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .base import ToolError
+from .vm_channel import VMChannel
+
+DEFAULT_VM_URL = "http://localhost:5000"
+
+
+class VMSession:
+    """
+    Connection to the VM server shared by everything that talks to it in one agent session.
+
+    Owns a keep-alive connection pool with a retry policy and the VM base url, and caches the display
+    profile (geometry and DPI scaling), so it is probed once per session instead of once per tool.
+    Connection errors are retried for every request. Server errors (502, 503, 504) are only retried for
+    GET requests, so an action is never run twice.
+
+    With `channel` the tools send actions and take screenshots over the server's WebSocket control channel
+    (see VMChannel), falling back to HTTP when the server has none.
+
+    Attributes:
+        base_url (str): url of the VM server, e.g. http://localhost:5000
+        timeout (float): default request timeout in seconds
+    """
+
+    def __init__(self, base_url: str = DEFAULT_VM_URL, retries: int = 3, backoff_factor: float = 0.2, pool_size: int = 4, timeout: float = 90, channel: bool = False):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.http = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self._display = None
+        self._use_channel = channel
+        self._channel = None
+
+    @property
+    def channel(self) -> VMChannel | None:
+        """The WebSocket control channel, connected on first use, None when disabled or not available"""
+        if self._use_channel and self._channel is None:
+            # http://host -> ws://host/ws, https://host -> wss://host/ws
+            channel = VMChannel(f"ws{self.base_url[4:]}/ws", timeout=self.timeout)
+            try:
+                channel.connect()
+                self._channel = channel
+            except Exception as e:
+                print(f"VM control channel not available, using HTTP: {e}")
+                self._use_channel = False
+        return self._channel
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.http.get(self.url(path), **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.http.post(self.url(path), **kwargs)
+
+    def display(self, refresh: bool = False) -> dict:
+        """Display profile of the VM, {"width": .., "height": .., "scale": ..}, probed on first use"""
+        if self._display is None or refresh:
+            try:
+                response = self.post("/action", json={"action": "size"})
+            except requests.exceptions.RequestException as e:
+                raise ToolError(f"Failed to get the screen size: {e}")
+            if response.status_code != 200:
+                raise ToolError(f"Failed to get the screen size. Status code: {response.status_code}, {response.text}")
+            result = response.json()["result"]
+            self._display = {"width": result["width"], "height": result["height"], "scale": result.get("scale", 1.0)}
+        return self._display
+
+    def close(self):
+        if self._channel is not None:
+            self._channel.close()
+        self.http.close()
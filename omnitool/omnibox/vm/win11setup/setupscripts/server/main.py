@@ -1,10 +1,14 @@
 import os
+import hashlib
+import json
 import logging
 import argparse
 import shlex
 import subprocess
 from flask import Flask, request, jsonify, send_file
+from flask_sock import Sock, ConnectionClosed
 import threading
+import time
 import traceback
 import pyautogui
 from PIL import Image
@@ -20,9 +24,128 @@ logging.basicConfig(filename=args.log_file,level=logging.DEBUG, filemode='w' )
 logger = logging.getLogger('werkzeug')
 
 app = Flask(__name__)
+sock = Sock(app)
 
 computer_control_lock = threading.Lock()
 
+# actions run in this process against the already imported pyautogui
+pyautogui.FAILSAFE = False
+
+
+def _point(params):
+    """Optional target (x, y) of a mouse action, None to act at the current position"""
+    if 'x' in params and 'y' in params:
+        return int(params['x']), int(params['y'])
+    return None, None
+
+
+def _action_move(params):
+    pyautogui.moveTo(int(params['x']), int(params['y']), duration=float(params.get('duration', 0)))
+
+
+def _action_click(params):
+    x, y = _point(params)
+    pyautogui.click(x, y, clicks=int(params.get('clicks', 1)), interval=float(params.get('interval', 0.0)), button=params.get('button', 'left'))
+
+
+def _action_mouse_down(params):
+    x, y = _point(params)
+    pyautogui.mouseDown(x, y, button=params.get('button', 'left'))
+
+
+def _action_mouse_up(params):
+    x, y = _point(params)
+    pyautogui.mouseUp(x, y, button=params.get('button', 'left'))
+
+
+def _action_key(params):
+    """Key combo: every key pressed in order, then released in reverse order. If a key can't be pressed,
+    the ones already down are still released"""
+    keys = params['keys']
+    if not isinstance(keys, list):
+        raise TypeError(f"keys must be a list, got {type(keys).__name__}")
+    pressed = []
+    try:
+        for key in keys:
+            if key not in pyautogui.KEYBOARD_KEYS:
+                raise ValueError(f"unknown key {key!r}")
+            pyautogui.keyDown(key)
+            pressed.append(key)
+    finally:
+        for key in reversed(pressed):
+            pyautogui.keyUp(key)
+
+
+def _action_key_down(params):
+    pyautogui.keyDown(params['key'])
+
+
+def _action_key_up(params):
+    pyautogui.keyUp(params['key'])
+
+
+def _action_press(params):
+    pyautogui.press(params['key'], presses=int(params.get('presses', 1)))
+
+
+def _action_type(params):
+    pyautogui.typewrite(params['text'], interval=float(params.get('interval', 0.0)))
+
+
+def _action_scroll(params):
+    x, y = _point(params)
+    pyautogui.scroll(int(params['clicks']), x=x, y=y)
+
+
+def _action_drag(params):
+    pyautogui.dragTo(int(params['x']), int(params['y']), duration=float(params.get('duration', 0.5)), button=params.get('button', 'left'))
+
+
+def _action_position(params):
+    x, y = pyautogui.position()
+    return {'x': x, 'y': y}
+
+
+def _display_scale():
+    """DPI scaling of the primary display (1.0 at 96 dpi), 1.0 where it cannot be queried"""
+    try:
+        import ctypes
+        return ctypes.windll.user32.GetDpiForSystem() / 96
+    except (AttributeError, OSError):
+        return 1.0
+
+
+def _action_size(params):
+    width, height = pyautogui.size()
+    return {'width': width, 'height': height, 'scale': _display_scale()}
+
+
+ACTIONS = {
+    'move': _action_move,
+    'click': _action_click,
+    'mouse_down': _action_mouse_down,
+    'mouse_up': _action_mouse_up,
+    'key': _action_key,
+    'key_down': _action_key_down,
+    'key_up': _action_key_up,
+    'press': _action_press,
+    'type': _action_type,
+    'scroll': _action_scroll,
+    'drag': _action_drag,
+    'position': _action_position,
+    'size': _action_size,
+}
+
+
+def run_action(action):
+    """Run one typed action dict ({"action": name, **params}), returns its result (None for input actions)"""
+    if not isinstance(action, dict):
+        raise TypeError(f"an action must be an object, got {type(action).__name__}")
+    name = action.get('action')
+    if name not in ACTIONS:
+        raise ValueError(f"unknown action {name!r}, available: {sorted(ACTIONS)}")
+    return ACTIONS[name](action)
+
 @app.route('/probe', methods=['GET'])
 def probe_endpoint():
     return jsonify({"status": "Probe successful", "message": "Service is operational"}), 200
@@ -60,8 +183,107 @@ def execute_command():
                 'message': str(e)
             }), 500
 
-@app.route('/screenshot', methods=['GET'])
-def capture_screen_with_cursor():    
+@app.route('/action', methods=['POST'])
+def action_endpoint():
+    """Run a typed action, e.g. {"action": "click", "x": 10, "y": 20, "button": "left"}"""
+    action = request.json or {}
+    with computer_control_lock:
+        try:
+            result = run_action(action)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': f'invalid action: {e!r}'}), 400
+        except Exception as e:
+            logger.error("\n" + traceback.format_exc() + "\n")
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+    return jsonify({'status': 'success', 'result': result})
+
+@app.route('/actions', methods=['POST'])
+def actions_endpoint():
+    """
+    Run an ordered batch of typed actions under one lock acquisition:
+    {"actions": [{"action": "move", "x": 10, "y": 20}, {"action": "click", "delay": 0.1}], "delay": 0}
+    An action's "delay" (or the batch default "delay") is slept, in seconds, before the next action.
+    Stops at the first failing action and reports its index.
+    """
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'the body must be an object with an "actions" list'}), 400
+    body, status = run_batch(data.get('actions', []), data.get('delay', 0))
+    return jsonify(body), status
+
+def run_batch(actions, default_delay=0.0):
+    """Run a batch of typed actions under one lock acquisition, returns the response body and HTTP status"""
+    if not isinstance(actions, list):
+        return {'status': 'error', 'message': f'actions must be a list, got {type(actions).__name__}', 'failed_index': 0, 'results': []}, 400
+    try:
+        default_delay = float(default_delay)
+    except (TypeError, ValueError) as e:
+        return {'status': 'error', 'message': f'invalid delay: {e!r}', 'failed_index': 0, 'results': []}, 400
+    results = []
+    with computer_control_lock:
+        for i, action in enumerate(actions):
+            try:
+                # a bad delay fails the action before it runs
+                delay = float(action.get('delay', default_delay)) if isinstance(action, dict) else 0.0
+                results.append(run_action(action))
+            except (ValueError, KeyError, TypeError) as e:
+                return {'status': 'error', 'message': f'invalid action: {e!r}', 'failed_index': i, 'results': results}, 400
+            except Exception as e:
+                logger.error("\n" + traceback.format_exc() + "\n")
+                return {'status': 'error', 'message': str(e), 'failed_index': i, 'results': results}, 500
+            if delay > 0 and i < len(actions) - 1:
+                time.sleep(delay)
+    return {'status': 'success', 'results': results}, 200
+
+def frame_hash(image, size=32, bits=3):
+    """Hash of a tiny grayscale thumbnail with `bits` bits per pixel, ignores caret blinks and anti-aliasing noise"""
+    w, h = image.size
+    thumb = image.convert('L').resize((size, max(1, size * h // w)), Image.BOX)
+    data = bytes(v >> (8 - bits) for v in thumb.tobytes())
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+@app.route('/screen_hash', methods=['GET'])
+def screen_hash_endpoint():
+    """Cheap screen fingerprint the client polls to detect when the UI has settled after an action"""
+    size = int(request.args.get('size', 32))
+    bits = int(request.args.get('bits', 3))
+    return jsonify({'hash': frame_hash(pyautogui.screenshot(), size, bits), 'time': time.time()})
+
+def wait_settled(stable_ms=150, timeout_s=3.0, poll_ms=30):
+    """Block until the screen hash is unchanged for stable_ms (or timeout_s), returns (seconds waited, timed out)"""
+    start = time.perf_counter()
+    last_hash = frame_hash(pyautogui.screenshot())
+    stable_since = time.perf_counter()
+    while True:
+        now = time.perf_counter()
+        if now - stable_since >= stable_ms / 1000:
+            return now - start, False
+        if now - start >= timeout_s:
+            return now - start, True
+        time.sleep(poll_ms / 1000)
+        current_hash = frame_hash(pyautogui.screenshot())
+        if current_hash != last_hash:
+            last_hash = current_hash
+            stable_since = time.perf_counter()
+
+SETTLE_OPTIONS = ('stable_ms', 'timeout_s', 'poll_ms')
+
+def settle_options(settle):
+    """wait_settled keyword arguments of a client's settle object, ValueError on unknown keys or bad values"""
+    if not isinstance(settle, dict):
+        raise ValueError(f'settle must be an object, got {type(settle).__name__}')
+    unknown = set(settle) - set(SETTLE_OPTIONS)
+    if unknown:
+        raise ValueError(f'unknown settle options {sorted(unknown)}, expected {list(SETTLE_OPTIONS)}')
+    options = {}
+    for key, value in settle.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f'settle {key} must be a non-negative number, got {value!r}')
+        options[key] = value
+    return options
+
+def screenshot_png():
+    """PNG bytes of the screen with the cursor drawn in"""
     cursor_path = os.path.join(os.path.dirname(__file__), "cursor.png")
     screenshot = pyautogui.screenshot()
     cursor_x, cursor_y = pyautogui.position()
@@ -71,11 +293,73 @@ def capture_screen_with_cursor():
     screenshot.paste(cursor, (cursor_x, cursor_y), cursor)
     
 
-    # Convert PIL Image to bytes and send
+    # Convert PIL Image to bytes
     img_io = BytesIO()
     screenshot.save(img_io, 'PNG')
-    img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+    return img_io.getvalue()
+
+@app.route('/screenshot', methods=['GET'])
+def capture_screen_with_cursor():
+    return send_file(BytesIO(screenshot_png()), mimetype='image/png')
+
+def _send_frame(ws, message_id):
+    """Frame-ready event: a JSON header, then the PNG as one binary message"""
+    png = screenshot_png()
+    ws.send(json.dumps({'id': message_id, 'type': 'frame', 'format': 'png', 'size': len(png), 'time': time.time()}))
+    ws.send(png)
+
+@sock.route('/ws')
+def control_channel(ws):
+    """
+    Persistent control channel, one JSON message per request, answered in order:
+    {"id": 1, "type": "actions", "actions": [...], "delay": 0, "settle": {"stable_ms": 150, "timeout_s": 3}, "frame": true}
+        -> {"id": 1, "type": "ack", "status": "success", "results": [...]}  (same body as POST /actions)
+        -> {"id": 1, "type": "settled", "seconds": 0.21, "timed_out": false}  when "settle" is set
+        -> {"id": 1, "type": "frame", ...} followed by the PNG as a binary message, when "frame" is true
+    {"id": 2, "type": "screenshot"} -> frame event
+    {"id": 3, "type": "ping"} -> {"id": 3, "type": "pong"}
+    """
+    while True:
+        try:
+            message = json.loads(ws.receive())
+        except ConnectionClosed:
+            return
+        except (TypeError, ValueError) as e:
+            ws.send(json.dumps({'id': None, 'type': 'error', 'message': f'invalid message: {e!r}'}))
+            continue
+        if not isinstance(message, dict):
+            ws.send(json.dumps({'id': None, 'type': 'error', 'message': 'invalid message: not an object'}))
+            continue
+        message_id = message.get('id')
+        kind = message.get('type')
+        try:
+            if kind == 'actions':
+                # checked before anything runs, the ack of a batch is final
+                try:
+                    settle = settle_options(message['settle']) if message.get('settle') else None
+                except ValueError as e:
+                    ws.send(json.dumps({'id': message_id, 'type': 'error', 'message': f'invalid settle: {e}'}))
+                    continue
+                body, status = run_batch(message.get('actions', []), message.get('delay', 0))
+                ws.send(json.dumps({'id': message_id, 'type': 'ack', 'code': status, **body}))
+                if status != 200:
+                    continue
+                if settle is not None:
+                    seconds, timed_out = wait_settled(**settle)
+                    ws.send(json.dumps({'id': message_id, 'type': 'settled', 'seconds': seconds, 'timed_out': timed_out}))
+                if message.get('frame'):
+                    _send_frame(ws, message_id)
+            elif kind == 'screenshot':
+                _send_frame(ws, message_id)
+            elif kind == 'ping':
+                ws.send(json.dumps({'id': message_id, 'type': 'pong'}))
+            else:
+                ws.send(json.dumps({'id': message_id, 'type': 'error', 'message': f'unknown message type {kind!r}'}))
+        except ConnectionClosed:
+            return
+        except Exception as e:
+            logger.error("\n" + traceback.format_exc() + "\n")
+            ws.send(json.dumps({'id': message_id, 'type': 'error', 'message': str(e)}))
 
 if __name__ == '__main__':
     app.run(debug=True, host="0.0.0.0", port=args.port)
\ No newline at end of file
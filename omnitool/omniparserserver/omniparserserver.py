@@ -5,13 +5,22 @@ python -m omniparserserver --som_model_path ../../weights/icon_detect/model.pt -
 import sys
 import os
 import time
-from fastapi import FastAPI
-from pydantic import BaseModel
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 import argparse
 import uvicorn
+import json
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(root_dir)
 from util.omniparser import Omniparser
+from util.replica_pool import ReplicaPool
+from util.ocr_engines import available_ocr_engines
+from util.metrics import REGISTRY, REPROCESSED_RATIO, observe_stages
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Omniparser API')
@@ -19,33 +28,322 @@ def parse_arguments():
     parser.add_argument('--caption_model_name', type=str, default='florence2', help='Name of the caption model')
     parser.add_argument('--caption_model_path', type=str, default='../../weights/icon_caption_florence', help='Path to the caption model')
     parser.add_argument('--device', type=str, default='cpu', help='Device to run the model')
+    parser.add_argument('--detector_backend', type=str, default='torch', choices=['torch', 'onnx', 'openvino'], help='Icon detector runtime, onnx/openvino export the .pt once and cache the graph next to it')
+    parser.add_argument('--caption_precision', type=str, default='auto', choices=['auto', 'fp32', 'fp16', 'bf16', 'int8'], help='Caption model precision, auto is fp32 on cpu and fp16 on gpu; int8 quantizes the linear layers (cpu)')
+    parser.add_argument('--detector_precision', type=str, default='fp32', choices=['fp32', 'bf16', 'int8'], help='Icon detector precision, bf16 autocasts on cpu, int8 needs --detector_backend openvino')
+    parser.add_argument('--detector_calibration_data', type=str, default=None, help='Screenshot directory (or dataset yaml) the int8 detector is calibrated on, required with --detector_precision int8')
+    parser.add_argument('--ocr_engine', type=str, default='easyocr', choices=available_ocr_engines(), help='OCR backend, loaded on first use')
+    parser.add_argument('--caption_cache_size', type=int, default=4096, help='Max cached icon captions, 0 to disable the cache')
+    parser.add_argument('--caption_cache_ttl', type=float, default=3600, help='Seconds a cached icon caption stays valid, 0 for no expiry')
+    parser.add_argument('--caption_max_new_tokens', type=int, default=20, help='Max caption length in tokens, e.g. 8 for short captions')
+    parser.add_argument('--parse_cache_size', type=int, default=64, help='Parse results kept in memory by frame hash, 0 to disable the parse cache')
+    parser.add_argument('--parse_cache_ttl', type=float, default=0, help='Seconds a cached parse result stays valid, 0 for no expiry')
+    parser.add_argument('--parse_cache_dir', type=str, default=None, help='Directory of the on-disk parse cache tier, disabled when not set')
+    parser.add_argument('--parse_cache_disk_entries', type=int, default=1024, help='Max parse results kept on disk')
+    parser.add_argument('--caption_batch_wait_ms', type=float, default=0, help='Max ms a request waits for others to share a caption batch, 0 to disable cross-request batching')
+    parser.add_argument('--caption_batch_size', type=int, default=128, help='Max icon crops per shared caption batch')
+    parser.add_argument('--intra_op_threads', type=int, default=None, help='Torch threads per parse (captioning; OCR and detection run in parallel with half each), defaults to the cores divided by --workers or --replicas')
+    parser.add_argument('--workers', type=int, default=1, help='Parses running at the same time, each stage of the parser is still serialized')
+    parser.add_argument('--replicas', type=int, default=0, help='Parser processes, each with its own models, behind a least-loaded dispatcher; 0 parses in the server process')
+    parser.add_argument('--max_queue', type=int, default=8, help='Parse requests allowed to wait for a worker before new ones are rejected with 503')
+    parser.add_argument('--request_timeout', type=float, default=120, help='Seconds before a parse request fails with 504')
+    parser.add_argument('--warmup_resolutions', type=str, default='1920x1080', help='Comma separated WxH frame sizes parsed at startup before /probe/ reports ready, empty to skip warmup')
     parser.add_argument('--BOX_TRESHOLD', type=float, default=0.05, help='Threshold for box detection')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host for the API')
     parser.add_argument('--port', type=int, default=8000, help='Port for the API')
     args = parser.parse_args()
+    if args.detector_precision == 'int8' and not args.detector_calibration_data:
+        parser.error('--detector_precision int8 needs --detector_calibration_data, a directory of screenshots or a dataset yaml')
     return args
 
 args = parse_arguments()
 config = vars(args)
 
 app = FastAPI()
-omniparser = Omniparser(config)
 
-class ParseRequest(BaseModel):
+def create_parser():
+    if args.replicas > 0:
+        return ReplicaPool(config, args.replicas)
+    return Omniparser(config)
+
+# the models are only built in the process serving the app: `python -m omniparserserver` hands the app to
+# uvicorn by import string, and spawned processes (uvicorn's reloader, parser replicas) re-import this
+# script as __mp_main__
+omniparser = create_parser() if __name__ not in ('__main__', '__mp_main__') else None
+
+# parsing is CPU heavy and synchronous, run it off the event loop on a bounded pool
+parallel_parses = args.replicas or args.workers
+parse_executor = ThreadPoolExecutor(max_workers=parallel_parses, thread_name_prefix='omniparser-worker')
+parse_slots = asyncio.Semaphore(parallel_parses + args.max_queue)
+queue_depth = REGISTRY.gauge('omniparser_queue_depth', 'Parse jobs waiting for a worker')
+workers_busy = REGISTRY.gauge('omniparser_workers_busy', 'Parse workers running a job')
+worker_utilization = REGISTRY.gauge('omniparser_worker_utilization', 'Fraction of parse workers running a job')
+parse_requests = REGISTRY.counter('omniparser_requests_total', 'Parse requests by endpoint and status')
+request_seconds = REGISTRY.histogram('omniparser_request_seconds', 'End to end parse request latency by endpoint')
+
+def run_on_worker(fn, *fn_args, **fn_kwargs):
+    queue_depth.dec()
+    workers_busy.inc()
+    try:
+        return fn(*fn_args, **fn_kwargs)
+    finally:
+        workers_busy.dec()
+
+def record_request(endpoint: str, status: int, latency: float = None):
+    parse_requests.inc(labels={'endpoint': endpoint, 'status': str(status)})
+    if latency is not None:
+        request_seconds.observe(latency, {'endpoint': endpoint})
+
+async def submit_parse_job(request: Request, fn, *fn_args, **fn_kwargs):
+    """
+    Take a parse slot, rejecting with 503 when the queue is full, and submit fn to the parse worker pool.
+    The slot is held until the worker future is done: a job that timed out keeps its slot until it
+    actually finishes, so the pool never has more jobs than slots.
+    """
+    if parse_slots.locked():
+        record_request(request.url.path, 503)
+        raise HTTPException(status_code=503, detail='parser queue is full')
+    await parse_slots.acquire()
+    loop = asyncio.get_running_loop()
+    queue_depth.inc()
+    try:
+        future = parse_executor.submit(run_on_worker, fn, *fn_args, **fn_kwargs)
+    except BaseException:
+        queue_depth.dec()
+        parse_slots.release()
+        raise
+    # a job cancelled while queued never reaches run_on_worker
+    future.add_done_callback(lambda f: queue_depth.dec() if f.cancelled() else None)
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(parse_slots.release))
+    return future
+
+async def run_parse_job(request: Request, fn, *fn_args, **fn_kwargs):
+    """
+    Run fn on the parse worker pool. Rejects with 503 when the queue is full, 504 on timeout,
+    and drops the job if the client disconnects while it is still queued. A failed job is recorded as a 500.
+    """
+    endpoint = request.url.path
+    future = await submit_parse_job(request, fn, *fn_args, **fn_kwargs)
+    job = asyncio.wrap_future(future)
+    deadline = time.monotonic() + args.request_timeout
+    while True:
+        try:
+            return await asyncio.wait_for(asyncio.shield(job), timeout=min(0.5, max(0.0, deadline - time.monotonic())))
+        except asyncio.TimeoutError:
+            pass
+        except Exception:
+            record_request(endpoint, 500)
+            raise
+        if await request.is_disconnected():
+            # a parse that already started can't be interrupted, but a queued one is skipped
+            future.cancel()
+            record_request(endpoint, 499)
+            raise HTTPException(status_code=499, detail='client disconnected')
+        if time.monotonic() >= deadline:
+            future.cancel()
+            record_request(endpoint, 504)
+            raise HTTPException(status_code=504, detail=f'parse did not finish within {args.request_timeout}s')
+
+async def stream_parse_job(request: Request, fn, *fn_args, **fn_kwargs):
+    """
+    run_parse_job for a generator fn: the generator runs on the parse worker pool and its items are
+    yielded as they come. The 503 is raised before the response starts; a timeout, failure or client
+    disconnect later on stops the generator at its next item and ends the stream with an error event.
+    """
+    endpoint = request.url.path
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        for item in fn(*fn_args, **fn_kwargs):
+            if stop.is_set():
+                break
+            loop.call_soon_threadsafe(items.put_nowait, ('item', item))
+
+    def finished(f):
+        error = None if f.cancelled() else f.exception()
+        loop.call_soon_threadsafe(items.put_nowait, ('error', error) if error is not None else ('done', None))
+
+    future = await submit_parse_job(request, produce)
+    future.add_done_callback(finished)
+
+    async def events():
+        deadline = time.monotonic() + args.request_timeout
+        try:
+            while True:
+                try:
+                    kind, value = await asyncio.wait_for(items.get(), timeout=min(0.5, max(0.0, deadline - time.monotonic())))
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        record_request(endpoint, 499)
+                        return
+                    if time.monotonic() >= deadline:
+                        record_request(endpoint, 504)
+                        yield {'event': 'error', 'status': 504, 'detail': f'parse did not finish within {args.request_timeout}s'}
+                        return
+                    continue
+                if kind == 'item':
+                    yield value
+                elif kind == 'error':
+                    record_request(endpoint, 500)
+                    yield {'event': 'error', 'status': 500, 'detail': repr(value)}
+                    return
+                else:
+                    return
+        finally:
+            # the worker keeps its slot until the generator has noticed and returned
+            stop.set()
+            future.cancel()
+
+    return events()
+
+class ResponseOptions(BaseModel):
+    # with_som=False skips annotating and encoding the SOM image, som_image_base64 is then null
+    with_som: bool = True
+    som_format: Literal['png', 'jpeg', 'webp'] = 'png'
+    som_quality: Optional[int] = Field(None, ge=1, le=100)  # jpeg/webp quality
+    som_max_side: Optional[int] = Field(None, ge=1)  # downscale the SOM image to this longer side, in pixels
+    # keep only these keys of every parsed element, e.g. ["content", "bbox"]
+    fields: Optional[List[str]] = None
+
+    def som_options(self):
+        return {'image_format': self.som_format.upper(), 'quality': self.som_quality, 'max_side': self.som_max_side}
+
+    def project(self, parsed_content_list):
+        if self.fields is None:
+            return parsed_content_list
+        return [{key: elem[key] for key in self.fields if key in elem} for elem in parsed_content_list]
+
+class ParseRequest(ResponseOptions):
     base64_image: str
+    # frames sent with the same session_id are parsed incrementally against the previous one
+    session_id: Optional[str] = None
+
+async def run_parse(request: Request, image, session_id: Optional[str], options: ResponseOptions, start: float):
+    response = {}
+    timings = {}
+    render_args = {'timings': timings, 'with_som': options.with_som, 'som_options': options.som_options()}
+    if session_id:
+        dino_labled_img, parsed_content_list, response['reprocessed_ratio'] = await run_parse_job(request, omniparser.parse_incremental, image, session_id, **render_args)
+        REPROCESSED_RATIO.observe(response['reprocessed_ratio'])
+    else:
+        dino_labled_img, parsed_content_list, response['cache_hit'] = await run_parse_job(request, omniparser.parse_cached, image, **render_args)
+    latency = time.time() - start
+    print('time:', latency, 'stages:', timings)
+    observe_stages(timings, [parsed_content_list])
+    record_request(request.url.path, 200, latency)
+    return {"som_image_base64": dino_labled_img, "parsed_content_list": options.project(parsed_content_list), 'latency': latency, 'timings': timings, **response}
 
 @app.post("/parse/")
-async def parse(parse_request: ParseRequest):
+async def parse(parse_request: ParseRequest, request: Request):
+    print('start parsing...')
+    start = time.time()
+    return await run_parse(request, parse_request.base64_image, parse_request.session_id, parse_request, start)
+
+async def read_image_bytes(request: Request) -> bytes:
+    """Image bytes of a raw (application/octet-stream, image/*) or multipart/form-data upload"""
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        upload = next((value for value in form.values() if hasattr(value, 'read')), None)
+        if upload is None:
+            raise HTTPException(status_code=400, detail='multipart body has no file part')
+        return await upload.read()
+    body = await request.body()
+    if not body:
+        raise HTTPException(status_code=400, detail='empty request body')
+    return body
+
+@app.post("/parse_image/")
+async def parse_image(request: Request, session_id: Optional[str] = None, with_som: bool = True, som_format: Literal['png', 'jpeg', 'webp'] = 'png',
+                      som_quality: Optional[int] = Query(None, ge=1, le=100), som_max_side: Optional[int] = Query(None, ge=1), fields: Optional[str] = None):
+    """
+    Same as /parse/, but the screenshot is sent as raw PNG/JPEG bytes instead of base64 JSON.
+    The response options are query parameters, `fields` comma separated.
+    """
     print('start parsing...')
     start = time.time()
-    dino_labled_img, parsed_content_list = omniparser.parse(parse_request.base64_image)
+    image_bytes = await read_image_bytes(request)
+    options = ResponseOptions(with_som=with_som, som_format=som_format, som_quality=som_quality, som_max_side=som_max_side,
+                              fields=fields.split(',') if fields else None)
+    return await run_parse(request, image_bytes, session_id, options, start)
+
+class ParseBatchRequest(ResponseOptions):
+    base64_images: List[str]
+
+@app.post("/parse_batch/")
+async def parse_batch(parse_request: ParseBatchRequest, request: Request):
+    print(f'start parsing a batch of {len(parse_request.base64_images)}...')
+    start = time.time()
+    timings = {}
+    results = await run_parse_job(request, omniparser.parse_batch, parse_request.base64_images, timings=timings, with_som=parse_request.with_som, som_options=parse_request.som_options())
     latency = time.time() - start
-    print('time:', latency)
-    return {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, 'latency': latency}
+    print('time:', latency, 'stages:', timings)
+    observe_stages(timings, [parsed_content_list for _, parsed_content_list in results])
+    record_request(request.url.path, 200, latency)
+    return {"results": [{"som_image_base64": dino_labled_img, "parsed_content_list": parse_request.project(parsed_content_list)} for dino_labled_img, parsed_content_list in results], 'latency': latency, 'timings': timings}
+
+@app.post("/parse_stream/")
+async def parse_stream(parse_request: ParseRequest, request: Request):
+    """NDJSON stream: OCR elements, uncaptioned icons, caption updates per batch, then the SOM image"""
+    stream = await stream_parse_job(request, omniparser.parse_stream, parse_request.base64_image)
+
+    async def events():
+        async for event in stream:
+            if event['event'] == 'done':
+                observe_stages(event['timings'])
+                record_request(request.url.path, 200, event['latency'])
+            yield json.dumps(event) + '\n'
+    return StreamingResponse(events(), media_type='application/x-ndjson')
+
+@app.get("/metrics")
+async def metrics(format: Literal['prometheus', 'json'] = 'prometheus'):
+    """Stage latency histograms, box/crop counters, queue depth and worker utilisation"""
+    worker_utilization.set(workers_busy.snapshot().get('total', 0) / parallel_parses)
+    caption_batcher = getattr(omniparser, 'caption_batcher', None)
+    if caption_batcher is not None:
+        REGISTRY.gauge('omniparser_caption_queue_depth', 'Crop requests waiting for a shared caption batch').set(caption_batcher.stats()['queue_depth'])
+    if format == 'json':
+        return REGISTRY.snapshot()
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+# sync endpoints, with replicas the stats are collected from every replica process
+@app.get("/stats/")
+@app.get("/admin/cache/", include_in_schema=False)
+def stats():
+    """Parse cache, caption cache and caption batcher stats; /admin/cache/ is an alias next to the flush endpoint"""
+    return omniparser.stats()
+
+@app.post("/admin/cache/flush/")
+def flush_cache(cache: Literal['all', 'parse', 'caption'] = 'all'):
+    """Drop the cached parse results and/or icon captions (memory and disk)"""
+    return {'flushed': omniparser.flush_cache(cache)}
+
+readiness = {'ready': False, 'warmup': None, 'error': None}
+
+def run_warmup():
+    resolutions = [tuple(int(v) for v in size.lower().split('x')) for size in args.warmup_resolutions.split(',') if size.strip()]
+    try:
+        if resolutions:
+            start = time.time()
+            readiness['warmup'] = omniparser.warmup(resolutions)
+            print(f'warmup done in {time.time() - start:.1f}s:', readiness['warmup'])
+        readiness['ready'] = True
+    except Exception as e:
+        readiness['error'] = repr(e)
+        print('warmup failed:', e)
+
+@app.on_event("startup")
+async def start_warmup():
+    # the server accepts connections right away, /probe/ keeps load balancers away until warmup is done
+    threading.Thread(target=run_warmup, name='omniparser-warmup', daemon=True).start()
 
 @app.get("/probe/")
 async def root():
-    return {"message": "Omniparser API ready"}
+    if not readiness['ready']:
+        return JSONResponse(status_code=503, content={"message": "Omniparser API warming up", **readiness})
+    return {"message": "Omniparser API ready", "warmup": readiness['warmup']}
 
 if __name__ == "__main__":
     uvicorn.run("omniparserserver:app", host=args.host, port=args.port, reload=True)
\ No newline at end of file
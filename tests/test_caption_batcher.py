@@ -0,0 +1,62 @@
+import threading
+import time
+
+import torch
+
+import util.caption_batcher as caption_batcher
+from util.caption_batcher import CaptionBatcher
+
+
+def test_requests_queued_behind_a_busy_model_share_one_call(monkeypatch):
+    calls = []
+    model_busy = threading.Event()
+    release = threading.Event()
+
+    def fake_caption_crops(crops, caption_model_processor, prompt, batch_size=128, max_new_tokens=20):
+        calls.append(len(crops))
+        model_busy.set()
+        release.wait(timeout=10)
+        return [f'caption {i}' for i in range(len(crops))]
+
+    monkeypatch.setattr(caption_batcher, 'caption_crops', fake_caption_crops)
+    batcher = CaptionBatcher(caption_model_processor=None, max_batch_size=128, max_wait_ms=1)
+    try:
+        first = batcher.submit(torch.zeros(4, 3, 64, 64), '<CAPTION>')
+        assert model_busy.wait(timeout=10)
+        queued = [batcher.submit(torch.zeros(4, 3, 64, 64), '<CAPTION>') for _ in range(8)]
+        # the model stays busy well past the queued requests' max_wait_ms
+        time.sleep(0.05)
+        release.set()
+        assert first.result(timeout=10) == [f'caption {i}' for i in range(4)]
+        for i, future in enumerate(queued):
+            assert future.result(timeout=10) == [f'caption {j}' for j in range(4 * i, 4 * i + 4)]
+        assert calls == [4, 32]
+    finally:
+        release.set()
+        batcher.close()
+
+
+def test_requests_with_another_prompt_wait_for_the_next_call(monkeypatch):
+    calls = []
+    model_busy = threading.Event()
+    release = threading.Event()
+
+    def fake_caption_crops(crops, caption_model_processor, prompt, batch_size=128, max_new_tokens=20):
+        calls.append((prompt, len(crops)))
+        model_busy.set()
+        release.wait(timeout=10)
+        return [prompt] * len(crops)
+
+    monkeypatch.setattr(caption_batcher, 'caption_crops', fake_caption_crops)
+    batcher = CaptionBatcher(caption_model_processor=None, max_batch_size=128, max_wait_ms=1)
+    try:
+        batcher.submit(torch.zeros(1, 3, 64, 64), '<CAPTION>')
+        assert model_busy.wait(timeout=10)
+        futures = [batcher.submit(torch.zeros(2, 3, 64, 64), prompt) for prompt in ('<CAPTION>', '<OD>', '<CAPTION>')]
+        time.sleep(0.05)
+        release.set()
+        assert [future.result(timeout=10) for future in futures] == [['<CAPTION>'] * 2, ['<OD>'] * 2, ['<CAPTION>'] * 2]
+        assert calls == [('<CAPTION>', 1), ('<CAPTION>', 4), ('<OD>', 2)]
+    finally:
+        release.set()
+        batcher.close()
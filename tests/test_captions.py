@@ -0,0 +1,50 @@
+import os
+
+import pytest
+import torch
+
+from util.bench_caption import caption_baseline, caption_with_stats, load_fixtures, load_golden
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'fixtures', 'captions')
+WEIGHTS = os.path.join(ROOT, 'weights', 'icon_caption_florence')
+BATCH_SIZE, MAX_NEW_TOKENS = 128, 20
+
+
+@pytest.fixture(scope='module')
+def caption_model_processor():
+    if not os.path.isdir(WEIGHTS):
+        pytest.skip(f'needs the Florence-2 caption weights in {WEIGHTS}')
+    from util.utils import get_caption_model_processor
+    return get_caption_model_processor('florence2', WEIGHTS)
+
+
+@pytest.fixture(scope='module')
+def fixtures():
+    fixtures = load_fixtures(FIXTURES)
+    assert fixtures, f'no screenshot listed in {FIXTURES}/boxes.json'
+    return fixtures
+
+
+def test_baseline_captions_match_the_golden_ones(caption_model_processor, fixtures):
+    from util.utils import default_caption_prompt
+    golden = load_golden(FIXTURES)
+    assert golden is not None, 'no golden captions, write them with python -m util.bench_caption --update_golden'
+    prompt = default_caption_prompt(caption_model_processor)
+
+    for name, image, boxes in fixtures:
+        assert caption_baseline(image, boxes, caption_model_processor, prompt, BATCH_SIZE, MAX_NEW_TOKENS) == golden[name], name
+
+
+def test_kv_cache_does_not_change_captions(caption_model_processor, fixtures):
+    from util.utils import default_caption_prompt, extract_icon_crops
+    prompt = default_caption_prompt(caption_model_processor)
+    crops = torch.cat([extract_icon_crops(image, torch.from_numpy(boxes)) for _, image, boxes in fixtures])
+
+    captions = {}
+    for use_cache in (False, True):
+        caption_model_processor['use_cache'] = use_cache
+        captions[use_cache] = caption_with_stats(crops, caption_model_processor, prompt, BATCH_SIZE, MAX_NEW_TOKENS)[0]
+
+    assert caption_model_processor['use_cache'], 'the kv cache got disabled as incompatible'
+    assert captions[True] == captions[False]
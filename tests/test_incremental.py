@@ -0,0 +1,69 @@
+import numpy as np
+
+from util.incremental import IncrementalParseSession
+
+
+W, H = 1920, 1080
+
+
+def _element(x0, y0, x1, y1, content):
+    return {'type': 'text', 'bbox': [x0 / W, y0 / H, x1 / W, y1 / H], 'interactivity': False, 'content': content, 'source': 'box_ocr_content_ocr'}
+
+
+def _session_with_change(elements, changed):
+    """Session whose previous frame differs from the returned frame in the `changed` pixel rectangle"""
+    session = IncrementalParseSession(tile_size=64, margin=32)
+    prev_frame = np.full((H, W, 3), 236, dtype=np.uint8)
+    session.update(prev_frame, elements)
+    frame = prev_frame.copy()
+    x0, y0, x1, y1 = changed
+    frame[y0:y1, x0:x1] = 0
+    return session, frame
+
+
+def _contains(region, bbox):
+    x0, y0, x1, y1 = region
+    return x0 <= bbox[0] * W and y0 <= bbox[1] * H and bbox[2] * W <= x1 and bbox[3] * H <= y1
+
+
+def test_region_grows_to_cover_an_element_straddling_its_edge():
+    straddling = _element(192, 108, 384, 216, 'File  Edit  View')
+    far = _element(1500, 900, 1700, 950, 'Status')
+    # dirty tiles x 192-320, y 64-128: with the margin the region is x 160-352, y 32-160
+    session, frame = _session_with_change([straddling, far], (200, 70, 300, 120))
+
+    regions = session.dirty_regions(frame)
+
+    assert regions == [(160, 32, 384, 216)]
+    assert _contains(regions[0], straddling['bbox'])
+    assert session.carry_over(regions, W, H) == [far]
+
+
+def test_region_growth_repeats_until_no_element_is_cut():
+    straddling = _element(192, 108, 384, 216, 'File  Edit  View')
+    # only intersects the region once it has grown to cover `straddling`
+    chained = _element(370, 200, 450, 230, 'Help')
+    session, frame = _session_with_change([straddling, chained], (200, 70, 300, 120))
+
+    regions = session.dirty_regions(frame)
+
+    assert len(regions) == 1
+    assert _contains(regions[0], straddling['bbox'])
+    assert _contains(regions[0], chained['bbox'])
+    assert session.carry_over(regions, W, H) == []
+
+
+def test_regions_merged_after_growing():
+    # two separate dirty spots joined by one element spanning both
+    wide = _element(100, 500, 1000, 540, 'a long text line')
+    session = IncrementalParseSession(tile_size=64, margin=32)
+    prev_frame = np.full((H, W, 3), 236, dtype=np.uint8)
+    session.update(prev_frame, [wide])
+    frame = prev_frame.copy()
+    frame[510:530, 130:150] = 0
+    frame[510:530, 900:920] = 0
+
+    regions = session.dirty_regions(frame)
+
+    assert len(regions) == 1
+    assert _contains(regions[0], wide['bbox'])
@@ -0,0 +1,29 @@
+import pickle
+
+from util.metrics import Counter, Histogram
+
+
+def test_drained_histogram_merges_into_another_process_registry():
+    replica = Histogram('omniparser_caption_batch_seconds', '', buckets=(0.1, 1.0))
+    parent = Histogram('omniparser_caption_batch_seconds', '', buckets=(0.1, 1.0))
+    parent.observe(0.05)
+    replica.observe(0.5)
+    replica.observe(2.0)
+
+    # the drained series go through the replica result queue
+    parent.merge(pickle.loads(pickle.dumps(replica.drain())))
+
+    assert parent.snapshot() == {'total': {'count': 3, 'sum': 2.55, 'mean': 2.55 / 3}}
+    assert ('omniparser_caption_batch_seconds_bucket{le="1.0"}', 2) in parent.samples()
+    assert replica.snapshot() == {}
+
+
+def test_counter_drain_only_returns_new_counts():
+    replica = Counter('omniparser_crops_captioned_total', '')
+    parent = Counter('omniparser_crops_captioned_total', '')
+    replica.inc(12)
+    parent.merge(replica.drain())
+    replica.inc(3, labels={'model': 'florence2'})
+    parent.merge(replica.drain())
+
+    assert parent.snapshot() == {'total': 12, '{model="florence2"}': 3}
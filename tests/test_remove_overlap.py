@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from util.utils import remove_overlap, remove_overlap_new
+from util.bench_overlap import remove_overlap_loop, remove_overlap_new_loop, random_layout, check_equivalence
+
+
+@pytest.mark.parametrize('n_icons', [5, 60, 500])
+@pytest.mark.parametrize('seed', range(4))
+def test_vectorized_suppression_matches_the_loops(n_icons, seed):
+    assert check_equivalence(n_icons, seed) == []
+
+
+def test_ocr_labels_are_absorbed_once():
+    ocr = [{'type': 'text', 'bbox': [0.1, 0.1, 0.2, 0.12], 'interactivity': False, 'content': 'Save', 'source': 'box_ocr_content_ocr'}]
+    # two buttons of the same size around one text line: both take the label, the text line goes
+    icons = [{'type': 'icon', 'bbox': [0.09, 0.09, 0.21, 0.13], 'interactivity': True, 'content': None},
+             {'type': 'icon', 'bbox': [0.09, 0.09, 0.21, 0.13], 'interactivity': True, 'content': None}]
+
+    result = remove_overlap_new(icons, 0.7, ocr)
+
+    assert result == remove_overlap_new_loop(icons, 0.7, ocr)
+    assert [elem['content'] for elem in result] == ['Save ', 'Save ']
+
+
+def test_remove_overlap_with_ocr_matches_the_loop():
+    icons, ocr_elems = random_layout(200, seed=7)
+    ocr_xyxy = [elem['bbox'] for elem in ocr_elems]
+
+    assert torch.equal(remove_overlap(torch.tensor(icons), 0.7, ocr_xyxy), remove_overlap_loop(torch.tensor(icons), 0.7, ocr_xyxy))
+    assert torch.equal(remove_overlap(torch.tensor(icons), 0.7), remove_overlap_loop(torch.tensor(icons), 0.7))
+
+
+@pytest.mark.parametrize('n_ocr', [10, 1000])
+def test_grid_and_dense_ocr_checks_agree(n_ocr):
+    icons, ocr_elems = random_layout(300, seed=3, n_ocr=n_ocr)
+    icon_elems = [{'type': 'icon', 'bbox': box, 'interactivity': True, 'content': None} for box in icons.tolist()]
+
+    dense = remove_overlap_new(icon_elems, 0.7, ocr_elems, use_grid=False)
+
+    assert remove_overlap_new(icon_elems, 0.7, ocr_elems, use_grid=True) == dense
+    assert remove_overlap_new(icon_elems, 0.7, ocr_elems) == dense
@@ -0,0 +1,51 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import util.replica_pool as replica_pool
+from util.replica_pool import ReplicaPool
+
+
+def _fake_replica_main(replica_idx, config, job_queue, result_queue):
+    """Replica speaking the job protocol of _replica_main without models, parse_stream sends SOM sized items"""
+    result_queue.put((None, 'ready', replica_idx))
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, method, args, kwargs = job
+        if method == 'parse_stream':
+            for i in range(config['stream_items']):
+                blocks = []
+                item = {'event': 'caption', 'index': i, 'som': 'x' * 100_000, 'mask': np.ones((64, 64), dtype=np.uint8)}
+                result_queue.put((job_id, 'item', replica_pool._share(item, blocks)))
+                replica_pool._release(blocks, unlink=False)
+                time.sleep(0.02)
+        blocks = []
+        result_queue.put((job_id, 'done', replica_pool._share((method, None, {}), blocks)))
+        replica_pool._release(blocks, unlink=False)
+
+
+def _shared_blocks():
+    # SharedMemory names its POSIX blocks psm_*, the queues' semaphores also live in /dev/shm
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')}
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs /dev/shm to list shared memory blocks')
+def test_closing_a_stream_early_unlinks_its_remaining_results(monkeypatch):
+    monkeypatch.setattr(replica_pool, '_replica_main', _fake_replica_main)
+    blocks_before = _shared_blocks()
+    pool = ReplicaPool({'stream_items': 5}, replicas=1)
+    try:
+        stream = pool.parse_stream(np.zeros((32, 32, 3), dtype=np.uint8))
+        first = next(stream)
+        assert first['index'] == 0 and len(first['som']) == 100_000
+        stream.close()
+        # the replica runs its jobs in order, the abandoned stream's results have all been read once this returns
+        assert pool.call('ping') == 'ping'
+        assert _shared_blocks() - blocks_before == set()
+        assert pool._load == [0]
+    finally:
+        pool.close()
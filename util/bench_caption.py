@@ -0,0 +1,162 @@
+'''
+Caption regression check and tokens/sec of KV-cached Florence-2 generation against generation without the cache:
+
+python -m util.bench_caption --fixtures fixtures/captions
+python -m util.bench_caption --fixtures fixtures/captions --update_golden
+
+The fixture directory holds screenshots and boxes.json, the icon boxes (normalized xyxy) of every screenshot, so
+the same crops are captioned on every run. They are captioned three ways:
+  baseline  the pipeline before the tensorized crops and the KV cache: a cv2 crop + resize per box, the caption
+            processor on the PIL crops, generate(use_cache=False)
+  no cache  extract_icon_crops (roi_align) + crops_to_pixel_values, generation without the KV cache
+  kv cache  the same preprocessing, KV-cached generation (what the parser runs)
+kv cache has to match no cache exactly, the KV cache must not change a caption. The baseline captions have to
+match the golden ones in <fixtures>/captions.json, written from the baseline with --update_golden, which catches
+drift of the model or of a transformers / remote-code upgrade. kv cache vs baseline is only reported: roi_align
+samples the crops differently from cv2 (up to 132/255 per pixel on desktop.png), so some captions differ.
+Exits with status 1 on any failed check or a missing golden file, so it can gate an upgrade. tests/test_captions.py
+runs the same checks when the weights are there.
+'''
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from util.utils import (get_caption_model_processor, extract_icon_crops, crops_to_pixel_values,
+                        default_caption_prompt, _prompt_inputs, _generate_florence)
+from util.bench_crops import crops_cv2
+from util.bench_detector import latency_summary
+
+
+@torch.inference_mode()
+def caption_with_stats(crops, caption_model_processor, prompt, batch_size, max_new_tokens):
+    """Captions of the crops, the generated token count and the latency of every batch"""
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    pad_token_id = processor.tokenizer.pad_token_id
+    captions, tokens, latencies = [], 0, []
+    for i in range(0, len(crops), batch_size):
+        batch = crops[i:i + batch_size]
+        pixel_values = crops_to_pixel_values(batch, processor, do_resize=model.device.type != 'cuda').to(device=model.device, dtype=model.dtype)
+        input_ids = _prompt_inputs(caption_model_processor, prompt, len(batch))['input_ids'].to(model.device)
+        start = time.perf_counter()
+        generated_ids = _generate_florence(caption_model_processor, input_ids, pixel_values, max_new_tokens)
+        latencies.append(time.perf_counter() - start)
+        # every sequence starts with the decoder start token, finished ones are padded
+        tokens += int((generated_ids[:, 1:] != pad_token_id).sum())
+        captions.extend(text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True))
+    return captions, tokens, latencies
+
+
+@torch.inference_mode()
+def caption_baseline(image_source, boxes, caption_model_processor, prompt, batch_size, max_new_tokens):
+    """Captions of the boxes by get_parsed_content_icon as it was before the tensorized crops and the KV cache"""
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    croped_pil_image = crops_cv2(image_source, boxes)
+    captions = []
+    for i in range(0, len(croped_pil_image), batch_size):
+        batch = croped_pil_image[i:i + batch_size]
+        if model.device.type == 'cuda':
+            inputs = processor(images=batch, text=[prompt] * len(batch), return_tensors="pt", do_resize=False).to(device=model.device, dtype=model.dtype)
+        else:
+            inputs = processor(images=batch, text=[prompt] * len(batch), return_tensors="pt").to(device=model.device)
+        generated_ids = model.generate(input_ids=inputs["input_ids"], pixel_values=inputs["pixel_values"], max_new_tokens=max_new_tokens,
+                                       num_beams=1, do_sample=False, use_cache=False, pad_token_id=processor.tokenizer.pad_token_id)
+        captions.extend(text.strip() for text in processor.batch_decode(generated_ids, skip_special_tokens=True))
+    return captions
+
+
+def load_fixtures(directory):
+    """(name, RGB ndarray, (N, 4) boxes) of every screenshot listed in <directory>/boxes.json"""
+    if not os.path.exists(os.path.join(directory, 'boxes.json')):
+        return []
+    with open(os.path.join(directory, 'boxes.json')) as f:
+        boxes = json.load(f)
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.png'))):
+        name = os.path.basename(path)
+        if name in boxes:
+            fixtures.append((name, np.array(Image.open(path).convert('RGB')), np.asarray(boxes[name], dtype=np.float64).reshape(-1, 4)))
+    return fixtures
+
+
+def report(label, expected, actual):
+    """Print how many captions of `actual` match `expected`, returns the matching fraction"""
+    mismatches = [(i, a, b) for i, (a, b) in enumerate(zip(expected, actual)) if a != b]
+    print(f'{label}: {len(actual) - len(mismatches)}/{len(actual)} captions identical')
+    for i, a, b in mismatches[:10]:
+        print(f'  crop {i}: {a!r} != {b!r}')
+    return 1 - len(mismatches) / len(actual) if actual else 1.0
+
+
+def load_golden(directory):
+    """Golden baseline captions of <directory>/captions.json by screenshot name, None if not written yet"""
+    path = os.path.join(directory, 'captions.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Florence-2 caption regression against the baseline pipeline, tokens/sec with and without the KV cache')
+    parser.add_argument('--caption_model_path', type=str, default='weights/icon_caption_florence')
+    parser.add_argument('--fixtures', type=str, default='fixtures/captions', help='Directory of screenshots and their boxes.json')
+    parser.add_argument('--update_golden', action='store_true', help='Write <fixtures>/captions.json from the baseline captions')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--max_new_tokens', type=int, default=20)
+    parser.add_argument('--device', type=str, default=None)
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    if not fixtures:
+        parser.error(f'no screenshot listed in {args.fixtures}/boxes.json')
+    crops = torch.cat([extract_icon_crops(image, torch.from_numpy(boxes)) for _, image, boxes in fixtures])
+    print(f'{len(fixtures)} frames, {len(crops)} icon crops')
+
+    caption_model_processor = get_caption_model_processor('florence2', args.caption_model_path, device=args.device)
+    prompt = default_caption_prompt(caption_model_processor)
+    baseline = {name: caption_baseline(image, boxes, caption_model_processor, prompt, args.batch_size, args.max_new_tokens)
+                for name, image, boxes in fixtures}
+    results = {}
+    for mode, use_cache in (('no cache', False), ('kv cache', True)):
+        caption_model_processor['use_cache'] = use_cache
+        # untimed first run
+        caption_with_stats(crops[:2], caption_model_processor, prompt, args.batch_size, args.max_new_tokens)
+        captions, tokens, latencies = caption_with_stats(crops, caption_model_processor, prompt, args.batch_size, args.max_new_tokens)
+        if use_cache and not caption_model_processor.get('use_cache', True):
+            print('the kv cache got disabled as incompatible, no cached numbers')
+            raise SystemExit(1)
+        results[mode] = captions
+        summary = latency_summary(latencies)
+        print(f"{mode:>8}: {tokens / sum(latencies):.1f} tokens/s, {len(captions) / sum(latencies):.1f} crops/s | "
+              f"batch mean {summary['mean_ms']:.1f} ms  p50 {summary['p50_ms']:.1f} ms  p90 {summary['p90_ms']:.1f} ms")
+
+    failed = report('kv cache vs no cache', results['no cache'], results['kv cache']) < 1.0
+    baseline_captions = [caption for name, _, _ in fixtures for caption in baseline[name]]
+    report('kv cache vs baseline', baseline_captions, results['kv cache'])
+
+    golden_path = os.path.join(args.fixtures, 'captions.json')
+    golden = load_golden(args.fixtures)
+    if args.update_golden:
+        with open(golden_path, 'w') as f:
+            json.dump(baseline, f, indent=1)
+        print(f'wrote {golden_path}')
+    elif golden is None:
+        print(f'no golden captions in {golden_path}, write them from the baseline pipeline with --update_golden')
+        failed = True
+    else:
+        golden_captions = [caption for name, _, _ in fixtures for caption in golden.get(name, [])]
+        failed |= report('baseline vs golden', golden_captions, baseline_captions) < 1.0 or len(golden_captions) != len(baseline_captions)
+
+    if failed:
+        print('FAILED: captions changed')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
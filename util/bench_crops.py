@@ -0,0 +1,117 @@
+'''
+Crops/sec of the tensorized caption preprocessing against the per-box cv2 + PIL + processor path it replaced:
+
+python -m util.bench_crops --images "path/to/screenshots/*.png" --boxes 50 200 800 --runs 5
+
+The cv2 path slices every box out of the frame, resizes it to 64x64 with cv2, converts it to PIL and runs the
+caption processor over the batch. The tensor path is extract_icon_crops (one roi_align call) followed by
+crops_to_pixel_values. Both stages are timed separately, and the mean absolute pixel value difference of the
+two paths is printed (roi_align averages samples where cv2 interpolates, so they are close but not identical).
+'''
+import argparse
+import glob
+import statistics
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+from torchvision.transforms import ToPILImage
+from transformers import AutoProcessor
+
+from util.utils import extract_icon_crops, crops_to_pixel_values
+from util.omniparser import warmup_frame
+from util.bench_detector import latency_summary
+
+
+def crops_cv2(image_source, boxes):
+    """The per-box crop loop of get_parsed_content_icon before extract_icon_crops"""
+    to_pil = ToPILImage()
+    croped_pil_image = []
+    for coord in boxes:
+        xmin, xmax = int(coord[0] * image_source.shape[1]), int(coord[2] * image_source.shape[1])
+        ymin, ymax = int(coord[1] * image_source.shape[0]), int(coord[3] * image_source.shape[0])
+        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
+        cropped_image = cv2.resize(cropped_image, (64, 64))
+        croped_pil_image.append(to_pil(cropped_image))
+    return croped_pil_image
+
+
+def pixel_values_processor(croped_pil_image, processor, prompt, do_resize=True):
+    return processor(images=croped_pil_image, text=[prompt] * len(croped_pil_image), return_tensors="pt", do_resize=do_resize)['pixel_values']
+
+
+def random_boxes(n, seed, w, h):
+    """n icon sized normalized xyxy boxes, at least 2x2 pixels"""
+    rng = np.random.default_rng(seed)
+    x0, y0 = rng.uniform(0, 0.95, n), rng.uniform(0, 0.95, n)
+    bw, bh = rng.uniform(4 / w, 0.05, n), rng.uniform(4 / h, 0.05, n)
+    return np.stack([x0, y0, np.minimum(x0 + bw, 1), np.minimum(y0 + bh, 1)], axis=1)
+
+
+def time_stage(fn, runs):
+    """Result of the last run and the latency of every run, in seconds"""
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return result, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Caption preprocessing crops/sec, roi_align vs cv2 + processor')
+    parser.add_argument('--processor', type=str, default='microsoft/Florence-2-base', help='Caption processor to load with AutoProcessor')
+    parser.add_argument('--prompt', type=str, default='<CAPTION>')
+    parser.add_argument('--images', type=str, default=None, help='Glob of screenshots, a synthetic frame when not set')
+    parser.add_argument('--boxes', type=int, nargs='+', default=[50, 200, 800], help='Icon boxes per frame')
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per frame and box count, after one untimed run')
+    parser.add_argument('--no_resize', action='store_true', help='Skip the processor resize, as on cuda')
+    args = parser.parse_args()
+
+    if args.images:
+        images = [np.asarray(Image.open(path).convert('RGB')) for path in sorted(glob.glob(args.images))]
+    else:
+        images = [warmup_frame(1920, 1080)]
+    if not images:
+        parser.error(f'no image matches {args.images}')
+
+    processor = AutoProcessor.from_pretrained(args.processor, trust_remote_code=True)
+    do_resize = not args.no_resize
+
+    for n_boxes in args.boxes:
+        latencies = {'cv2 crop': [], 'processor': [], 'roi_align crop': [], 'tensor normalize': []}
+        diffs = []
+        for seed, image_source in enumerate(images):
+            h, w = image_source.shape[:2]
+            boxes = random_boxes(n_boxes, seed, w, h)
+            stages = {
+                'cv2 crop': lambda: crops_cv2(image_source, boxes),
+                'roi_align crop': lambda: extract_icon_crops(image_source, boxes),
+            }
+            results = {}
+            for stage, fn in stages.items():
+                fn()
+                results[stage], stage_latencies = time_stage(fn, args.runs)
+                latencies[stage].extend(stage_latencies)
+            normalize = {
+                'processor': lambda: pixel_values_processor(results['cv2 crop'], processor, args.prompt, do_resize),
+                'tensor normalize': lambda: crops_to_pixel_values(results['roi_align crop'], processor, do_resize=do_resize),
+            }
+            for stage, fn in normalize.items():
+                fn()
+                results[stage], stage_latencies = time_stage(fn, args.runs)
+                latencies[stage].extend(stage_latencies)
+            diffs.append(float((results['processor'] - results['tensor normalize']).abs().mean()))
+
+        def crops_per_sec(*stages):
+            return n_boxes / sum(statistics.mean(latencies[stage]) for stage in stages)
+
+        stages = '  '.join(f"{stage} p50 {latency_summary(stage_latencies)['p50_ms']:.1f} ms" for stage, stage_latencies in latencies.items())
+        old, new = crops_per_sec('cv2 crop', 'processor'), crops_per_sec('roi_align crop', 'tensor normalize')
+        print(f'{n_boxes} boxes: cv2 + processor {old:.0f} crops/s, roi_align + tensor {new:.0f} crops/s, speedup {new / old:.1f}x | '
+              f'{stages} | mean abs pixel value diff {statistics.mean(diffs):.4f}')
+
+
+if __name__ == '__main__':
+    main()
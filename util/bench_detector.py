@@ -0,0 +1,106 @@
+'''
+Parity and latency check of an exported icon detector against the PyTorch one:
+
+python -m util.bench_detector --som_model_path weights/icon_detect/model.pt --backend onnx --images "path/to/screenshots/*.png"
+
+Every frame goes through both detectors. A box of the exported backend matches when it has IoU >= --match_iou
+with a PyTorch box. Exits with status 1 when box recall falls below --min_recall, so it can gate a deployment.
+'''
+import argparse
+import glob
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+from torchvision.ops import box_iou
+
+from util.utils import get_yolo_model, detect_icons, YOLO_BACKENDS
+from util.omniparser import warmup_frame
+
+
+def time_detector(model, images, box_threshold, runs):
+    """Detections of the last run per image and the latency of every run, in seconds"""
+    detections, latencies = [], []
+    for image in images:
+        for _ in range(runs):
+            start = time.perf_counter()
+            xyxy, conf = detect_icons(model, image, BOX_TRESHOLD=box_threshold)
+            latencies.append(time.perf_counter() - start)
+        detections.append((xyxy.cpu(), conf.cpu()))
+    return detections, latencies
+
+
+def compare(reference, candidate, match_iou):
+    """Box recall/precision of candidate vs reference detections and the largest confidence gap of matched boxes"""
+    matched_ref = matched_cand = total_ref = total_cand = 0
+    max_conf_diff = 0.0
+    for (ref_xyxy, ref_conf), (cand_xyxy, cand_conf) in zip(reference, candidate):
+        total_ref += len(ref_xyxy)
+        total_cand += len(cand_xyxy)
+        if len(ref_xyxy) == 0 or len(cand_xyxy) == 0:
+            continue
+        iou = box_iou(ref_xyxy, cand_xyxy)
+        best_iou, best_idx = iou.max(dim=1)
+        hit = best_iou >= match_iou
+        matched_ref += int(hit.sum())
+        matched_cand += int((iou.max(dim=0).values >= match_iou).sum())
+        if hit.any():
+            max_conf_diff = max(max_conf_diff, float((ref_conf[hit] - cand_conf[best_idx[hit]]).abs().max()))
+    return {
+        'recall': matched_ref / total_ref if total_ref else 1.0,
+        'precision': matched_cand / total_cand if total_cand else 1.0,
+        'max_conf_diff': max_conf_diff,
+        'boxes_reference': total_ref,
+        'boxes_candidate': total_cand,
+    }
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'mean_ms': 1000 * statistics.mean(latencies),
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p90_ms': 1000 * latencies[int(len(latencies) * 0.9)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare an exported icon detector with the PyTorch one')
+    parser.add_argument('--som_model_path', type=str, default='weights/icon_detect/model.pt')
+    parser.add_argument('--backend', type=str, default='onnx', choices=[b for b in YOLO_BACKENDS if b != 'torch'])
+    parser.add_argument('--images', type=str, default=None, help='Glob of screenshots, synthetic frames when not set')
+    parser.add_argument('--box_threshold', type=float, default=0.05)
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per image, after one untimed warmup run')
+    parser.add_argument('--match_iou', type=float, default=0.9)
+    parser.add_argument('--min_recall', type=float, default=0.98)
+    args = parser.parse_args()
+
+    if args.images:
+        images = [Image.open(path).convert('RGB') for path in sorted(glob.glob(args.images))]
+    else:
+        images = [Image.fromarray(warmup_frame(w, h)) for w, h in [(1920, 1080), (1280, 800), (1440, 900)]]
+    if not images:
+        parser.error(f'no image matches {args.images}')
+
+    results = {}
+    detections = {}
+    for backend in ('torch', args.backend):
+        model = get_yolo_model(args.som_model_path, backend=backend)
+        time_detector(model, images[:1], args.box_threshold, runs=1)
+        detections[backend], latencies = time_detector(model, images, args.box_threshold, args.runs)
+        results[backend] = latency_summary(latencies)
+
+    parity = compare(detections['torch'], detections[args.backend], args.match_iou)
+    print(f'{len(images)} frames, {args.runs} runs each')
+    for backend, summary in results.items():
+        print(f"{backend:>9}: mean {summary['mean_ms']:.1f} ms  p50 {summary['p50_ms']:.1f} ms  p90 {summary['p90_ms']:.1f} ms")
+    print(f"speedup: {results['torch']['mean_ms'] / results[args.backend]['mean_ms']:.2f}x")
+    print('parity:', parity)
+    if parity['recall'] < args.min_recall:
+        print(f"FAILED: box recall {parity['recall']:.3f} < {args.min_recall}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Startup time and memory of the OCR backends, lazily created vs the old eager import:
+
+python -m util.bench_ocr --engines easyocr,paddleocr --image path/to/screenshot.png
+
+Every scenario runs in a fresh spawned process and reports the time to import util.utils, to build the engine
+and to run it on the frame (first and steady state reads), with the RSS after each step. 'import only' is what a
+server that never runs OCR (or only one engine) pays now; 'eager' builds every engine right after the import,
+like importing util.utils used to.
+'''
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def rss_mb():
+    """Current resident set size, peak RSS where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def text_frame(w=1280, h=800):
+    """Synthetic frame of text lines, for when no --image is given"""
+    import cv2
+    frame = np.full((h, w, 3), 245, dtype=np.uint8)
+    for row, y in enumerate(range(40, h - 20, 36)):
+        cv2.putText(frame, f'Menu item {row}  Settings  Open file  Save as', (20 + 40 * (row % 5), y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (20, 20, 20), 2)
+    return frame
+
+
+def run_scenario(engines, image_path, reads):
+    """Import util.utils, build `engines` and read the frame with each, timing every step; runs in a fresh process"""
+    stats = {'rss_start_mb': rss_mb()}
+    start = time.perf_counter()
+    import util.utils  # noqa: F401
+    from util.ocr_engines import get_ocr_engine, run_ocr
+    stats['import_s'] = time.perf_counter() - start
+    stats['rss_import_mb'] = rss_mb()
+    if image_path:
+        from PIL import Image
+        image_np = np.asarray(Image.open(image_path).convert('RGB'))
+    else:
+        image_np = text_frame()
+    for name in engines:
+        start = time.perf_counter()
+        get_ocr_engine(name)
+        stats[f'{name}_create_s'] = time.perf_counter() - start
+        stats[f'{name}_rss_create_mb'] = rss_mb()
+    for name in engines:
+        latencies = []
+        for _ in range(reads + 1):
+            start = time.perf_counter()
+            run_ocr(name, image_np, {'text_threshold': 0.8})
+            latencies.append(time.perf_counter() - start)
+        stats[f'{name}_first_read_s'] = latencies[0]
+        stats[f'{name}_read_s'] = statistics.mean(latencies[1:]) if reads else latencies[0]
+        stats[f'{name}_rss_read_mb'] = rss_mb()
+    return stats
+
+
+def run_scenario_isolated(engines, image_path, reads):
+    """run_scenario in a fresh spawned process"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(run_scenario, engines, image_path, reads).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time and RSS of the OCR backends')
+    parser.add_argument('--engines', type=str, default='easyocr,paddleocr', help='Comma separated OCR engine names')
+    parser.add_argument('--image', type=str, default=None, help='Screenshot to read, a synthetic text frame when not set')
+    parser.add_argument('--reads', type=int, default=3, help='Timed reads per engine after the first one')
+    args = parser.parse_args()
+    engines = [name for name in args.engines.split(',') if name]
+
+    scenarios = {'import only': []}
+    scenarios.update({name: [name] for name in engines})
+    if len(engines) > 1:
+        scenarios['eager'] = engines
+    for scenario, scenario_engines in scenarios.items():
+        try:
+            stats = run_scenario_isolated(scenario_engines, args.image, args.reads)
+        except Exception as e:
+            print(f'{scenario:>12}: failed, {e!r}')
+            continue
+        line = (f"{scenario:>12}: import {stats['import_s']:.2f} s, rss {stats['rss_start_mb']:.0f} -> {stats['rss_import_mb']:.0f} MB")
+        for name in scenario_engines:
+            line += (f" | {name} create {stats[f'{name}_create_s']:.2f} s (rss {stats[f'{name}_rss_create_mb']:.0f} MB), "
+                     f"first read {stats[f'{name}_first_read_s']:.2f} s, read {stats[f'{name}_read_s']:.2f} s (rss {stats[f'{name}_rss_read_mb']:.0f} MB)")
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+'''
+Equivalence and latency check of the vectorized overlap suppression against the per-pair python loops it replaced:
+
+python -m util.bench_overlap --sizes 500 1000 2000 --runs 5
+python -m util.bench_overlap --grid_icons 300 --grid_ocr 250 500 1000 2000 4000 8000
+
+Every layout is a synthetic screen of OCR text lines and icon boxes, some of them nested, duplicated, covering a
+text line or inside one, so all branches of the suppression are hit. remove_overlap and remove_overlap_new must give
+exactly the output of the loops. Exits with status 1 on any difference.
+
+The grid case times the OCR containment check of remove_overlap_new against every OCR box (dense) and against
+the OCR boxes sharing a cell of a BoxGridIndex (grid, index build included), with --grid_icons icons and a
+growing number of OCR lines, and checks both give the same output. OCR_GRID_MIN_PAIRS is set from it.
+'''
+import argparse
+import statistics
+import time
+from typing import List
+
+import numpy as np
+import torch
+
+from util.utils import OCR_GRID_MIN_PAIRS, remove_overlap, remove_overlap_new
+from util.bench_detector import latency_summary
+
+
+def remove_overlap_loop(boxes, iou_threshold, ocr_bbox=None):
+    """remove_overlap before it was vectorized, the reference output"""
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def IoU(box1, box2):
+        intersection = intersection_area(box1, box2)
+        union = box_area(box1) + box_area(box2) - intersection + 1e-6
+        if box_area(box1) > 0 and box_area(box2) > 0:
+            ratio1 = intersection / box_area(box1)
+            ratio2 = intersection / box_area(box2)
+        else:
+            ratio1, ratio2 = 0, 0
+        return max(intersection / union, ratio1, ratio2)
+
+    def is_inside(box1, box2):
+        intersection = intersection_area(box1, box2)
+        ratio1 = intersection / box_area(box1)
+        return ratio1 > 0.95
+
+    boxes = boxes.tolist()
+    filtered_boxes = []
+    if ocr_bbox:
+        filtered_boxes.extend(ocr_bbox)
+    for i, box1 in enumerate(boxes):
+        is_valid_box = True
+        for j, box2 in enumerate(boxes):
+            # keep the smaller box
+            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
+                is_valid_box = False
+                break
+        if is_valid_box:
+            if ocr_bbox:
+                # only add the box if it does not overlap with any ocr bbox
+                if not any(IoU(box1, box3) > iou_threshold and not is_inside(box1, box3) for k, box3 in enumerate(ocr_bbox)):
+                    filtered_boxes.append(box1)
+            else:
+                filtered_boxes.append(box1)
+    return torch.tensor(filtered_boxes)
+
+
+def remove_overlap_new_loop(boxes, iou_threshold, ocr_bbox=None):
+    """remove_overlap_new before it was vectorized, the reference output (needs a non-empty ocr_bbox)"""
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def IoU(box1, box2):
+        intersection = intersection_area(box1, box2)
+        union = box_area(box1) + box_area(box2) - intersection + 1e-6
+        if box_area(box1) > 0 and box_area(box2) > 0:
+            ratio1 = intersection / box_area(box1)
+            ratio2 = intersection / box_area(box2)
+        else:
+            ratio1, ratio2 = 0, 0
+        return max(intersection / union, ratio1, ratio2)
+
+    def is_inside(box1, box2):
+        intersection = intersection_area(box1, box2)
+        ratio1 = intersection / box_area(box1)
+        return ratio1 > 0.80
+
+    filtered_boxes = []
+    if ocr_bbox:
+        filtered_boxes.extend(ocr_bbox)
+    for i, box1_elem in enumerate(boxes):
+        box1 = box1_elem['bbox']
+        is_valid_box = True
+        for j, box2_elem in enumerate(boxes):
+            # keep the smaller box
+            box2 = box2_elem['bbox']
+            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
+                is_valid_box = False
+                break
+        if is_valid_box:
+            if ocr_bbox:
+                # keep yolo boxes + prioritize ocr label
+                box_added = False
+                ocr_labels = ''
+                for box3_elem in ocr_bbox:
+                    if not box_added:
+                        box3 = box3_elem['bbox']
+                        if is_inside(box3, box1): # ocr inside icon
+                            try:
+                                # gather all ocr labels
+                                ocr_labels += box3_elem['content'] + ' '
+                                filtered_boxes.remove(box3_elem)
+                            except:
+                                continue
+                        elif is_inside(box1, box3): # icon inside ocr
+                            box_added = True
+                            break
+                        else:
+                            continue
+                if not box_added:
+                    if ocr_labels:
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
+                    else:
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
+            else:
+                filtered_boxes.append(box1)
+    return filtered_boxes
+
+
+def random_layout(n_icons, seed, w=1920, h=1080, n_ocr=None):
+    """Normalized xyxy icon boxes (N, 4) and OCR elements of a synthetic screen with n_ocr (n_icons // 2 by default) text lines"""
+    rng = np.random.default_rng(seed)
+    # text lines in rows of a grid, so they do not overlap each other
+    ocr_bbox = []
+    for k in range(max(1, n_icons // 2 if n_ocr is None else n_ocr)):
+        row, col = divmod(k, 8)
+        x0 = (col * 240 + rng.integers(0, 60)) / w
+        y0 = ((row * 24) % (h - 20) + rng.integers(0, 4)) / h
+        ocr_bbox.append([x0, y0, x0 + rng.integers(40, 170) / w, y0 + 16 / h])
+    ocr_elems = [{'type': 'text', 'bbox': box, 'interactivity': False, 'content': f'text {k}', 'source': 'box_ocr_content_ocr'}
+                 for k, box in enumerate(ocr_bbox)]
+
+    icons = []
+    for _ in range(n_icons):
+        kind = rng.integers(0, 5)
+        if kind == 0 and icons:
+            # nested in / duplicate of an earlier icon
+            x0, y0, x1, y1 = icons[rng.integers(0, len(icons))]
+            d = rng.integers(0, 4, size=4) / np.array([w, h, w, h])
+            icons.append([x0 + d[0], y0 + d[1], max(x0 + d[0] + 1 / w, x1 - d[2]), max(y0 + d[1] + 1 / h, y1 - d[3])])
+        elif kind == 1:
+            # button around a text line
+            x0, y0, x1, y1 = ocr_bbox[rng.integers(0, len(ocr_bbox))]
+            icons.append([x0 - 6 / w, y0 - 4 / h, x1 + 6 / w, y1 + 4 / h])
+        elif kind == 2:
+            # glyph inside a text line
+            x0, y0, x1, y1 = ocr_bbox[rng.integers(0, len(ocr_bbox))]
+            icons.append([x0 + 1 / w, y0 + 1 / h, x0 + 15 / w, y1 - 1 / h])
+        else:
+            x0, y0 = rng.integers(0, w - 64) / w, rng.integers(0, h - 64) / h
+            icons.append([x0, y0, x0 + rng.integers(8, 64) / w, y0 + rng.integers(8, 64) / h])
+    icons = np.clip(np.asarray(icons, dtype=np.float64), 0, 1)
+    return icons, ocr_elems
+
+
+def check_equivalence(n_icons, seed, iou_threshold=0.7):
+    """Names of the functions whose output differs from the loop version on one layout"""
+    icons, ocr_elems = random_layout(n_icons, seed)
+    ocr_xyxy = [elem['bbox'] for elem in ocr_elems]
+    failed = []
+    if not torch.equal(remove_overlap(torch.tensor(icons), iou_threshold, ocr_xyxy), remove_overlap_loop(torch.tensor(icons), iou_threshold, ocr_xyxy)):
+        failed.append('remove_overlap')
+    icon_elems = [{'type': 'icon', 'bbox': box, 'interactivity': True, 'content': None} for box in icons.tolist()]
+    if remove_overlap_new(icon_elems, iou_threshold, ocr_elems) != remove_overlap_new_loop(icon_elems, iou_threshold, ocr_elems):
+        failed.append('remove_overlap_new')
+    return failed
+
+
+def time_call(fn, runs):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def time_grid_vs_dense(n_icons, n_ocr, runs, iou_threshold):
+    """Latencies of remove_overlap_new with the dense and the grid OCR check on one layout, and whether they agree"""
+    icons, ocr_elems = random_layout(n_icons, seed=0, n_ocr=n_ocr)
+    icon_elems = [{'type': 'icon', 'bbox': box, 'interactivity': True, 'content': None} for box in icons.tolist()]
+    same = remove_overlap_new(icon_elems, iou_threshold, ocr_elems, use_grid=False) == remove_overlap_new(icon_elems, iou_threshold, ocr_elems, use_grid=True)
+    timings = {
+        'dense': time_call(lambda: remove_overlap_new(icon_elems, iou_threshold, ocr_elems, use_grid=False), runs),
+        'grid': time_call(lambda: remove_overlap_new(icon_elems, iou_threshold, ocr_elems, use_grid=True), runs),
+    }
+    return timings, same
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorized overlap suppression vs the per-pair loops')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000], help='Icon boxes per layout')
+    parser.add_argument('--seeds', type=int, default=5, help='Layouts checked for equivalence per size')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per size and implementation')
+    parser.add_argument('--iou_threshold', type=float, default=0.7)
+    parser.add_argument('--grid_icons', type=int, default=300, help='Icon boxes of the grid vs dense layouts')
+    parser.add_argument('--grid_ocr', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000, 8000], help='OCR lines of the grid vs dense layouts')
+    args = parser.parse_args()
+
+    failed = False
+    for n_icons in args.sizes:
+        for seed in range(args.seeds):
+            for name in check_equivalence(n_icons, seed, args.iou_threshold):
+                print(f'{n_icons} boxes, seed {seed}: {name} differs from the loop')
+                failed = True
+
+        icons, ocr_elems = random_layout(n_icons, seed=0)
+        icon_elems = [{'type': 'icon', 'bbox': box, 'interactivity': True, 'content': None} for box in icons.tolist()]
+        timings = {
+            'loop': time_call(lambda: remove_overlap_new_loop(icon_elems, args.iou_threshold, ocr_elems), args.runs),
+            'vectorized': time_call(lambda: remove_overlap_new(icon_elems, args.iou_threshold, ocr_elems), args.runs),
+        }
+        line = '  '.join(f"{name} p50 {latency_summary(latencies)['p50_ms']:.1f} ms" for name, latencies in timings.items())
+        print(f"{n_icons} icons, {len(ocr_elems)} ocr boxes: {line} | speedup {statistics.median(timings['loop']) / statistics.median(timings['vectorized']):.1f}x")
+
+    print(f'grid vs dense ocr check, the default switches to the grid above {OCR_GRID_MIN_PAIRS} icon x ocr pairs')
+    for n_ocr in args.grid_ocr:
+        timings, same = time_grid_vs_dense(args.grid_icons, n_ocr, args.runs, args.iou_threshold)
+        if not same:
+            print(f'{args.grid_icons} icons, {n_ocr} ocr boxes: grid output differs from dense')
+            failed = True
+        line = '  '.join(f"{name} p50 {latency_summary(latencies)['p50_ms']:.1f} ms" for name, latencies in timings.items())
+        print(f"{args.grid_icons} icons, {n_ocr} ocr boxes: {line} | grid speedup {statistics.median(timings['dense']) / statistics.median(timings['grid']):.2f}x")
+
+    if failed:
+        print('FAILED: outputs differ')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''
+Latency of the parse stage graph against running the stages one after another:
+
+python -m util.bench_stages --images "path/to/screenshots/*.png" --runs 5 --intra_op_threads 8
+
+The sequential baseline runs OCR, detection, merge, captioning and the SOM rendering in series, every stage
+with all of the parse's threads. The stage graph is Omniparser.parse: OCR || detection with half of the
+threads each, then captioning (all threads) || annotate. Caches are disabled so every run does the work.
+'''
+import argparse
+import glob
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+
+from util.utils import merge_ocr_and_icons
+from util.omniparser import Omniparser, stage_timer, warmup_frame
+from util.bench_detector import latency_summary
+
+
+def parse_sequential(omniparser, image, timings):
+    """The stages of Omniparser.parse one after another, all with the full thread budget"""
+    image_np = np.asarray(image)
+    detect_threads = omniparser.detect_threads
+    omniparser.detect_threads = omniparser.caption_threads
+    try:
+        text, ocr_bbox = omniparser._run_ocr(image, timings)
+        xyxy = omniparser._run_detection(image, timings)
+        w, h = image.size
+        with stage_timer(timings, 'merge'):
+            parsed_content_list, starting_idx, ocr_bbox = merge_ocr_and_icons(xyxy, ocr_bbox, text, w, h, iou_threshold=0.7)
+        omniparser._caption(image_np, parsed_content_list, starting_idx, ocr_bbox, text, timings)
+        omniparser._render(image_np, parsed_content_list, omniparser._draw_bbox_config(image), timings)
+    finally:
+        omniparser.detect_threads = detect_threads
+    return parsed_content_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse latency of the stage graph vs sequential stages')
+    parser.add_argument('--som_model_path', type=str, default='weights/icon_detect/model.pt')
+    parser.add_argument('--caption_model_name', type=str, default='florence2')
+    parser.add_argument('--caption_model_path', type=str, default='weights/icon_caption_florence')
+    parser.add_argument('--ocr_engine', type=str, default='easyocr')
+    parser.add_argument('--images', type=str, default=None, help='Glob of screenshots, synthetic frames when not set')
+    parser.add_argument('--box_threshold', type=float, default=0.05)
+    parser.add_argument('--intra_op_threads', type=int, default=None, help='Threads of a parse, all cores when not set')
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per image and mode, after one untimed warmup run')
+    args = parser.parse_args()
+
+    if args.images:
+        images = [Image.open(path).convert('RGB') for path in sorted(glob.glob(args.images))]
+    else:
+        images = [Image.fromarray(warmup_frame(w, h)) for w, h in [(1920, 1080), (1280, 800)]]
+    if not images:
+        parser.error(f'no image matches {args.images}')
+
+    omniparser = Omniparser({
+        'som_model_path': args.som_model_path, 'caption_model_name': args.caption_model_name, 'caption_model_path': args.caption_model_path,
+        'BOX_TRESHOLD': args.box_threshold, 'ocr_engine': args.ocr_engine, 'intra_op_threads': args.intra_op_threads,
+        'caption_cache_size': 0, 'parse_cache_size': 0,
+    })
+    modes = {
+        'sequential': lambda image, timings: parse_sequential(omniparser, image, timings),
+        'stage graph': lambda image, timings: omniparser._parse_decoded(image, np.asarray(image), timings),
+    }
+    latencies = {mode: [] for mode in modes}
+    stage_timings = {mode: {} for mode in modes}
+    for image in images:
+        for run in modes.values():
+            run(image, {})
+        for _ in range(args.runs):
+            # alternate the modes so both see the same thermal / cache state
+            for mode, run in modes.items():
+                timings = {}
+                start = time.perf_counter()
+                run(image, timings)
+                latencies[mode].append(time.perf_counter() - start)
+                for stage, seconds in timings.items():
+                    stage_timings[mode].setdefault(stage, []).append(seconds)
+
+    print(f'{len(images)} frames, {args.runs} runs each, {omniparser.caption_threads} threads per parse ({omniparser.detect_threads} each for OCR and detection in the stage graph)')
+    for mode in modes:
+        summary = latency_summary(latencies[mode])
+        stages = '  '.join(f'{stage} {1000 * statistics.mean(seconds):.0f}' for stage, seconds in stage_timings[mode].items())
+        print(f"{mode:>11}: mean {summary['mean_ms']:.1f} ms  p50 {summary['p50_ms']:.1f} ms  p90 {summary['p90_ms']:.1f} ms | stages (ms) {stages}")
+    print(f"speedup: {statistics.mean(latencies['sequential']) / statistics.mean(latencies['stage graph']):.2f}x")
+
+
+if __name__ == '__main__':
+    main()
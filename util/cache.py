@@ -0,0 +1,188 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache with optional time-to-live eviction and hit/miss counters.
+
+    Attributes:
+        max_size (int): maximum number of entries, the least recently used entry is evicted first
+        ttl (Optional[float]): seconds an entry stays valid after insertion, None to disable
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and time.monotonic() - item[1] > self.ttl:
+                del self._data[key]
+                self.evictions += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def crop_digest(crop: np.ndarray, quant_bits: int = 5) -> str:
+    """
+    Digest of an image crop with the low bits of every pixel dropped, so crops of the
+    same icon that differ only by compression noise or anti-aliasing share a key.
+    """
+    crop = np.ascontiguousarray(crop, dtype=np.uint8) >> (8 - quant_bits)
+    digest = hashlib.blake2b(crop.tobytes(), digest_size=16)
+    digest.update(str(crop.shape).encode())
+    return digest.hexdigest()
+
+
+def frame_digest(image: np.ndarray, params: Any = None) -> str:
+    """Exact digest of decoded pixels plus the parameters the result depends on."""
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(image.data, digest_size=20)
+    digest.update(str(image.shape).encode())
+    digest.update(repr(params).encode())
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    Two tier cache of parse results: an in-memory LRU in front of an optional on-disk store.
+
+    Disk entries are pickled one file per key under `disk_dir` and survive restarts; a disk hit is
+    promoted to memory. The oldest files are removed once there are more than `disk_max_entries`.
+
+    Attributes:
+        memory (LRUCache): the in-memory tier
+        disk_dir (Optional[str]): directory of the disk tier, None to disable it
+        disk_max_entries (int): maximum number of results kept on disk
+    """
+
+    def __init__(self, max_size: int = 64, ttl: Optional[float] = None, disk_dir: Optional[str] = None, disk_max_entries: int = 1024):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _disk_files(self):
+        return [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.pkl')]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.memory.get(key)
+        if value is not None or not self.disk_dir:
+            return default if value is None else value
+        path = self._path(key)
+        try:
+            if self.memory.ttl is not None and time.time() - os.path.getmtime(path) > self.memory.ttl:
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._disk_lock:
+                self.disk_misses += 1
+            return default
+        with self._disk_lock:
+            self.disk_hits += 1
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self.memory.put(key, value)
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        # unique temp file, replica processes and threads can write the same key at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix=key, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._disk_lock:
+            files = self._disk_files()
+            if len(files) > self.disk_max_entries:
+                files.sort(key=lambda entry: entry.stat().st_mtime)
+                for entry in files[:len(files) - self.disk_max_entries]:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if not self.disk_dir:
+            return
+        with self._disk_lock:
+            for entry in self._disk_files():
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        stats = {'memory': self.memory.stats(), 'disk': None}
+        if self.disk_dir:
+            total = self.disk_hits + self.disk_misses
+            stats['disk'] = {
+                'dir': self.disk_dir,
+                'entries': len(self._disk_files()),
+                'max_entries': self.disk_max_entries,
+                'hits': self.disk_hits,
+                'misses': self.disk_misses,
+                'hit_rate': self.disk_hits / total if total else 0.0,
+            }
+        return stats
@@ -0,0 +1,160 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional
+
+import torch
+
+from util.utils import caption_crops
+
+
+class _CaptionRequest:
+    def __init__(self, crops, prompt, max_new_tokens):
+        self.crops = crops
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class CaptionBatcher:
+    """
+    Collects icon crops from concurrent parse requests and captions them together.
+
+    A background thread takes the first waiting request and every request already queued behind it,
+    then keeps collecting late requests for what is left of the first request's `max_wait_ms`, until
+    `max_batch_size` crops are gathered. It runs them through the caption model as one batch and
+    hands every request its own slice of captions.
+    Requests with a different prompt or caption length are left for the next batch.
+
+    Attributes:
+        max_batch_size (int): crops per caption model batch
+        max_wait_ms (float): how long the first request of a batch waits for others to join
+        intra_op_threads (Optional[int]): torch threads of the batcher thread, the process default when None
+    """
+
+    def __init__(self, caption_model_processor, max_batch_size: int = 128, max_wait_ms: float = 10, intra_op_threads: Optional[int] = None):
+        self.caption_model_processor = caption_model_processor
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.intra_op_threads = intra_op_threads
+        self._queue = queue.Queue()
+        self._pending = []
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._batched_crops = 0
+        self._batched_requests = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='caption-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, crops, prompt: str, max_new_tokens: int = 20) -> Future:
+        """Queue a (N, 3, 64, 64) crop tensor, the future resolves to its N captions."""
+        request = _CaptionRequest(crops, prompt, max_new_tokens)
+        if len(crops) == 0:
+            request.future.set_result([])
+        else:
+            self._queue.put(request)
+        return request.future
+
+    def caption(self, crops, prompt: str, max_new_tokens: int = 20) -> List[str]:
+        return self.submit(crops, prompt, max_new_tokens).result()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches
+            return {
+                'batches': batches,
+                'requests': self._batched_requests,
+                'crops': self._batched_crops,
+                'queue_depth': self._queue.qsize() + len(self._pending),
+                'avg_requests_per_batch': self._batched_requests / batches if batches else 0.0,
+                'avg_batch_fill': self._batched_crops / (batches * self.max_batch_size) if batches else 0.0,
+                'avg_queue_wait_ms': 1000 * self._queue_wait_total / self._batched_requests if self._batched_requests else 0.0,
+                'max_queue_wait_ms': 1000 * self._queue_wait_max,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait_ms,
+            }
+
+    def _next_request(self, block: bool = True, timeout=None):
+        if self._pending:
+            return self._pending.pop(0)
+        try:
+            request = self._queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+        if request is None:
+            # keep the close sentinel for the next call, so the worker thread sees it and exits
+            self._queue.put(None)
+        return request
+
+    def _collect(self):
+        first = self._next_request()
+        if first is None:
+            return None
+        batch, size = [first], len(first.crops)
+        skipped = []
+
+        def add(request):
+            nonlocal size
+            if (request.prompt, request.max_new_tokens) != (first.prompt, first.max_new_tokens):
+                skipped.append(request)
+            else:
+                batch.append(request)
+                size += len(request.crops)
+
+        # everything that queued up while the model was busy joins without waiting
+        while size < self.max_batch_size:
+            request = self._next_request(block=False)
+            if request is None:
+                break
+            add(request)
+        # then wait for late requests for what is left of the first request's max_wait_ms
+        deadline = first.enqueued + self.max_wait_ms / 1000
+        while size < self.max_batch_size and not self._closed:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            request = self._next_request(timeout=remaining)
+            if request is not None:
+                add(request)
+        self._pending = skipped + self._pending
+        return batch
+
+    def _run(self):
+        if self.intra_op_threads:
+            torch.set_num_threads(self.intra_op_threads)
+        while True:
+            batch = self._collect()
+            if batch is None:
+                if self._closed:
+                    return
+                continue
+            started = time.perf_counter()
+            try:
+                crops = torch.cat([request.crops for request in batch])
+                captions = caption_crops(crops, self.caption_model_processor, batch[0].prompt, batch_size=self.max_batch_size, max_new_tokens=batch[0].max_new_tokens)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            offset = 0
+            for request in batch:
+                request.future.set_result(captions[offset:offset + len(request.crops)])
+                offset += len(request.crops)
+            with self._stats_lock:
+                self._batches += -(-len(crops) // self.max_batch_size)
+                self._batched_crops += len(crops)
+                self._batched_requests += len(batch)
+                for request in batch:
+                    wait = started - request.enqueued
+                    self._queue_wait_total += wait
+                    self._queue_wait_max = max(self._queue_wait_max, wait)
@@ -0,0 +1,135 @@
+'''
+Compare low precision caption / detector modes against fp32 on a fixture set of screenshots:
+
+python -m util.eval_precision --fixtures "fixtures/*.png" --modes fp32,bf16,int8
+
+For every mode it reports the caption agreement with fp32 (exact match and mean token overlap, on the same
+icon crops), the detector box recall against fp32, the mean latency per frame of both models and the RSS
+after loading and running them. Every mode runs in a fresh process, so its RSS doesn't include the memory
+left behind by the modes before it.
+'''
+import argparse
+import glob
+import multiprocessing as mp
+import os
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from util.utils import get_caption_model_processor, get_yolo_model, detect_icons, extract_icon_crops, caption_crops, default_caption_prompt
+from util.bench_detector import compare
+from util.omniparser import warmup_frame
+
+
+def rss_mb():
+    """Current resident set size, peak RSS where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def token_overlap(a: str, b: str) -> float:
+    a, b = set(a.lower().split()), set(b.lower().split())
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def run_mode(mode, args, images, crops):
+    """Detections per frame, captions per frame (of the reference crops) and the latencies of one precision mode
+
+    Runs in its own process: crops come in and detections go out as numpy arrays.
+    """
+    crops = [torch.from_numpy(c) for c in crops]
+    # int8 detection needs an openvino export, without --detector_int8 int8 only applies to the caption model
+    detector_precision = 'fp32' if mode == 'int8' and not args.detector_int8 else mode
+    caption_model_processor = get_caption_model_processor(args.caption_model_name, args.caption_model_path, device='cpu', precision=mode)
+    som_model = get_yolo_model(args.som_model_path, backend='openvino' if detector_precision == 'int8' else 'torch', precision=detector_precision,
+                               calibration_data=args.calibration_data)
+    prompt = default_caption_prompt(caption_model_processor)
+    # untimed first run
+    detect_icons(som_model, images[0], BOX_TRESHOLD=args.box_threshold, precision=detector_precision)
+    caption_crops(crops[0][:2], caption_model_processor, prompt)
+
+    detections, captions, detect_times, caption_times = [], [], [], []
+    for image, image_crops in zip(images, crops):
+        start = time.perf_counter()
+        xyxy, conf = detect_icons(som_model, image, BOX_TRESHOLD=args.box_threshold, precision=detector_precision)
+        detect_times.append(time.perf_counter() - start)
+        w, h = image.size
+        detections.append(((xyxy.cpu() * xyxy.new_tensor([w, h, w, h]).cpu()).numpy(), conf.cpu().numpy()))
+        start = time.perf_counter()
+        captions.append(caption_crops(image_crops, caption_model_processor, prompt, batch_size=args.batch_size) if len(image_crops) else [])
+        caption_times.append(time.perf_counter() - start)
+    stats = {
+        'caption_precision': caption_model_processor['precision'],
+        'detector_precision': detector_precision,
+        'detect_ms': 1000 * statistics.mean(detect_times),
+        'caption_ms': 1000 * statistics.mean(caption_times),
+        'rss_mb': rss_mb(),
+    }
+    return detections, captions, stats
+
+
+def run_mode_isolated(mode, args, images, crops):
+    """run_mode in a fresh spawned process"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+        detections, captions, stats = executor.submit(run_mode, mode, args, images, [c.numpy() for c in crops]).result()
+    return [(torch.from_numpy(xyxy), torch.from_numpy(conf)) for xyxy, conf in detections], captions, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Caption agreement, box recall, latency and RSS of precision modes vs fp32')
+    parser.add_argument('--som_model_path', type=str, default='weights/icon_detect/model.pt')
+    parser.add_argument('--caption_model_name', type=str, default='florence2')
+    parser.add_argument('--caption_model_path', type=str, default='weights/icon_caption_florence')
+    parser.add_argument('--fixtures', type=str, default=None, help='Glob of screenshots, synthetic frames when not set')
+    parser.add_argument('--modes', type=str, default='fp32,bf16,int8', help='Comma separated, fp32 is always evaluated first as the reference')
+    parser.add_argument('--box_threshold', type=float, default=0.05)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--match_iou', type=float, default=0.9)
+    parser.add_argument('--detector_int8', action='store_true', help='Also run the detector in int8 (OpenVINO export) for the int8 mode')
+    parser.add_argument('--calibration_data', type=str, default=None, help='Screenshot directory (or dataset yaml) the int8 detector is calibrated on, required with --detector_int8')
+    args = parser.parse_args()
+    if args.detector_int8 and not args.calibration_data:
+        parser.error('--detector_int8 needs --calibration_data, a directory of screenshots or a dataset yaml')
+
+    if args.fixtures:
+        images = [Image.open(path).convert('RGB') for path in sorted(glob.glob(args.fixtures))]
+    else:
+        images = [Image.fromarray(warmup_frame(w, h)) for w, h in [(1920, 1080), (1280, 800)]]
+    if not images:
+        parser.error(f'no image matches {args.fixtures}')
+    modes = ['fp32'] + [mode for mode in args.modes.split(',') if mode and mode != 'fp32']
+
+    # every mode captions the same crops, the icons found by the fp32 detector
+    reference_model = get_yolo_model(args.som_model_path)
+    crops = []
+    for image in images:
+        xyxy, _ = detect_icons(reference_model, image, BOX_TRESHOLD=args.box_threshold)
+        crops.append(extract_icon_crops(np.asarray(image), xyxy.cpu()))
+    del reference_model
+
+    reference = None
+    print(f'{len(images)} frames, {sum(len(c) for c in crops)} icon crops')
+    for mode in modes:
+        detections, captions, stats = run_mode_isolated(mode, args, images, crops)
+        if reference is None:
+            reference = (detections, captions)
+        pairs = [(a, b) for ref, cur in zip(reference[1], captions) for a, b in zip(ref, cur)]
+        stats['caption_exact_match'] = sum(a == b for a, b in pairs) / len(pairs) if pairs else 1.0
+        stats['caption_token_overlap'] = statistics.mean(token_overlap(a, b) for a, b in pairs) if pairs else 1.0
+        stats['box_recall'] = compare(reference[0], detections, args.match_iou)['recall']
+        print(f"{mode:>5}: caption {stats['caption_precision']}, detector {stats['detector_precision']} | "
+              f"caption exact {stats['caption_exact_match']:.3f} overlap {stats['caption_token_overlap']:.3f} | "
+              f"box recall {stats['box_recall']:.3f} | detect {stats['detect_ms']:.1f} ms caption {stats['caption_ms']:.1f} ms | "
+              f"rss {stats['rss_mb']:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
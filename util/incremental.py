@@ -0,0 +1,139 @@
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+Region = Tuple[int, int, int, int]  # pixel xyxy
+
+
+def _merge_regions(regions: List[Region]) -> List[Region]:
+    """Merge overlapping rectangles until none of them overlap."""
+    regions = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for r in regions:
+            for i, o in enumerate(out):
+                if r[0] < o[2] and o[0] < r[2] and r[1] < o[3] and o[1] < r[3]:
+                    out[i] = (min(r[0], o[0]), min(r[1], o[1]), max(r[2], o[2]), max(r[3], o[3]))
+                    merged = True
+                    break
+            else:
+                out.append(r)
+        regions = out
+    return regions
+
+
+def _grow_regions(regions: List[Region], boxes: List[Region]) -> List[Region]:
+    """Grow every region to cover the boxes it intersects and merge overlapping regions, until nothing changes."""
+    while True:
+        grown = []
+        for r in regions:
+            x0, y0, x1, y1 = r
+            for b in boxes:
+                if b[0] < r[2] and r[0] < b[2] and b[1] < r[3] and r[1] < b[3]:
+                    x0, y0, x1, y1 = min(x0, b[0]), min(y0, b[1]), max(x1, b[2]), max(y1, b[3])
+            grown.append((x0, y0, x1, y1))
+        grown = _merge_regions(grown)
+        if sorted(grown) == sorted(regions):
+            return grown
+        regions = grown
+
+
+def _intersects(bbox, regions_ratio) -> bool:
+    x0, y0, x1, y1 = bbox
+    return any(x0 < r[2] and r[0] < x1 and y0 < r[3] and r[1] < y1 for r in regions_ratio)
+
+
+class IncrementalParseSession:
+    """
+    Per-session state for incremental parsing.
+
+    Keeps the previous frame and its parsed elements. A new frame is compared with the
+    previous one tile by tile; only the dirty tiles (grown by `margin` pixels, then grown
+    to cover the previous elements they cut through and merged into rectangles) need to be
+    parsed again, and the previous elements that lie fully outside of them are carried over.
+
+    Attributes:
+        tile_size (int): side of the square tiles in pixels
+        margin (int): pixels added around every dirty region, so elements cut by a tile
+            border are re-detected whole
+        diff_threshold (int): per-channel pixel difference above which a pixel counts as changed
+        max_dirty_ratio (float): above this fraction of reprocessed area a full parse is done instead
+        lock (threading.Lock): held from dirty_regions to update, the frames of a session are diffed one at a time
+    """
+
+    def __init__(self, tile_size: int = 64, margin: int = 32, diff_threshold: int = 12, max_dirty_ratio: float = 0.5):
+        self.tile_size = tile_size
+        self.margin = margin
+        self.diff_threshold = diff_threshold
+        self.max_dirty_ratio = max_dirty_ratio
+        self.prev_frame = None
+        self.prev_elements = None
+        self.lock = threading.Lock()
+
+    def dirty_regions(self, frame: np.ndarray) -> Optional[List[Region]]:
+        """Regions of `frame` to parse again, or None when the whole frame has to be parsed."""
+        if self.prev_frame is None or self.prev_frame.shape != frame.shape:
+            return None
+        h, w = frame.shape[:2]
+        t = self.tile_size
+        changed = (cv2.absdiff(frame, self.prev_frame).max(axis=2) > self.diff_threshold).astype(np.uint8)
+        pad_h, pad_w = -h % t, -w % t
+        changed = np.pad(changed, ((0, pad_h), (0, pad_w)))
+        tiles = changed.reshape(changed.shape[0] // t, t, changed.shape[1] // t, t).max(axis=(1, 3))
+
+        num, _, stats, _ = cv2.connectedComponentsWithStats(tiles, connectivity=8)
+        regions = []
+        for x, y, tw, th, _ in stats[1:num].tolist():
+            regions.append((
+                max(0, x * t - self.margin), max(0, y * t - self.margin),
+                min(w, (x + tw) * t + self.margin), min(h, (y + th) * t + self.margin),
+            ))
+        # previous elements touching a region are dropped, so the region has to contain them whole for the
+        # re-parse to find them again instead of a truncated text line or icon
+        boxes = [
+            (max(0, int(np.floor(x0 * w))), max(0, int(np.floor(y0 * h))), min(w, int(np.ceil(x1 * w))), min(h, int(np.ceil(y1 * h))))
+            for x0, y0, x1, y1 in (elem['bbox'] for elem in self.prev_elements or [])
+        ]
+        regions = _grow_regions(_merge_regions(regions), boxes)
+        if self.reprocessed_ratio(regions, w, h) > self.max_dirty_ratio:
+            return None
+        return regions
+
+    @staticmethod
+    def reprocessed_ratio(regions: Optional[List[Region]], w: int, h: int) -> float:
+        if regions is None:
+            return 1.0
+        return sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) / float(w * h)
+
+    def carry_over(self, regions: List[Region], w: int, h: int) -> list:
+        """Previous elements lying fully outside the dirty regions."""
+        regions_ratio = [(x0 / w, y0 / h, x1 / w, y1 / h) for x0, y0, x1, y1 in regions]
+        return [dict(elem) for elem in self.prev_elements if not _intersects(elem['bbox'], regions_ratio)]
+
+    def update(self, frame: np.ndarray, elements: list) -> None:
+        self.prev_frame = frame
+        self.prev_elements = [dict(elem) for elem in elements]
+
+
+def region_elements_to_frame(elements: list, region: Region, w: int, h: int) -> list:
+    """Map elements parsed on a region crop (bbox normalized to the crop) back to frame-normalized bboxes."""
+    x0, y0, x1, y1 = region
+    rw, rh = x1 - x0, y1 - y0
+    out = []
+    for elem in elements:
+        bx0, by0, bx1, by1 = elem['bbox']
+        out.append({**elem, 'bbox': [(x0 + bx0 * rw) / w, (y0 + by0 * rh) / h, (x0 + bx1 * rw) / w, (y0 + by1 * rh) / h]})
+    return out
+
+
+_SOURCE_ORDER = {'box_ocr_content_ocr': 0, 'box_yolo_content_ocr': 1, 'box_yolo_content_yolo': 2}
+
+
+def order_elements(elements: list) -> list:
+    """Same ordering as a full parse: ocr text, icons labelled by ocr, captioned icons."""
+    return sorted(elements, key=lambda elem: _SOURCE_ORDER.get(elem.get('source'), 2))
@@ -0,0 +1,198 @@
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (10, 25, 50, 100, 200, 400, 800, 1600)
+RATIO_BUCKETS = (0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0)
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> Tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.type = 'counter'
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: Optional[Dict[str, str]] = None) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _format_labels(key), value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return {_format_labels(key) or 'total': value for key, value in self._values.items()}
+
+    def drain(self) -> Dict[Tuple, float]:
+        """Values counted since the last drain, the counter starts again from zero"""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: Dict[Tuple, float]) -> None:
+        """Add the drained values of the same counter in another process"""
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.type = 'gauge'
+
+    def set(self, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount: float = 1, labels: Optional[Dict[str, str]] = None) -> None:
+        self.inc(-amount, labels)
+
+
+class Histogram:
+    """Cumulative bucket histogram, rendered in the Prometheus text format."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = 'histogram'
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series['counts']):
+                    out.append((self.name + '_bucket' + _format_labels(key, (('le', repr(float(bound))),)), count))
+                out.append((self.name + '_bucket' + _format_labels(key, (('le', '+Inf'),)), series['count']))
+                out.append((self.name + '_sum' + _format_labels(key), series['sum']))
+                out.append((self.name + '_count' + _format_labels(key), series['count']))
+        return out
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                _format_labels(key) or 'total': {'count': series['count'], 'sum': series['sum'], 'mean': series['sum'] / series['count'] if series['count'] else 0.0}
+                for key, series in self._series.items()
+            }
+
+    def drain(self) -> Dict[Tuple, Dict]:
+        """Series observed since the last drain, the histogram starts again empty"""
+        with self._lock:
+            series, self._series = self._series, {}
+        return series
+
+    def merge(self, series: Dict[Tuple, Dict]) -> None:
+        """Add the drained series of the same histogram in another process"""
+        with self._lock:
+            for key, other in series.items():
+                own = self._series.get(key)
+                if own is None:
+                    own = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                own['counts'] = [a + b for a, b in zip(own['counts'], other['counts'])]
+                own['sum'] += other['sum']
+                own['count'] += other['count']
+
+
+class MetricsRegistry:
+    """A set of named metrics, rendered together for the /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name: str, help: str = '') -> Gauge:
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = '', buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict:
+        """All metrics as a JSON friendly dict."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+# process wide registry, the parser stages record into it and the server exposes it
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram('omniparser_stage_seconds', 'Wall time of a parse stage (decode, ocr, yolo, merge, caption, annotate, encode)')
+CAPTION_BATCH_SECONDS = REGISTRY.histogram('omniparser_caption_batch_seconds', 'Wall time of one caption model batch')
+CROPS_CAPTIONED = REGISTRY.counter('omniparser_crops_captioned_total', 'Icon crops run through the caption model')
+BOXES_PER_FRAME = REGISTRY.histogram('omniparser_boxes_per_frame', 'Parsed elements per frame', buckets=COUNT_BUCKETS)
+BOXES_TOTAL = REGISTRY.counter('omniparser_boxes_total', 'Parsed elements over all frames')
+REPROCESSED_RATIO = REGISTRY.histogram('omniparser_incremental_reprocessed_ratio', 'Fraction of an incrementally parsed frame that was parsed again', buckets=RATIO_BUCKETS)
+
+# recorded inside the caption call, that is in the replica processes when the server runs with --replicas;
+# a replica drains them after every job and the dispatcher merges them into its own registry
+REPLICA_METRICS = (CAPTION_BATCH_SECONDS, CROPS_CAPTIONED)
+
+
+def drain_replica_metrics() -> Dict[str, Dict]:
+    return {metric.name: metric.drain() for metric in REPLICA_METRICS}
+
+
+def merge_replica_metrics(drained: Dict[str, Dict]) -> None:
+    for metric in REPLICA_METRICS:
+        metric.merge(drained.get(metric.name, {}))
+
+
+def observe_stages(timings: Dict[str, float], parsed_content_lists: Sequence[list] = ()) -> None:
+    """Record the stage timings of a parse request and the element count of every parsed frame."""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, {'stage': stage})
+    for parsed_content_list in parsed_content_lists:
+        BOXES_PER_FRAME.observe(len(parsed_content_list))
+        BOXES_TOTAL.inc(len(parsed_content_list))
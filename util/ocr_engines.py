@@ -0,0 +1,114 @@
+import gc
+import threading
+from typing import Callable, Dict, NamedTuple
+
+import numpy as np
+
+
+class OCRBackend(NamedTuple):
+    """
+    An OCR backend known to the registry.
+
+    Attributes:
+        create (Callable[[], object]): builds the engine, called on first use
+        read (Callable): read(engine, image_np, easyocr_args) -> (coord, text), where coord
+            is a list of 4-point polygons and text the matching list of strings
+    """
+    create: Callable[[], object]
+    read: Callable[[object, np.ndarray, Dict], tuple]
+
+
+_backends: Dict[str, OCRBackend] = {}
+_engines: Dict[str, object] = {}
+_engines_lock = threading.Lock()
+
+
+def register_ocr_engine(name: str, create: Callable[[], object], read: Callable) -> None:
+    """Register an OCR backend under `name`. The engine itself is only built by get_ocr_engine."""
+    _backends[name] = OCRBackend(create=create, read=read)
+
+
+def available_ocr_engines():
+    return list(_backends)
+
+
+def loaded_ocr_engines():
+    return list(_engines)
+
+
+def get_ocr_engine(name: str):
+    """Return the engine registered under `name`, creating it on first use and caching it per process."""
+    if name not in _backends:
+        raise ValueError(f"Unknown OCR engine {name!r}, available: {available_ocr_engines()}")
+    engine = _engines.get(name)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = _engines[name] = _backends[name].create()
+    return engine
+
+
+def unload_ocr_engine(name: str) -> bool:
+    """Drop the cached engine so its memory can be reclaimed. Returns False if it was not loaded."""
+    with _engines_lock:
+        engine = _engines.pop(name, None)
+    if engine is None:
+        return False
+    del engine
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+    return True
+
+
+def run_ocr(name: str, image_np: np.ndarray, easyocr_args: Dict = None):
+    """Run the `name` engine on an RGB image, returns (coord, text)."""
+    engine = get_ocr_engine(name)
+    return _backends[name].read(engine, image_np, easyocr_args)
+
+
+def _create_easyocr():
+    import easyocr
+    return easyocr.Reader(['en'])
+
+
+def _read_easyocr(reader, image_np, easyocr_args=None):
+    if easyocr_args is None:
+        easyocr_args = {}
+    result = reader.readtext(image_np, **easyocr_args)
+    coord = [item[0] for item in result]
+    text = [item[1] for item in result]
+    return coord, text
+
+
+def _create_paddleocr():
+    from paddleocr import PaddleOCR
+    return PaddleOCR(
+        lang='en',  # other lang also available
+        use_angle_cls=False,
+        use_gpu=False,  # using cuda will conflict with pytorch in the same process
+        show_log=False,
+        max_batch_size=1024,
+        use_dilation=True,  # improves accuracy
+        det_db_score_mode='slow',  # improves accuracy
+        rec_batch_num=1024)
+
+
+def _read_paddleocr(paddle_ocr, image_np, easyocr_args=None):
+    if easyocr_args is None:
+        text_threshold = 0.5
+    else:
+        text_threshold = easyocr_args['text_threshold']
+    result = paddle_ocr.ocr(image_np, cls=False)[0]
+    coord = [item[0] for item in result if item[1][1] > text_threshold]
+    text = [item[1][0] for item in result if item[1][1] > text_threshold]
+    return coord, text
+
+
+register_ocr_engine('easyocr', _create_easyocr, _read_easyocr)
+register_ocr_engine('paddleocr', _create_paddleocr, _read_paddleocr)
@@ -1,32 +1,392 @@
-from util.utils import get_som_labeled_img, get_caption_model_processor, get_yolo_model, check_ocr_box
+from util.utils import get_caption_model_processor, get_yolo_model, check_ocr_box, detect_icons, merge_ocr_and_icons, caption_icons, annotate_som, encode_som, iter_parsed_content_icon, detect_icons_batch, extract_icon_crops, iter_caption_crops_cached, non_ocr_boxes
+from util.ocr_engines import unload_ocr_engine
+from util.cache import LRUCache, ParseCache, frame_digest
+from util.caption_batcher import CaptionBatcher
+from util.incremental import IncrementalParseSession, region_elements_to_frame, order_elements
 import torch
 from PIL import Image
 import io
 import base64
-from typing import Dict
+import os
+import time
+import threading
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Union
+
+
+def decode_image(image: Union[str, bytes, np.ndarray]):
+    """
+    Decode a base64 string or raw PNG/JPEG bytes into an RGB PIL image and its ndarray.
+    Raw bytes are decoded by OpenCV straight from the request buffer, without a base64 pass.
+    An already decoded RGB ndarray is passed through.
+    """
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image), image
+    if isinstance(image, str):
+        image = base64.b64decode(image)
+    image_np = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image_np is None:
+        # formats OpenCV can't read (e.g. GIF) go through PIL
+        image_np = np.asarray(Image.open(io.BytesIO(image)).convert('RGB'))
+    else:
+        image_np = cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(image_np), image_np
+
+
+def warmup_frame(w: int, h: int) -> np.ndarray:
+    """Synthetic desktop-like RGB frame with a title bar, text lines and icon-sized buttons, for warmup parses"""
+    frame = np.full((h, w, 3), 236, dtype=np.uint8)
+    cv2.rectangle(frame, (0, 0), (w, max(24, h // 30)), (45, 45, 60), -1)
+    cv2.putText(frame, 'File  Edit  View  Help', (10, max(18, h // 40)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
+    for i, line in enumerate(['Documents', 'Settings', 'Search the web', 'Recycle Bin']):
+        cv2.putText(frame, line, (w // 10, h // 6 + i * h // 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 20, 20), 2, cv2.LINE_AA)
+    for i in range(8):
+        x = w // 2 + i * max(40, w // 24)
+        cv2.rectangle(frame, (x, h - 60), (x + 32, h - 28), (30 + 25 * i, 120, 220 - 20 * i), -1)
+        cv2.circle(frame, (x + 16, h - 44), 8, (250, 250, 250), -1)
+    return frame
+
+
+@contextmanager
+def stage_timer(timings: Dict, name: str):
+    """Add the wall time of the block to timings[name], in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
 class Omniparser(object):
     def __init__(self, config: Dict):
         self.config = config
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-        self.som_model = get_yolo_model(model_path=config['som_model_path'])
-        self.caption_model_processor = get_caption_model_processor(model_name=config['caption_model_name'], model_name_or_path=config['caption_model_path'], device=device)
+        self.detector_precision = config.get('detector_precision', 'fp32')
+        self.som_model = get_yolo_model(model_path=config['som_model_path'], backend=config.get('detector_backend', 'torch'), precision=config.get('detector_precision', 'fp32'),
+                                        calibration_data=config.get('detector_calibration_data'))
+        self.caption_model_processor = get_caption_model_processor(model_name=config['caption_model_name'], model_name_or_path=config['caption_model_path'], device=device, precision=config.get('caption_precision', 'auto'))
+        # 20 tokens by default, lower for short captions
+        self.caption_max_new_tokens = config.get('caption_max_new_tokens', 20)
+        # the OCR engine itself is created lazily on the first parse
+        self.ocr_engine = config.get('ocr_engine', 'easyocr')
+        # icon captions keyed by crop digest, the same toolbar/taskbar icons show up on every frame
+        self.caption_cache = None
+        if config.get('caption_cache_size', 4096) > 0:
+            self.caption_cache = LRUCache(max_size=config.get('caption_cache_size', 4096), ttl=config.get('caption_cache_ttl') or None)
+        # whole parse results keyed by the decoded pixels, for repeated frames (static desktop, wait steps, retries)
+        self.parse_cache = None
+        if config.get('parse_cache_size', 64) > 0:
+            self.parse_cache = ParseCache(max_size=config.get('parse_cache_size', 64), ttl=config.get('parse_cache_ttl') or None,
+                                          disk_dir=config.get('parse_cache_dir'), disk_max_entries=config.get('parse_cache_disk_entries', 1024))
+        # torch threads of one parse: the cores shared by the parses running at the same time. OCR and
+        # detection run in parallel and get half of them each; captioning, which only overlaps with the
+        # cheap cv2 annotate, gets all of them
+        self.caption_threads = config.get('intra_op_threads') or max(1, (os.cpu_count() or 1) // max(1, config.get('workers', 1)))
+        self.detect_threads = max(1, self.caption_threads // 2)
+        torch.set_num_threads(self.caption_threads)
+        cv2.setNumThreads(self.detect_threads)
+        # icon crops of concurrent requests are captioned together when batching is enabled
+        self.caption_batcher = None
+        if config.get('caption_batch_wait_ms', 0) > 0:
+            # the batcher captions for all workers at once, one batch at a time
+            self.caption_batcher = CaptionBatcher(self.caption_model_processor, max_batch_size=config.get('caption_batch_size', 128), max_wait_ms=config['caption_batch_wait_ms'],
+                                                  intra_op_threads=self.caption_threads * max(1, config.get('workers', 1)))
+        # incremental parse state per session id, idle sessions expire
+        self.sessions = LRUCache(max_size=config.get('max_sessions', 64), ttl=config.get('session_ttl', 600))
+        self._sessions_lock = threading.Lock()
+        self.stage_pool = ThreadPoolExecutor(max_workers=2 * config.get('workers', 1), thread_name_prefix='omniparser-stage')
+        # the detector and OCR engines are not thread safe; with several parses in flight each stage
+        # is serialized, but different requests can still be in different stages at the same time
+        self._ocr_lock = threading.Lock()
+        self._detector_lock = threading.Lock()
         print('Omniparser initialized!!!')
 
-    def parse(self, image_base64: str):
-        image_bytes = base64.b64decode(image_base64)
-        image = Image.open(io.BytesIO(image_bytes))
-        print('image size:', image.size)
-        
+    def unload_ocr(self):
+        """Free the OCR engine, it is rebuilt on the next parse."""
+        return unload_ocr_engine(self.ocr_engine)
+
+    def warmup(self, resolutions=((1920, 1080),), runs: int = 2):
+        """
+        Run synthetic frames of each (w, h) resolution through the full pipeline so the detector graph,
+        OCR engine and caption generation are initialised before real traffic. Returns the cold and
+        warm latency and the stage timings of the last run, per resolution.
+        """
+        results = []
+        for w, h in resolutions:
+            latencies, timings = [], {}
+            for _ in range(runs):
+                timings = {}
+                start = time.perf_counter()
+                with stage_timer(timings, 'decode'):
+                    image, image_np = decode_image(warmup_frame(w, h))
+                # live requests are served while warming up, the synthetic icons stay out of their caption cache
+                self._parse_decoded(image, image_np, timings, use_caption_cache=False)
+                latencies.append(time.perf_counter() - start)
+            results.append({'resolution': f'{w}x{h}', 'cold_latency': latencies[0], 'warm_latency': latencies[-1], 'timings': timings})
+        # make sure generation ran even if no icon was detected on the synthetic frames
+        self._use_threads(self.caption_threads)
+        for _ in iter_caption_crops_cached(torch.zeros((2, 3, 64, 64)), self.caption_model_processor, max_new_tokens=self.caption_max_new_tokens, caption_batcher=self.caption_batcher):
+            pass
+        return results
+
+    def stats(self):
+        return {
+            'parse_cache': self.parse_cache.stats() if self.parse_cache is not None else None,
+            'caption_cache': self.caption_cache.stats() if self.caption_cache is not None else None,
+            'caption_batcher': self.caption_batcher.stats() if self.caption_batcher is not None else None,
+        }
+
+    def flush_cache(self, cache: str = 'all') -> List[str]:
+        """Drop the cached parse results ('parse'), icon captions ('caption') or both ('all')"""
+        flushed = []
+        if cache in ('all', 'parse') and self.parse_cache is not None:
+            self.parse_cache.clear()
+            flushed.append('parse')
+        if cache in ('all', 'caption') and self.caption_cache is not None:
+            self.caption_cache.clear()
+            flushed.append('caption')
+        return flushed
+
+    def _draw_bbox_config(self, image: Image.Image):
         box_overlay_ratio = max(image.size) / 3200
-        draw_bbox_config = {
+        return {
             'text_scale': 0.8 * box_overlay_ratio,
             'text_thickness': max(int(2 * box_overlay_ratio), 1),
             'text_padding': max(int(3 * box_overlay_ratio), 1),
             'thickness': max(int(3 * box_overlay_ratio), 1),
         }
 
-        (text, ocr_bbox), _ = check_ocr_box(image, display_img=False, output_bb_format='xyxy', easyocr_args={'text_threshold': 0.8}, use_paddleocr=False)
-        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image, self.som_model, BOX_TRESHOLD = self.config['BOX_TRESHOLD'], output_coord_in_ratio=True, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=self.caption_model_processor, ocr_text=text,use_local_semantics=True, iou_threshold=0.7, scale_img=False, batch_size=128)
+    @staticmethod
+    def _use_threads(threads: int):
+        """Torch intra-op threads of the calling thread. With OpenMP (the default CPU build) the setting is
+        per thread, so stages running in parallel on other threads keep theirs"""
+        if torch.get_num_threads() != threads:
+            torch.set_num_threads(threads)
+
+    def _run_ocr(self, image: Image.Image, timings: Dict):
+        self._use_threads(self.detect_threads)
+        with self._ocr_lock, stage_timer(timings, 'ocr'):
+            (text, ocr_bbox), _ = check_ocr_box(image, display_img=False, output_bb_format='xyxy', easyocr_args={'text_threshold': 0.8}, ocr_engine=self.ocr_engine)
+        return text, ocr_bbox
+
+    def _run_detection(self, image: Image.Image, timings: Dict):
+        self._use_threads(self.detect_threads)
+        with self._detector_lock, stage_timer(timings, 'yolo'):
+            xyxy, _ = detect_icons(self.som_model, image, BOX_TRESHOLD=self.config['BOX_TRESHOLD'], scale_img=False, precision=self.detector_precision)
+        return xyxy
+
+    def _detect_and_merge(self, image: Image.Image, timings: Dict):
+        """OCR and icon detection run concurrently, then the overlap merge"""
+        w, h = image.size
+        ocr_future = self.stage_pool.submit(self._run_ocr, image, timings)
+        xyxy = self._run_detection(image, timings)
+        text, ocr_bbox = ocr_future.result()
+        with stage_timer(timings, 'merge'):
+            parsed_content_list, starting_idx, ocr_bbox = merge_ocr_and_icons(xyxy, ocr_bbox, text, w, h, iou_threshold=0.7)
+        return parsed_content_list, starting_idx, ocr_bbox, text
+
+    def _caption(self, image_np: np.ndarray, parsed_content_list, starting_idx, ocr_bbox, text, timings: Dict, use_caption_cache: bool = True):
+        self._use_threads(self.caption_threads)
+        caption_cache = self.caption_cache if use_caption_cache else None
+        with stage_timer(timings, 'caption'):
+            caption_icons(parsed_content_list, starting_idx, image_np, self.caption_model_processor, ocr_bbox=ocr_bbox, ocr_text=text, use_local_semantics=True, batch_size=128, caption_cache=caption_cache, max_new_tokens=self.caption_max_new_tokens, caption_batcher=self.caption_batcher)
+
+    def _render(self, image_np: np.ndarray, parsed_content_list, draw_bbox_config, timings: Dict, som_options: Dict = None):
+        with stage_timer(timings, 'annotate'):
+            annotated_frame, label_coordinates = annotate_som(image_np, parsed_content_list, draw_bbox_config=draw_bbox_config, output_coord_in_ratio=True)
+        with stage_timer(timings, 'encode'):
+            dino_labled_img = encode_som(annotated_frame, **(som_options or {}))
+        return dino_labled_img
+
+    def _submit_render(self, image: Image.Image, image_np: np.ndarray, parsed_content_list, timings: Dict, with_som: bool, som_options: Dict = None):
+        """Draw the SOM image on the stage pool, None when it is not wanted"""
+        if not with_som:
+            return None
+        return self.stage_pool.submit(self._render, image_np, parsed_content_list, self._draw_bbox_config(image), timings, som_options)
+
+    def _parse_elements(self, image: Image.Image, timings: Dict = None):
+        """OCR, icon detection, overlap merge and captioning, bboxes normalized to `image`"""
+        timings = {} if timings is None else timings
+        image = image.convert('RGB')
+        parsed_content_list, starting_idx, ocr_bbox, text = self._detect_and_merge(image, timings)
+        self._caption(np.asarray(image), parsed_content_list, starting_idx, ocr_bbox, text, timings)
+        return parsed_content_list
+
+    def parse(self, image: Union[str, bytes], timings: Dict = None, with_som: bool = True, som_options: Dict = None):
+        """
+        Parse a screenshot as the stage graph (OCR || YOLO) -> merge -> (caption || annotate).
+        `image` is a base64 string or the raw PNG/JPEG bytes.
+        If `timings` is given it is filled with the wall time of every stage, in seconds.
+        with_som=False skips the annotated image (returned as None), som_options are passed to
+        encode_som: image_format ('PNG', 'JPEG', 'WEBP'), quality and max_side.
+        """
+        timings = {} if timings is None else timings
+        with stage_timer(timings, 'decode'):
+            image, image_np = decode_image(image)
+        return self._parse_decoded(image, image_np, timings, with_som, som_options)
+
+    def _parse_decoded(self, image: Image.Image, image_np: np.ndarray, timings: Dict, with_som: bool = True, som_options: Dict = None, use_caption_cache: bool = True):
+        print('image size:', image.size)
+        parsed_content_list, starting_idx, ocr_bbox, text = self._detect_and_merge(image, timings)
+        # the SOM image only shows box ids, so it can be drawn while the icons are captioned
+        render_future = self._submit_render(image, image_np, parsed_content_list, timings, with_som, som_options)
+        self._caption(image_np, parsed_content_list, starting_idx, ocr_bbox, text, timings, use_caption_cache)
+        dino_labled_img = render_future.result() if render_future is not None else None
+
+        return dino_labled_img, parsed_content_list
+
+    def _parse_cache_key(self, image_np: np.ndarray, with_som: bool, som_options: Dict = None):
+        # everything the result depends on, the disk tier outlives restarts with another model setup
+        detector = (self.config['som_model_path'], self.config.get('detector_backend', 'torch'), self.detector_precision,
+                    self.config.get('detector_calibration_data') if self.detector_precision == 'int8' else None)
+        captioner = (self.config['caption_model_name'], self.config['caption_model_path'], self.caption_model_processor['precision'], self.caption_max_new_tokens)
+        params = (self.config['BOX_TRESHOLD'], detector, captioner, self.ocr_engine, with_som, sorted((som_options or {}).items()))
+        return frame_digest(image_np, params)
+
+    def parse_cached(self, image: Union[str, bytes], timings: Dict = None, with_som: bool = True, som_options: Dict = None):
+        """
+        parse() through the parse result cache, keyed by the decoded pixels and the parse parameters.
+        Returns (som_image_base64, parsed_content_list, cache_hit).
+        """
+        timings = {} if timings is None else timings
+        if self.parse_cache is None:
+            return (*self.parse(image, timings, with_som=with_som, som_options=som_options), False)
+        with stage_timer(timings, 'decode'):
+            image, image_np = decode_image(image)
+        with stage_timer(timings, 'cache_lookup'):
+            key = self._parse_cache_key(image_np, with_som, som_options)
+            cached = self.parse_cache.get(key)
+        if cached is not None:
+            dino_labled_img, parsed_content_list = cached
+            return dino_labled_img, [dict(elem) for elem in parsed_content_list], True
+        dino_labled_img, parsed_content_list = self._parse_decoded(image, image_np, timings, with_som, som_options)
+        self.parse_cache.put(key, (dino_labled_img, [dict(elem) for elem in parsed_content_list]))
+        return dino_labled_img, parsed_content_list, False
+
+    def parse_batch(self, images: List[Union[str, bytes]], timings: Dict = None, with_som: bool = True, som_options: Dict = None):
+        """
+        Parse several screenshots at once: one batched detector call across all frames, OCR of
+        the frames running alongside it, and the icon crops of every frame pooled into shared
+        caption batches. Returns a list of (som_image_base64, parsed_content_list), one per frame.
+        """
+        timings = {} if timings is None else timings
+        with stage_timer(timings, 'decode'):
+            decoded = [decode_image(image) for image in images]
+            images = [image for image, _ in decoded]
+            images_np = [image_np for _, image_np in decoded]
+
+        ocr_futures = [self.stage_pool.submit(self._run_ocr, image, timings) for image in images]
+        self._use_threads(self.detect_threads)
+        with self._detector_lock, stage_timer(timings, 'yolo'):
+            detections = detect_icons_batch(self.som_model, images, BOX_TRESHOLD=self.config['BOX_TRESHOLD'], precision=self.detector_precision)
+
+        frames = []
+        for image, ocr_future, (xyxy, _) in zip(images, ocr_futures, detections):
+            text, ocr_bbox = ocr_future.result()
+            w, h = image.size
+            with stage_timer(timings, 'merge'):
+                frames.append(merge_ocr_and_icons(xyxy, ocr_bbox, text, w, h, iou_threshold=0.7))
+
+        render_futures = [
+            self._submit_render(image, image_np, parsed_content_list, timings, with_som, som_options)
+            for image, image_np, (parsed_content_list, _, _) in zip(images, images_np, frames)
+        ]
+
+        self._use_threads(self.caption_threads)
+        with stage_timer(timings, 'caption'):
+            # pool the uncaptioned icons of all frames, remembering where each crop goes back to
+            crops, owners = [], []
+            for frame_idx, (image_np, (parsed_content_list, starting_idx, _)) in enumerate(zip(images_np, frames)):
+                if starting_idx < 0:
+                    continue
+                boxes = non_ocr_boxes(torch.tensor([box['bbox'] for box in parsed_content_list]), starting_idx)
+                crops.append(extract_icon_crops(image_np, boxes))
+                owners.extend((frame_idx, starting_idx + pos) for pos in range(len(boxes)))
+            if crops:
+                for update in iter_caption_crops_cached(torch.cat(crops), self.caption_model_processor, batch_size=128, caption_cache=self.caption_cache, max_new_tokens=self.caption_max_new_tokens, caption_batcher=self.caption_batcher):
+                    for i, caption in update.items():
+                        frame_idx, elem_idx = owners[i]
+                        frames[frame_idx][0][elem_idx]['content'] = caption
+
+        return [(render_future.result() if render_future is not None else None, parsed_content_list) for render_future, (parsed_content_list, _, _) in zip(render_futures, frames)]
+
+    def parse_stream(self, image: Union[str, bytes]):
+        """
+        Same pipeline as parse, but yields events as results become available:
+          {'event': 'ocr', 'elements': [...]}       text boxes and icons labelled by OCR
+          {'event': 'icons', 'elements': [...]}     icon boxes still waiting for a caption ('content': None)
+          {'event': 'captions', 'updates': [...]}   {'idx', 'content'} per captioned icon, one event per batch
+          {'event': 'som', 'som_image_base64': str}
+          {'event': 'done', 'latency': float, 'timings': {...}}
+        Every element carries its 'idx' in the final parsed_content_list.
+        """
+        start = time.perf_counter()
+        timings = {}
+        with stage_timer(timings, 'decode'):
+            image, image_np = decode_image(image)
+
+        parsed_content_list, starting_idx, ocr_bbox, text = self._detect_and_merge(image, timings)
+        render_future = self.stage_pool.submit(self._render, image_np, parsed_content_list, self._draw_bbox_config(image), timings)
+        n_labelled = starting_idx if starting_idx >= 0 else len(parsed_content_list)
+        yield {'event': 'ocr', 'elements': [dict(elem, idx=i) for i, elem in enumerate(parsed_content_list[:n_labelled])]}
+        yield {'event': 'icons', 'elements': [dict(elem, idx=i) for i, elem in enumerate(parsed_content_list[n_labelled:], n_labelled)]}
+
+        if starting_idx >= 0:
+            self._use_threads(self.caption_threads)
+            filtered_boxes = torch.tensor([box['bbox'] for box in parsed_content_list])
+            captions = iter_parsed_content_icon(filtered_boxes, starting_idx, image_np, self.caption_model_processor, batch_size=128, caption_cache=self.caption_cache, max_new_tokens=self.caption_max_new_tokens, caption_batcher=self.caption_batcher)
+            while True:
+                with stage_timer(timings, 'caption'):
+                    update = next(captions, None)
+                if update is None:
+                    break
+                updates = []
+                for pos, caption in update.items():
+                    parsed_content_list[starting_idx + pos]['content'] = caption
+                    updates.append({'idx': starting_idx + pos, 'content': caption})
+                yield {'event': 'captions', 'updates': updates}
+
+        yield {'event': 'som', 'som_image_base64': render_future.result()}
+        yield {'event': 'done', 'latency': time.perf_counter() - start, 'timings': timings}
+
+    def parse_incremental(self, image: Union[str, bytes], session_id: str, timings: Dict = None, with_som: bool = True, som_options: Dict = None):
+        """
+        Parse a frame of an ongoing session, only re-running OCR, detection and captioning on the
+        tiles that changed since the session's previous frame. Returns the SOM image, the element
+        list and the fraction of the frame that was reprocessed.
+        """
+        timings = {} if timings is None else timings
+        with stage_timer(timings, 'decode'):
+            image, frame = decode_image(image)
+        h, w = frame.shape[:2]
+
+        with self._sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = IncrementalParseSession(
+                    tile_size=self.config.get('incremental_tile_size', 64),
+                    margin=self.config.get('incremental_margin', 32),
+                )
+                self.sessions.put(session_id, session)
+
+        # concurrent frames of one session would diff against the same previous frame and overwrite
+        # each other's elements, they are parsed one after the other
+        with session.lock:
+            regions = session.dirty_regions(frame)
+            if regions is None:
+                parsed_content_list = self._parse_elements(image, timings)
+            else:
+                parsed_content_list = session.carry_over(regions, w, h)
+                for region in regions:
+                    region_elements = self._parse_elements(image.crop(region), timings)
+                    parsed_content_list.extend(region_elements_to_frame(region_elements, region, w, h))
+                parsed_content_list = order_elements(parsed_content_list)
+            session.update(frame, parsed_content_list)
+        reprocessed_ratio = session.reprocessed_ratio(regions, w, h)
 
-        return dino_labled_img, parsed_content_list
\ No newline at end of file
+        dino_labled_img = self._render(frame, parsed_content_list, self._draw_bbox_config(image), timings, som_options) if with_som else None
+        return dino_labled_img, parsed_content_list, reprocessed_ratio
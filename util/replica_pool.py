@@ -0,0 +1,319 @@
+import inspect
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from util.omniparser import decode_image, stage_timer
+from util.metrics import drain_replica_metrics, merge_replica_metrics
+
+
+# strings above this size (SOM images) come back through shared memory instead of the result pipe
+_SHARED_TEXT_MIN_SIZE = 64 * 1024
+
+
+class _SharedArray:
+    def __init__(self, name: str, shape, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+class _SharedText:
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+def _share(obj, blocks: List[shared_memory.SharedMemory]):
+    """Replace ndarrays and large strings in obj by handles to shared memory blocks they are copied into"""
+    if isinstance(obj, np.ndarray):
+        block = shared_memory.SharedMemory(create=True, size=max(1, obj.nbytes))
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=block.buf)[...] = obj
+        blocks.append(block)
+        return _SharedArray(block.name, obj.shape, obj.dtype.str)
+    if isinstance(obj, str) and len(obj) >= _SHARED_TEXT_MIN_SIZE:
+        data = obj.encode('utf-8')
+        block = shared_memory.SharedMemory(create=True, size=len(data))
+        block.buf[:len(data)] = data
+        blocks.append(block)
+        return _SharedText(block.name, len(data))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_share(item, blocks) for item in obj)
+    if isinstance(obj, dict):
+        return {key: _share(value, blocks) for key, value in obj.items()}
+    return obj
+
+
+def _unshare(obj, unlink: bool = False):
+    """Inverse of _share, copies the data out of the shared blocks (and unlinks them if asked)"""
+    if isinstance(obj, (_SharedArray, _SharedText)):
+        block = shared_memory.SharedMemory(name=obj.name)
+        try:
+            if isinstance(obj, _SharedArray):
+                value = np.ndarray(obj.shape, dtype=np.dtype(obj.dtype), buffer=block.buf).copy()
+            else:
+                value = bytes(block.buf[:obj.size]).decode('utf-8')
+        finally:
+            block.close()
+            if unlink:
+                block.unlink()
+        return value
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_unshare(item, unlink) for item in obj)
+    if isinstance(obj, dict):
+        return {key: _unshare(value, unlink) for key, value in obj.items()}
+    return obj
+
+
+def _discard(kind: str, payload):
+    """Unlink the shared blocks of a result message nobody is going to read"""
+    if kind in ('item', 'done'):
+        _unshare(payload, unlink=True)
+
+
+def _release(blocks: List[shared_memory.SharedMemory], unlink: bool):
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+
+
+def _replica_main(replica_idx: int, config: Dict, job_queue, result_queue):
+    """Replica process: builds its own Omniparser and runs the jobs sent to it one at a time."""
+    from util.omniparser import Omniparser
+    omniparser = Omniparser(config)
+    result_queue.put((None, 'ready', replica_idx))
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, method, args, kwargs = job
+        blocks = []
+        try:
+            args, kwargs = _unshare((args, kwargs))
+            result = getattr(omniparser, method)(*args, **kwargs)
+            if inspect.isgenerator(result):
+                for item in result:
+                    item_blocks = []
+                    result_queue.put((job_id, 'item', _share(item, item_blocks)))
+                    _release(item_blocks, unlink=False)
+                result = None
+            # kwargs['timings'] was filled in this process, send it back to the caller's dict, and the caption
+            # metrics recorded here to the dispatcher's /metrics
+            result_queue.put((job_id, 'done', _share((result, kwargs.get('timings'), drain_replica_metrics()), blocks)))
+        except Exception:
+            result_queue.put((job_id, 'error', traceback.format_exc()))
+        finally:
+            # the dispatcher unlinks the result blocks once it has copied them out
+            _release(blocks, unlink=False)
+
+
+class ReplicaPool:
+    """
+    Pre-forked Omniparser replicas behind a least-loaded dispatcher, with the same parse methods as Omniparser.
+
+    Every replica is a separate process holding its own YOLO, OCR and caption models, so Python level work
+    of concurrent parses runs on separate cores. Frames are decoded by the dispatcher and handed to the
+    replica through multiprocessing.shared_memory, SOM images come back the same way; only the small job
+    descriptions and element lists go through the queues. Incremental sessions stick to one replica.
+
+    Attributes:
+        replicas (int): number of replica processes
+    """
+
+    def __init__(self, config: Dict, replicas: int):
+        self.replicas = replicas
+        ctx = mp.get_context('spawn')
+        replica_config = dict(config)
+        # each replica runs one parse at a time and gets its share of the cores, split between OCR and
+        # detection by the replica itself
+        replica_config['workers'] = 1
+        replica_config['intra_op_threads'] = config.get('intra_op_threads') or max(1, (os.cpu_count() or 1) // replicas)
+        self._result_queue = ctx.Queue()
+        self._job_queues = [ctx.Queue() for _ in range(replicas)]
+        self._processes = [
+            ctx.Process(target=_replica_main, args=(i, replica_config, self._job_queues[i], self._result_queue), name=f'omniparser-replica-{i}', daemon=True)
+            for i in range(replicas)
+        ]
+        self._load = [0] * replicas
+        self._alive = [True] * replicas
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        for process in self._processes:
+            process.start()
+        self._wait_ready()
+        self._reader = threading.Thread(target=self._read_results, name='omniparser-replica-results', daemon=True)
+        self._reader.start()
+        print(f'{replicas} Omniparser replicas ready')
+
+    def _wait_ready(self):
+        ready = set()
+        while len(ready) < self.replicas:
+            try:
+                _, kind, replica_idx = self._result_queue.get(timeout=5)
+                ready.add(replica_idx)
+            except queue.Empty:
+                dead = [i for i, process in enumerate(self._processes) if not process.is_alive()]
+                if dead:
+                    self.close()
+                    raise RuntimeError(f'Omniparser replicas {dead} exited during startup')
+
+    def _read_results(self):
+        while not self._closed:
+            try:
+                job_id, kind, payload = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                self._reap()
+                continue
+            except (EOFError, OSError):
+                return
+            self._reap()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None and kind != 'item':
+                    del self._jobs[job_id]
+                    self._load[job['replica']] -= 1
+                # put under the lock so an abandoning consumer either drains the message or sees it discarded here
+                if job is not None and not job['abandoned']:
+                    job['messages'].put((kind, payload))
+                    job = None
+            if job is not None:
+                _discard(kind, payload)
+
+    def _reap(self):
+        """Fail the jobs of replicas that died, they are not dispatched to anymore"""
+        for i, process in enumerate(self._processes):
+            if self._alive[i] and not process.is_alive():
+                self._alive[i] = False
+                print(f'Omniparser replica {i} exited with code {process.exitcode}')
+                with self._lock:
+                    dead_jobs = [job_id for job_id, job in self._jobs.items() if job['replica'] == i]
+                    for job_id in dead_jobs:
+                        self._jobs.pop(job_id)['messages'].put(('error', f'replica {i} exited with code {process.exitcode}'))
+
+    def _pick_replica(self, replica: Optional[int]) -> int:
+        with self._lock:
+            if replica is not None:
+                if not self._alive[replica]:
+                    raise RuntimeError(f'replica {replica} is not running')
+                return replica
+            alive = [i for i in range(self.replicas) if self._alive[i]]
+            if not alive:
+                raise RuntimeError('no Omniparser replica is running')
+            return min(alive, key=lambda i: self._load[i])
+
+    def _submit(self, method: str, args, kwargs, replica: Optional[int] = None):
+        """Send a job to a replica (the least loaded one by default), yields ('item', x) for every item of a
+        generator result, then ('done', result). Closing the generator early abandons the job: the replica
+        still runs it to the end, and the shared blocks of its remaining results are unlinked as they arrive."""
+        timings = kwargs.pop('timings', None)
+        if timings is not None:
+            kwargs['timings'] = {}
+        blocks = []
+        messages = queue.Queue()
+        job_id = next(self._job_ids)
+        job = {'replica': None, 'messages': messages, 'abandoned': False}
+        try:
+            shared_args = _share((args, kwargs), blocks)
+            replica = self._pick_replica(replica)
+            job['replica'] = replica
+            with self._lock:
+                self._jobs[job_id] = job
+                self._load[replica] += 1
+            self._job_queues[replica].put((job_id, method, *shared_args))
+            while True:
+                kind, payload = messages.get()
+                if kind == 'error':
+                    raise RuntimeError(f'{method} failed on replica {replica}:\n{payload}')
+                if kind == 'item':
+                    yield kind, _unshare(payload, unlink=True)
+                    continue
+                result, replica_timings, replica_metrics = _unshare(payload, unlink=True)
+                merge_replica_metrics(replica_metrics)
+                for stage, seconds in (replica_timings or {}).items():
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+                yield kind, result
+                return
+        except GeneratorExit:
+            with self._lock:
+                job['abandoned'] = True
+                pending = []
+                while not messages.empty():
+                    pending.append(messages.get_nowait())
+            for kind, payload in pending:
+                _discard(kind, payload)
+            raise
+        finally:
+            _release(blocks, unlink=True)
+
+    def call(self, method: str, *args, replica: Optional[int] = None, **kwargs):
+        """Run Omniparser.<method> on a replica and return its result"""
+        for kind, result in self._submit(method, args, kwargs, replica):
+            if kind == 'done':
+                return result
+
+    def broadcast(self, method: str, *args, **kwargs) -> List:
+        """Run Omniparser.<method> on every running replica, returns the results in replica order"""
+        alive = [i for i in range(self.replicas) if self._alive[i]]
+        with ThreadPoolExecutor(max_workers=max(1, len(alive))) as executor:
+            return list(executor.map(lambda i: self.call(method, *args, replica=i, **kwargs), alive))
+
+    def _decode(self, image, timings: Optional[Dict]):
+        with stage_timer({} if timings is None else timings, 'decode'):
+            return decode_image(image)[1]
+
+    def parse(self, image, timings: Dict = None, **kwargs):
+        return self.call('parse', self._decode(image, timings), timings=timings, **kwargs)
+
+    def parse_cached(self, image, timings: Dict = None, **kwargs):
+        return self.call('parse_cached', self._decode(image, timings), timings=timings, **kwargs)
+
+    def parse_batch(self, images, timings: Dict = None, **kwargs):
+        return self.call('parse_batch', [self._decode(image, timings) for image in images], timings=timings, **kwargs)
+
+    def parse_incremental(self, image, session_id: str, timings: Dict = None, **kwargs):
+        # the previous frame of a session only lives in the replica that parsed it
+        replica = zlib.crc32(session_id.encode()) % self.replicas
+        return self.call('parse_incremental', self._decode(image, timings), session_id, timings=timings, replica=replica, **kwargs)
+
+    def parse_stream(self, image):
+        events = self._submit('parse_stream', (self._decode(image, None),), {})
+        try:
+            for kind, event in events:
+                if kind == 'item':
+                    yield event
+        finally:
+            # a consumer that stops early abandons the job instead of leaving its results in shared memory
+            events.close()
+
+    def warmup(self, resolutions=((1920, 1080),), runs: int = 2):
+        """Warm up every replica in parallel, returns the warmup results of each replica"""
+        return self.broadcast('warmup', resolutions, runs)
+
+    def stats(self):
+        with self._lock:
+            load = list(self._load)
+        return {'replicas': self.broadcast('stats'), 'load': load, 'alive': list(self._alive)}
+
+    def flush_cache(self, cache: str = 'all') -> List[str]:
+        return sorted(set(itertools.chain.from_iterable(self.broadcast('flush_cache', cache))))
+
+    def close(self):
+        self._closed = True
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,57 @@
+from collections import defaultdict
+from typing import List, Sequence
+
+import numpy as np
+
+
+class BoxGridIndex:
+    """
+    A uniform grid index over boxes in normalized xyxy coordinates.
+
+    Every box is registered in all the grid cells it covers, so any two boxes with a
+    positive-area intersection share at least one cell. Queries therefore only need to
+    look at the boxes registered in the cells covered by the query box.
+
+    Attributes:
+        boxes (np.ndarray): (N, 4) array of the indexed boxes, xyxy in [0, 1]
+        grid_size (int): number of cells along each axis
+    """
+
+    def __init__(self, boxes: Sequence[Sequence[float]], grid_size: int = 32):
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.grid_size = grid_size
+        cells = defaultdict(list)
+        for idx, (x0, y0, x1, y1) in enumerate(self._cell_ranges(self.boxes)):
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    cells[cx * grid_size + cy].append(idx)
+        self._cells = {cell: np.asarray(idxs, dtype=np.int64) for cell, idxs in cells.items()}
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def _cell_ranges(self, boxes: np.ndarray) -> List[List[int]]:
+        cell = np.floor(boxes * self.grid_size).astype(np.int64)
+        return np.clip(cell, 0, self.grid_size - 1).tolist()
+
+    def _lookup(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        hits = [
+            self._cells[cell]
+            for cx in range(x0, x1 + 1)
+            for cy in range(y0, y1 + 1)
+            if (cell := cx * self.grid_size + cy) in self._cells
+        ]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        if len(hits) == 1:
+            return hits[0]
+        return np.unique(np.concatenate(hits))
+
+    def query(self, box: Sequence[float]) -> np.ndarray:
+        """Return the sorted indices of the boxes sharing at least one cell with `box`."""
+        return self.query_many([box])[0]
+
+    def query_many(self, boxes: Sequence[Sequence[float]]) -> List[np.ndarray]:
+        """Same as `query` for each of `boxes`, with the cell lookup done in one batch."""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        return [self._lookup(*cell_range) for cell_range in self._cell_ranges(boxes)]
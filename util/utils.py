@@ -17,137 +17,340 @@ import cv2
 import numpy as np
 # %matplotlib inline
 from matplotlib import pyplot as plt
-import easyocr
-from paddleocr import PaddleOCR
-reader = easyocr.Reader(['en'])
-paddle_ocr = PaddleOCR(
-    lang='en',  # other lang also available
-    use_angle_cls=False,
-    use_gpu=False,  # using cuda will conflict with pytorch in the same process
-    show_log=False,
-    max_batch_size=1024,
-    use_dilation=True,  # improves accuracy
-    det_db_score_mode='slow',  # improves accuracy
-    rec_batch_num=1024)
 import time
 import base64
 
 import os
 import ast
 import torch
+import transformers
 from typing import Tuple, List, Union
-from torchvision.ops import box_convert
+import contextlib
+import traceback
+import shutil
+import tempfile
+import errno
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+from torchvision.ops import box_convert, roi_align
+import torch.nn.functional as F
 import re
 from torchvision.transforms import ToPILImage
 import supervision as sv
 import torchvision.transforms as T
 from util.box_annotator import BoxAnnotator 
+from util.spatial_index import BoxGridIndex
+from util.ocr_engines import run_ocr
+from util.cache import crop_digest
+from util.metrics import CAPTION_BATCH_SECONDS, CROPS_CAPTIONED
 
 
 import torch
 
-def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None):
+CAPTION_PRECISIONS = ('auto', 'fp32', 'fp16', 'bf16', 'int8')
+_PRECISION_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16, 'int8': torch.float32}
+
+
+def cpu_supports_bf16():
+    """True when the CPU has native bf16 kernels (AVX512-BF16 / AMX), emulated bf16 is slower than fp32"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_caption_precision(precision, device):
+    """'auto' is fp32 on cpu and fp16 on gpu; modes the device can't run fall back to those"""
+    if precision == 'auto':
+        return 'fp32' if device == 'cpu' else 'fp16'
+    if precision == 'bf16' and device == 'cpu' and not cpu_supports_bf16():
+        print('bf16 is not supported natively by this CPU, using fp32')
+        return 'fp32'
+    if precision == 'int8' and device != 'cpu':
+        print('int8 dynamic quantization runs on CPU only, using fp16')
+        return 'fp16'
+    return precision
+
+
+def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None, precision='auto'):
+    """Load the caption model and its processor
+
+    precision: 'auto', 'fp32', 'fp16', 'bf16' (bf16 weights, CPUs with native bf16 support), or 'int8'
+        (dynamic int8 quantization of the linear layers, CPU only)
+    """
     if not device:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = resolve_caption_precision(precision, device)
+    torch_dtype = _PRECISION_DTYPES[precision]
     
     if model_name == "blip2":
         from transformers import Blip2Processor, Blip2ForConditionalGeneration
         processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
-        if device == 'cpu':
-            model = Blip2ForConditionalGeneration.from_pretrained(
-                model_name_or_path, device_map=None, torch_dtype=torch.float32
-            )
-        else:
-            model = Blip2ForConditionalGeneration.from_pretrained(
-                model_name_or_path, device_map=None, torch_dtype=torch.float16
-            ).to(device)
+        model = Blip2ForConditionalGeneration.from_pretrained(
+            model_name_or_path, device_map=None, torch_dtype=torch_dtype
+        )
     
     elif model_name == "florence2":
         from transformers import AutoProcessor, AutoModelForCausalLM
         processor = AutoProcessor.from_pretrained("microsoft/Florence-2-base", trust_remote_code=True)
-        if device == 'cpu':
+        try:
             model = AutoModelForCausalLM.from_pretrained(
                 model_name_or_path, 
-                torch_dtype=torch.float32, 
+                torch_dtype=torch_dtype, 
                 trust_remote_code=True,
-                attn_implementation="eager"
+                attn_implementation="sdpa"
             )
-        else:
+        except (ValueError, ImportError) as e:
+            # older transformers / remote code without SDPA support
+            print('sdpa attention not available, falling back to eager:', e)
             model = AutoModelForCausalLM.from_pretrained(
                 model_name_or_path, 
-                torch_dtype=torch.float16, 
+                torch_dtype=torch_dtype, 
                 trust_remote_code=True,
                 attn_implementation="eager"
-            ).to(device)
+            )
     
-    return {'model': model.to(device), 'processor': processor}
+    if precision == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return {'model': model.to(device), 'processor': processor, 'precision': precision}
 
 
 
-def get_yolo_model(model_path):
+YOLO_BACKENDS = ('torch', 'onnx', 'openvino')
+DETECTOR_PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+@contextmanager
+def _file_lock(path, timeout=600):
+    """Cross-process lock on `path`, so concurrent replicas export only once. The OS releases it when the
+    holder exits, a crashed export never leaves a stale lock behind. On Windows waiting for it gives up with
+    a TimeoutError after `timeout` seconds"""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    # blocks for up to 10s per attempt
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as e:
+                    # only contention is retried, anything else (bad descriptor, read-only filesystem) is raised
+                    if e.errno not in (errno.EDEADLOCK, errno.EACCES):
+                        raise
+                    if time.time() > deadline:
+                        raise TimeoutError(f'could not lock {path} within {timeout}s') from e
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _replace(src, dst):
+    """os.replace that also replaces an existing directory"""
+    if os.path.isdir(dst):
+        old = tempfile.mkdtemp(dir=os.path.dirname(dst), prefix='.old-')
+        os.replace(dst, os.path.join(old, os.path.basename(dst)))
+        os.replace(src, dst)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(src, dst)
+
+
+def _calibration_dataset(calibration_data, artifact):
+    """Ultralytics dataset yaml for int8 calibration: `calibration_data` itself when it is a yaml, otherwise
+    one written next to the artifact over the screenshots of the `calibration_data` directory (no labels needed)"""
+    if not calibration_data:
+        raise ValueError("The int8 detector export needs calibration_data, a directory of screenshots or a dataset yaml")
+    if calibration_data.endswith(('.yaml', '.yml')):
+        return calibration_data
+    images = [f for f in os.listdir(calibration_data) if f.lower().endswith(('.png', '.jpg', '.jpeg'))] if os.path.isdir(calibration_data) else []
+    if not images:
+        raise ValueError(f"No screenshots to calibrate the int8 detector on in {calibration_data!r}, pass a directory of screenshots or a dataset yaml")
+    directory = json.dumps(os.path.abspath(calibration_data))
+    dataset = artifact + '_calibration.yaml'
+    with open(dataset, 'w') as f:
+        f.write(f"path: {directory}\ntrain: {directory}\nval: {directory}\nnames:\n  0: icon\n")
+    return dataset
+
+
+def export_yolo_model(model_path, backend, int8=False, calibration_data=None):
+    """Export the .pt detector to ONNX or OpenVINO next to the weights, once; returns the artifact path
+
+    The artifact is rebuilt when the .pt file is newer. Needs the `onnx` + `onnxruntime` or `openvino` packages.
+    int8: OpenVINO post-training int8 quantization, calibrated on `calibration_data`, a directory of
+    screenshots or an ultralytics dataset yaml, required for an int8 export.
+    """
+    from ultralytics import YOLO
+    stem, _ = os.path.splitext(model_path)
+    if backend == 'onnx':
+        artifact = stem + '.onnx'
+    else:
+        artifact = stem + ('_int8' if int8 else '') + '_openvino_model'
+    with _file_lock(artifact + '.lock'):
+        if not os.path.exists(artifact) or os.path.getmtime(artifact) < os.path.getmtime(model_path):
+            print(f'exporting {model_path} to {backend}{" int8" if int8 else ""}...')
+            # dynamic input shape, predict keeps the letterboxed size of every frame
+            export_args = dict(format=backend, dynamic=True, int8=int8)
+            if int8:
+                export_args['data'] = _calibration_dataset(calibration_data, artifact)
+            # export a copy of the weights in a temp dir and move the result into place, so an interrupted
+            # export never leaves a partial artifact that looks up to date
+            export_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(model_path)), prefix='.export-')
+            try:
+                export_model = os.path.join(export_dir, os.path.basename(model_path))
+                shutil.copy2(model_path, export_model)
+                _replace(YOLO(export_model).export(**export_args), artifact)
+            finally:
+                shutil.rmtree(export_dir, ignore_errors=True)
+    return artifact
+
+
+def get_yolo_model(model_path, backend='torch', precision='fp32', calibration_data=None):
+    """Load the icon detector. backend 'onnx' / 'openvino' runs an exported graph (ONNX Runtime / OpenVINO)
+    through the same ultralytics predict API, so predictions keep the same xyxy/conf tensors.
+
+    precision 'int8' needs the openvino backend and is calibrated on the `calibration_data` screenshots;
+    'bf16' is applied at predict time by detect_icons.
+    """
     from ultralytics import YOLO
+    if backend not in YOLO_BACKENDS:
+        raise ValueError(f"Unknown detector backend {backend!r}, available: {list(YOLO_BACKENDS)}")
+    if precision not in DETECTOR_PRECISIONS:
+        raise ValueError(f"Unknown detector precision {precision!r}, available: {list(DETECTOR_PRECISIONS)}")
+    if precision == 'int8' and backend != 'openvino':
+        raise ValueError("int8 detector precision needs the openvino backend")
+    if backend != 'torch':
+        model_path = export_yolo_model(model_path, backend, int8=precision == 'int8', calibration_data=calibration_data)
+        return YOLO(model_path, task='detect')
     # Load the model.
     model = YOLO(model_path)
     return model
 
 
-@torch.inference_mode()
-def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128):
-    # Number of samples per batch, --> 128 roughly takes 4 GB of GPU memory for florence v2 model
-    to_pil = ToPILImage()
-    if starting_idx:
-        non_ocr_boxes = filtered_boxes[starting_idx:]
+def extract_icon_crops(image_source: np.ndarray, boxes, crop_size=64):
+    """Crop every box (normalized xyxy) out of the image and resize it to crop_size x crop_size in one roi_align call
+
+    Returns a float (N, 3, crop_size, crop_size) tensor with values in [0, 255].
+    """
+    h, w = image_source.shape[:2]
+    boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
+    # same integer pixel bounds as slicing image_source[ymin:ymax, xmin:xmax]
+    boxes = torch.floor(boxes * torch.tensor([w, h, w, h], dtype=torch.float32))
+    image = torch.from_numpy(np.ascontiguousarray(image_source)).permute(2, 0, 1)[None].float()
+    rois = torch.cat([torch.zeros(len(boxes), 1), boxes], dim=1)
+    return roi_align(image, rois, output_size=(crop_size, crop_size), spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+
+def _image_processor_params(image_processor):
+    """Target size, rescale factor, mean and std of a HF image processor"""
+    size = image_processor.size
+    if 'height' in size:
+        target = (size['height'], size['width'])
     else:
-        non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
-    for i, coord in enumerate(non_ocr_boxes):
+        target = (size['shortest_edge'], size['shortest_edge'])
+    crop = None
+    if getattr(image_processor, 'do_center_crop', False):
+        crop = (image_processor.crop_size['height'], image_processor.crop_size['width'])
+    rescale = image_processor.rescale_factor if getattr(image_processor, 'do_rescale', True) else 1.0
+    mean = torch.tensor(image_processor.image_mean).view(1, 3, 1, 1)
+    std = torch.tensor(image_processor.image_std).view(1, 3, 1, 1)
+    return target, crop, rescale, mean, std
+
+
+def crops_to_pixel_values(crops, processor, do_resize=True):
+    """Resize and normalize a batch of crops the way the caption processor would, without PIL round-trips"""
+    target, crop, rescale, mean, std = _image_processor_params(processor.image_processor)
+    # uint8 resize goes through torch's fast (PIL-equivalent) kernels, float bicubic is several times slower
+    pixel_values = crops.round().to(torch.uint8)
+    if do_resize:
+        pixel_values = F.interpolate(pixel_values, size=target, mode='bicubic', align_corners=False, antialias=True)
+        if crop is not None:
+            top, left = (target[0] - crop[0]) // 2, (target[1] - crop[1]) // 2
+            pixel_values = pixel_values[:, :, top:top + crop[0], left:left + crop[1]]
+    return pixel_values.float().mul_(rescale / std).sub_(mean / std)
+
+
+def _prompt_inputs(caption_model_processor, prompt, n):
+    """Text inputs for n copies of the prompt, built once per prompt with a dummy image and cached"""
+    cached = caption_model_processor.setdefault('prompt_inputs', {})
+    if prompt not in cached:
+        dummy = Image.new('RGB', (64, 64))
+        inputs = caption_model_processor['processor'](images=[dummy], text=[prompt], return_tensors="pt")
+        cached[prompt] = {k: v for k, v in inputs.items() if k != 'pixel_values'}
+    return {k: v.repeat(n, *[1] * (v.dim() - 1)) for k, v in cached[prompt].items()}
+
+
+def _is_kv_cache_incompatibility(error):
+    """The Florence-2 remote code reads past_key_values as legacy tuples in prepare_inputs_for_generation;
+    transformers versions that hand it a Cache object (or None) fail there with an AttributeError / TypeError"""
+    if not isinstance(error, (AttributeError, TypeError)):
+        return False
+    return any(frame.name == 'prepare_inputs_for_generation' for frame in traceback.extract_tb(error.__traceback__))
+
+
+def _generate_florence(caption_model_processor, input_ids, pixel_values, max_new_tokens=20):
+    """Greedy Florence-2 decoding with the KV cache
+
+    Finished sequences stop at EOS and are padded while the rest of the batch keeps decoding.
+    When the installed transformers version is incompatible with the remote code's cache handling,
+    generation is retried without the cache and the cache stays disabled for this model; any other
+    error is raised.
+    """
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    tokenizer = processor.tokenizer
+    generation_args = dict(
+        input_ids=input_ids,
+        pixel_values=pixel_values,
+        max_new_tokens=max_new_tokens,
+        num_beams=1, 
+        do_sample=False,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+    )
+    if caption_model_processor.get('use_cache', True):
         try:
-            xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
-            ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-            cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-            cropped_image = cv2.resize(cropped_image, (64, 64))
-            croped_pil_image.append(to_pil(cropped_image))
-        except:
-            continue
+            return model.generate(**generation_args, use_cache=True)
+        except (AttributeError, TypeError) as e:
+            if not _is_kv_cache_incompatibility(e):
+                raise
+            print(f'florence remote code is incompatible with the kv cache of transformers {transformers.__version__}, disabling the cache: {e!r}')
+            caption_model_processor['use_cache'] = False
+    return model.generate(**generation_args, use_cache=False)
+
 
+@torch.inference_mode()
+def iter_caption_crops(crops, caption_model_processor, prompt, batch_size=128, max_new_tokens=20):
+    """Caption a (N, 3, 64, 64) tensor of icon crops, yields the list of captions of every batch
+
+    max_new_tokens: caption length limit for florence, lower it for short captions
+    """
     model, processor = caption_model_processor['model'], caption_model_processor['processor']
-    if not prompt:
-        if 'florence' in model.config.name_or_path:
-            prompt = "<CAPTION>"
-        else:
-            prompt = "The image shows"
-    
-    generated_texts = []
     device = model.device
     
-    for i in range(0, len(croped_pil_image), batch_size):
-        start = time.time()
-        batch = croped_pil_image[i:i+batch_size]
-        t1 = time.time()
+    for i in range(0, len(crops), batch_size):
+        batch = crops[i:i+batch_size]
+        batch_start = time.perf_counter()
         
-        if model.device.type == 'cuda':
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt", do_resize=False).to(device=device, dtype=torch.float16)
-        else:
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
+        # inputs follow the weights dtype, which depends on the caption precision (fp16 / bf16 / fp32)
+        pixel_values = crops_to_pixel_values(batch, processor, do_resize=model.device.type != 'cuda').to(device=device, dtype=model.dtype)
+        inputs = {k: v.to(device) for k, v in _prompt_inputs(caption_model_processor, prompt, len(batch)).items()}
         
         if 'florence' in model.config.name_or_path:
-            # Clear any existing cache before generation
-            if hasattr(model, 'past_key_values') and model.past_key_values is not None:
-                model.past_key_values = None
-            
-            # Generate with cache disabled to avoid the error
-            generated_ids = model.generate(
-                input_ids=inputs["input_ids"],
-                pixel_values=inputs["pixel_values"],
-                max_new_tokens=20,
-                num_beams=1, 
-                do_sample=False,
-                use_cache=False,  # Disable cache to prevent the error
-                pad_token_id=processor.tokenizer.pad_token_id if hasattr(processor.tokenizer, 'pad_token_id') else processor.tokenizer.eos_token_id
-            )
+            generated_ids = _generate_florence(caption_model_processor, inputs["input_ids"], pixel_values, max_new_tokens)
         else:
             generated_ids = model.generate(
                 **inputs, 
+                pixel_values=pixel_values,
                 max_length=100, 
                 num_beams=5, 
                 no_repeat_ngram_size=2, 
@@ -157,9 +360,87 @@ def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_
         
         generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
         generated_text = [gen.strip() for gen in generated_text]
-        generated_texts.extend(generated_text)
-    
-    return generated_texts
+        CAPTION_BATCH_SECONDS.observe(time.perf_counter() - batch_start)
+        CROPS_CAPTIONED.inc(len(batch))
+        yield generated_text
+
+
+def caption_crops(crops, caption_model_processor, prompt, batch_size=128, max_new_tokens=20):
+    """Caption a (N, 3, 64, 64) tensor of icon crops, returns N strings"""
+    return [text for batch in iter_caption_crops(crops, caption_model_processor, prompt, batch_size=batch_size, max_new_tokens=max_new_tokens) for text in batch]
+
+
+def default_caption_prompt(caption_model_processor):
+    if 'florence' in caption_model_processor['model'].config.name_or_path:
+        return "<CAPTION>"
+    return "The image shows"
+
+
+@torch.inference_mode()
+def iter_caption_crops_cached(crops, caption_model_processor, prompt=None, batch_size=128, caption_cache=None, max_new_tokens=20, caption_batcher=None):
+    """Caption a (N, 3, 64, 64) tensor of icon crops, yields {crop index: caption} updates
+
+    Cached captions come first in a single update, then one update per caption batch.
+    caption_cache: optional util.cache.LRUCache, keyed by a quantized digest of the 64x64 crop; only misses are captioned
+    caption_batcher: optional util.caption_batcher.CaptionBatcher, misses are then captioned together with
+        the crops of other concurrent requests and come back as a single update
+    """
+    if not prompt:
+        prompt = default_caption_prompt(caption_model_processor)
+
+    # look up cached captions, identical crops are only captioned once
+    cached = {}
+    miss_keys = {}
+    if caption_cache is not None:
+        crops_u8 = crops.round().to(torch.uint8).permute(0, 2, 3, 1).numpy()
+    for i in range(len(crops)):
+        key = (crop_digest(crops_u8[i]), prompt, max_new_tokens) if caption_cache is not None else i
+        caption = caption_cache.get(key) if caption_cache is not None else None
+        if caption is not None:
+            cached[i] = caption
+        else:
+            miss_keys.setdefault(key, []).append(i)
+    if cached:
+        yield cached
+
+    miss_items = list(miss_keys.items())
+    miss_idx = [idxs[0] for _, idxs in miss_items]
+    done = 0
+    if miss_idx:
+        if caption_batcher is not None:
+            batches = [caption_batcher.caption(crops[miss_idx], prompt, max_new_tokens=max_new_tokens)]
+        else:
+            batches = iter_caption_crops(crops[miss_idx], caption_model_processor, prompt, batch_size=batch_size, max_new_tokens=max_new_tokens)
+        for captions in batches:
+            update = {}
+            for (key, idxs), caption in zip(miss_items[done:done + len(captions)], captions):
+                if caption_cache is not None:
+                    caption_cache.put(key, caption)
+                for i in idxs:
+                    update[i] = caption
+            done += len(captions)
+            yield update
+
+
+def non_ocr_boxes(filtered_boxes, starting_idx):
+    if starting_idx:
+        return filtered_boxes[starting_idx:]
+    return filtered_boxes
+
+
+def iter_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128, caption_cache=None, max_new_tokens=20, caption_batcher=None):
+    """Caption the non-ocr boxes, yields {box position: caption} updates (see iter_caption_crops_cached)"""
+    # Number of samples per batch, --> 128 roughly takes 4 GB of GPU memory for florence v2 model
+    crops = extract_icon_crops(image_source, non_ocr_boxes(filtered_boxes, starting_idx))
+    yield from iter_caption_crops_cached(crops, caption_model_processor, prompt=prompt, batch_size=batch_size, caption_cache=caption_cache, max_new_tokens=max_new_tokens, caption_batcher=caption_batcher)
+
+
+def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128, caption_cache=None, max_new_tokens=20, caption_batcher=None):
+    """Caption the non-ocr boxes, returns the captions in box order (see iter_parsed_content_icon)"""
+    generated_texts = {}
+    for update in iter_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt, batch_size=batch_size, caption_cache=caption_cache, max_new_tokens=max_new_tokens, caption_batcher=caption_batcher):
+        generated_texts.update(update)
+    return [generated_texts[i] for i in range(len(generated_texts))]
 
 
 
@@ -215,138 +496,145 @@ def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, captio
 
     return generated_texts
 
-def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
-    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+def _box_area(boxes):
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def _intersection(boxes1, boxes2):
+    """Element-wise (broadcasting) intersection area of xyxy boxes."""
+    x1 = np.maximum(boxes1[..., 0], boxes2[..., 0])
+    y1 = np.maximum(boxes1[..., 1], boxes2[..., 1])
+    x2 = np.minimum(boxes1[..., 2], boxes2[..., 2])
+    y2 = np.minimum(boxes1[..., 3], boxes2[..., 3])
+    return np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
 
-    def box_area(box):
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def intersection_area(box1, box2):
-        x1 = max(box1[0], box2[0])
-        y1 = max(box1[1], box2[1])
-        x2 = min(box1[2], box2[2])
-        y2 = min(box1[3], box2[3])
-        return max(0, x2 - x1) * max(0, y2 - y1)
-
-    def IoU(box1, box2):
-        intersection = intersection_area(box1, box2)
-        union = box_area(box1) + box_area(box2) - intersection + 1e-6
-        if box_area(box1) > 0 and box_area(box2) > 0:
-            ratio1 = intersection / box_area(box1)
-            ratio2 = intersection / box_area(box2)
-        else:
-            ratio1, ratio2 = 0, 0
-        return max(intersection / union, ratio1, ratio2)
 
-    def is_inside(box1, box2):
-        # return box1[0] >= box2[0] and box1[1] >= box2[1] and box1[2] <= box2[2] and box1[3] <= box2[3]
-        intersection = intersection_area(box1, box2)
-        ratio1 = intersection / box_area(box1)
-        return ratio1 > 0.95
+def _intersection_matrix(boxes1, boxes2):
+    """Pairwise intersection areas between two (N, 4) / (M, 4) xyxy arrays -> (N, M)."""
+    return _intersection(boxes1[:, None, :], boxes2[None, :, :])
 
-    boxes = boxes.tolist()
+
+def _overlap_matrix(boxes1, boxes2):
+    """Batched version of the IoU used for overlap suppression.
+
+    Same definition as the old per-pair closure: max(iou, inter/area1, inter/area2),
+    with the two containment ratios set to 0 when either box is degenerate.
+    Returns the overlap matrix, the intersection matrix and both area vectors.
+    """
+    area1, area2 = _box_area(boxes1), _box_area(boxes2)
+    inter = _intersection_matrix(boxes1, boxes2)
+    union = area1[:, None] + area2[None, :] - inter + 1e-6
+    overlap = inter / union
+    valid = (area1[:, None] > 0) & (area2[None, :] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio1 = np.where(valid, inter / area1[:, None], 0)
+        ratio2 = np.where(valid, inter / area2[None, :], 0)
+    overlap = np.maximum(overlap, np.maximum(ratio1, ratio2))
+    return overlap, inter, area1, area2
+
+
+def _suppress_larger_boxes(boxes, iou_threshold):
+    """Mask of boxes that do not overlap (above threshold) any strictly smaller box."""
+    overlap, _, area, _ = _overlap_matrix(boxes, boxes)
+    suppress = (overlap > iou_threshold) & (area[:, None] > area[None, :])
+    np.fill_diagonal(suppress, False)
+    return ~suppress.any(axis=1)
+
+
+def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    boxes = np.asarray(boxes.tolist(), dtype=np.float64).reshape(-1, 4)
     filtered_boxes = []
     if ocr_bbox:
         filtered_boxes.extend(ocr_bbox)
-    # print('ocr_bbox!!!', ocr_bbox)
-    for i, box1 in enumerate(boxes):
-        # if not any(IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2) for j, box2 in enumerate(boxes) if i != j):
-        is_valid_box = True
-        for j, box2 in enumerate(boxes):
-            # keep the smaller box
-            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
-                is_valid_box = False
-                break
-        if is_valid_box:
-            # add the following 2 lines to include ocr bbox
-            if ocr_bbox:
-                # only add the box if it does not overlap with any ocr bbox
-                if not any(IoU(box1, box3) > iou_threshold and not is_inside(box1, box3) for k, box3 in enumerate(ocr_bbox)):
-                    filtered_boxes.append(box1)
-            else:
-                filtered_boxes.append(box1)
+    keep = _suppress_larger_boxes(boxes, iou_threshold)
+    if ocr_bbox:
+        # only add the box if it does not overlap with any ocr bbox
+        ocr = np.asarray(ocr_bbox, dtype=np.float64).reshape(-1, 4)
+        overlap, inter, area, _ = _overlap_matrix(boxes, ocr)
+        inside = inter / area[:, None] > 0.95
+        keep &= ~((overlap > iou_threshold) & ~inside).any(axis=1)
+    filtered_boxes.extend(boxes[keep].tolist())
     return torch.tensor(filtered_boxes)
 
 
-def remove_overlap_new(boxes, iou_threshold, ocr_bbox=None):
+# icon x ocr box pairs above which remove_overlap_new looks up the ocr boxes in a BoxGridIndex instead of
+# checking every pair, below it building the index costs more than it saves (python -m util.bench_overlap)
+OCR_GRID_MIN_PAIRS = 250_000
+
+
+def remove_overlap_new(boxes, iou_threshold, ocr_bbox=None, ocr_index=None, use_grid=None):
     '''
     ocr_bbox format: [{'type': 'text', 'bbox':[x,y], 'interactivity':False, 'content':str }, ...]
     boxes format: [{'type': 'icon', 'bbox':[x,y], 'interactivity':True, 'content':None }, ...]
+    ocr_index: optional BoxGridIndex built over the ocr_bbox boxes, always used when given
+    use_grid: check the icons against the ocr boxes sharing a grid cell (True) or against all of them (False),
+    by default the grid is only built for more than OCR_GRID_MIN_PAIRS icon x ocr box pairs
 
+    Overlap, containment and area checks are computed as matrices in one pass instead
+    of per-pair python loops. Icons are returned as element dicts even when there are no ocr boxes.
     '''
     assert ocr_bbox is None or isinstance(ocr_bbox, List)
 
-    def box_area(box):
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def intersection_area(box1, box2):
-        x1 = max(box1[0], box2[0])
-        y1 = max(box1[1], box2[1])
-        x2 = min(box1[2], box2[2])
-        y2 = min(box1[3], box2[3])
-        return max(0, x2 - x1) * max(0, y2 - y1)
-
-    def IoU(box1, box2):
-        intersection = intersection_area(box1, box2)
-        union = box_area(box1) + box_area(box2) - intersection + 1e-6
-        if box_area(box1) > 0 and box_area(box2) > 0:
-            ratio1 = intersection / box_area(box1)
-            ratio2 = intersection / box_area(box2)
+    ocr_bbox = ocr_bbox or []
+    if not boxes:
+        return list(ocr_bbox)
+    box_xyxy = np.asarray([elem['bbox'] for elem in boxes], dtype=np.float64).reshape(-1, 4)
+    # keep the smaller box
+    keep = _suppress_larger_boxes(box_xyxy, iou_threshold)
+
+    kept_idx = np.flatnonzero(keep)
+    if use_grid is None:
+        use_grid = ocr_index is not None or len(kept_idx) * len(ocr_bbox) > OCR_GRID_MIN_PAIRS
+    # (icon, ocr box) pairs to check, grouped by icon: counts[row] pairs for the icon kept_idx[row]
+    if use_grid:
+        if ocr_index is None:
+            ocr_index = BoxGridIndex([elem['bbox'] for elem in ocr_bbox])
+        ocr_xyxy = ocr_index.boxes
+        # only ocr boxes sharing a grid cell with an icon can intersect it
+        candidates = ocr_index.query_many(box_xyxy[kept_idx])
+        counts = [len(c) for c in candidates]
+        pair_icon = np.repeat(kept_idx, counts)
+        pair_ocr = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+        inter = _intersection(box_xyxy[pair_icon], ocr_xyxy[pair_ocr])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ocr_in_icon_pairs = inter / _box_area(ocr_xyxy)[pair_ocr] > 0.80
+            icon_in_ocr_pairs = inter / _box_area(box_xyxy[pair_icon]) > 0.80
+    else:
+        # every icon against every ocr box, as (icon, ocr) matrices flattened row by row
+        ocr_xyxy = np.asarray([elem['bbox'] for elem in ocr_bbox], dtype=np.float64).reshape(-1, 4)
+        counts = [len(ocr_bbox)] * len(kept_idx)
+        pair_ocr = np.tile(np.arange(len(ocr_bbox)), len(kept_idx))
+        inter = _intersection_matrix(box_xyxy[kept_idx], ocr_xyxy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ocr_in_icon_pairs = (inter / _box_area(ocr_xyxy)[None, :] > 0.80).ravel()
+            icon_in_ocr_pairs = (inter / _box_area(box_xyxy[kept_idx])[:, None] > 0.80).ravel()
+    offsets = np.cumsum([0] + counts)
+
+    ocr_removed = np.zeros(len(ocr_bbox), dtype=bool)
+    icons = []
+    for row, i in enumerate(kept_idx):
+        box1_elem = boxes[i]
+        start, end = offsets[row], offsets[row + 1]
+        ocr_in_icon = ocr_in_icon_pairs[start:end]
+        icon_in_ocr = icon_in_ocr_pairs[start:end]
+        # ocr boxes are visited in order until the icon is found inside one of them;
+        # everything inside the icon before that point is absorbed into its label
+        stop = np.flatnonzero(icon_in_ocr & ~ocr_in_icon)
+        limit = stop[0] if len(stop) else end - start
+        absorbed = pair_ocr[start:start + limit][ocr_in_icon[:limit]]
+        ocr_labels = ''.join(ocr_bbox[k]['content'] + ' ' for k in absorbed)
+        ocr_removed[absorbed] = True
+        if len(stop):
+            # icon inside ocr, don't add this icon box
+            continue
+        if ocr_labels:
+            icons.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
         else:
-            ratio1, ratio2 = 0, 0
-        return max(intersection / union, ratio1, ratio2)
-
-    def is_inside(box1, box2):
-        # return box1[0] >= box2[0] and box1[1] >= box2[1] and box1[2] <= box2[2] and box1[3] <= box2[3]
-        intersection = intersection_area(box1, box2)
-        ratio1 = intersection / box_area(box1)
-        return ratio1 > 0.80
-
-    # boxes = boxes.tolist()
-    filtered_boxes = []
-    if ocr_bbox:
-        filtered_boxes.extend(ocr_bbox)
-    # print('ocr_bbox!!!', ocr_bbox)
-    for i, box1_elem in enumerate(boxes):
-        box1 = box1_elem['bbox']
-        is_valid_box = True
-        for j, box2_elem in enumerate(boxes):
-            # keep the smaller box
-            box2 = box2_elem['bbox']
-            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
-                is_valid_box = False
-                break
-        if is_valid_box:
-            if ocr_bbox:
-                # keep yolo boxes + prioritize ocr label
-                box_added = False
-                ocr_labels = ''
-                for box3_elem in ocr_bbox:
-                    if not box_added:
-                        box3 = box3_elem['bbox']
-                        if is_inside(box3, box1): # ocr inside icon
-                            # box_added = True
-                            # delete the box3_elem from ocr_bbox
-                            try:
-                                # gather all ocr labels
-                                ocr_labels += box3_elem['content'] + ' '
-                                filtered_boxes.remove(box3_elem)
-                            except:
-                                continue
-                            # break
-                        elif is_inside(box1, box3): # icon inside ocr, don't added this icon box, no need to check other ocr bbox bc no overlap between ocr bbox, icon can only be in one ocr box
-                            box_added = True
-                            break
-                        else:
-                            continue
-                if not box_added:
-                    if ocr_labels:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
-                    else:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
-            else:
-                filtered_boxes.append(box1)
-    return filtered_boxes # torch.tensor(filtered_boxes)
+            icons.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
+    filtered_boxes = [elem for elem, removed in zip(ocr_bbox, ocr_removed) if not removed]
+    return filtered_boxes + icons # torch.tensor(filtered_boxes)
 
 
 def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
@@ -438,38 +726,62 @@ def predict_yolo(model, image, box_threshold, imgsz, scale_img, iou_threshold=0.
 
     return boxes, conf, phrases
 
+def predict_yolo_batch(model, images, box_threshold, iou_threshold=0.7):
+    """predict_yolo over a list of images in one predict call, returns a list of (xyxy, conf)"""
+    results = model.predict(
+        source=images,
+        conf=box_threshold,
+        iou=iou_threshold, # default 0.7
+        )
+    return [(result.boxes.xyxy, result.boxes.conf) for result in results]
+
 def int_box_area(box, w, h):
     x1, y1, x2, y2 = box
     int_box = [int(x1*w), int(y1*h), int(x2*w), int(y2*h)]
     area = (int_box[2] - int_box[0]) * (int_box[3] - int_box[1])
     return area
 
-def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128):
-    """Process either an image path or Image object
-    
-    Args:
-        image_source: Either a file path (str) or PIL Image object
-        ...
-    """
-    if isinstance(image_source, str):
-        image_source = Image.open(image_source)
-    image_source = image_source.convert("RGB") # for CLIP
+def _detector_autocast(precision):
+    """bf16 autocast of the PyTorch detector on CPU, a no-op for other precisions and exported backends"""
+    if precision == 'bf16':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def detect_icons(model, image_source: Image.Image, BOX_TRESHOLD=0.01, imgsz=None, scale_img=False, precision='fp32'):
+    """Run the icon detector, returns xyxy boxes normalized to [0, 1] and their confidences"""
     w, h = image_source.size
     if not imgsz:
         imgsz = (h, w)
-    # print('image size:', w, h)
-    xyxy, logits, phrases = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
-    xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
-    image_source = np.asarray(image_source)
-    phrases = [str(i) for i in range(len(phrases))]
+    with _detector_autocast(precision):
+        xyxy, logits, phrases = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
+    xyxy = xyxy.float() / torch.Tensor([w, h, w, h]).to(xyxy.device)
+    return xyxy, logits.float()
+
+
+def detect_icons_batch(model, images: List[Image.Image], BOX_TRESHOLD=0.01, precision='fp32'):
+    """detect_icons for several frames with a single batched detector call"""
+    detections = []
+    with _detector_autocast(precision):
+        predictions = predict_yolo_batch(model, images, box_threshold=BOX_TRESHOLD, iou_threshold=0.1)
+    for image, (xyxy, logits) in zip(images, predictions):
+        w, h = image.size
+        detections.append((xyxy.float() / torch.Tensor([w, h, w, h]).to(xyxy.device), logits.float()))
+    return detections
 
-    # annotate the image with labels
+
+def merge_ocr_and_icons(xyxy, ocr_bbox, ocr_text, w, h, iou_threshold=0.9):
+    """Merge detected icons (normalized xyxy) with ocr boxes (pixel xyxy)
+
+    Returns the element list with uncaptioned icons ('content': None) at the end, the index of the
+    first of them, and the normalized ocr boxes.
+    """
     if ocr_bbox:
         ocr_bbox = torch.tensor(ocr_bbox) / torch.Tensor([w, h, w, h])
         ocr_bbox=ocr_bbox.tolist()
     else:
         print('no ocr bbox!!!')
-        ocr_bbox = None
+        ocr_bbox = []
 
     ocr_bbox_elem = [{'type': 'text', 'bbox':box, 'interactivity':False, 'content':txt, 'source': 'box_ocr_content_ocr'} for box, txt in zip(ocr_bbox, ocr_text) if int_box_area(box, w, h) > 0] 
     xyxy_elem = [{'type': 'icon', 'bbox':box, 'interactivity':True, 'content':None} for box in xyxy.tolist() if int_box_area(box, w, h) > 0]
@@ -479,17 +791,19 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     filtered_boxes_elem = sorted(filtered_boxes, key=lambda x: x['content'] is None)
     # get the index of the first 'content': None
     starting_idx = next((i for i, box in enumerate(filtered_boxes_elem) if box['content'] is None), -1)
-    filtered_boxes = torch.tensor([box['bbox'] for box in filtered_boxes_elem])
-    print('len(filtered_boxes):', len(filtered_boxes), starting_idx)
+    print('len(filtered_boxes):', len(filtered_boxes_elem), starting_idx)
+    return filtered_boxes_elem, starting_idx, ocr_bbox
 
-    # get parsed icon local semantics
-    time1 = time.time()
+
+def caption_icons(filtered_boxes_elem, starting_idx, image_source: np.ndarray, caption_model_processor, ocr_bbox=None, ocr_text=[], use_local_semantics=True, prompt=None, batch_size=128, caption_cache=None, max_new_tokens=20, caption_batcher=None):
+    """Fill the 'content' of uncaptioned icons in place, returns the merged 'Text Box ID' / 'Icon Box ID' lines"""
+    filtered_boxes = torch.tensor([box['bbox'] for box in filtered_boxes_elem])
     if use_local_semantics:
         caption_model = caption_model_processor['model']
         if 'phi3_v' in caption_model.config.model_type: 
             parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor)
         else:
-            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size)
+            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size, caption_cache=caption_cache, max_new_tokens=max_new_tokens, caption_batcher=caption_batcher)
         ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
         icon_start = len(ocr_text)
         parsed_content_icon_ls = []
@@ -503,25 +817,77 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     else:
         ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
         parsed_content_merged = ocr_text
-    print('time to get parsed content:', time.time()-time1)
+    return parsed_content_merged
+
 
+def annotate_som(image_source: np.ndarray, filtered_boxes_elem, draw_bbox_config=None, text_scale=0.4, text_padding=5, output_coord_in_ratio=False):
+    """Draw the numbered element boxes on the image, returns the annotated frame and the label coordinates"""
+    h, w = image_source.shape[:2]
+    filtered_boxes = torch.tensor([box['bbox'] for box in filtered_boxes_elem]).reshape(-1, 4)
     filtered_boxes = box_convert(boxes=filtered_boxes, in_fmt="xyxy", out_fmt="cxcywh")
 
     phrases = [i for i in range(len(filtered_boxes))]
     
     # draw boxes
     if draw_bbox_config:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, **draw_bbox_config)
+        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=None, phrases=phrases, **draw_bbox_config)
     else:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
+        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=None, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
     
-    pil_img = Image.fromarray(annotated_frame)
-    buffered = io.BytesIO()
-    pil_img.save(buffered, format="PNG")
-    encoded_image = base64.b64encode(buffered.getvalue()).decode('ascii')
     if output_coord_in_ratio:
         label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
         assert w == annotated_frame.shape[1] and h == annotated_frame.shape[0]
+    return annotated_frame, label_coordinates
+
+
+def encode_som(annotated_frame: np.ndarray, image_format='PNG', quality=None, max_side=None):
+    """Base64 encode the annotated frame
+
+    image_format: 'PNG', 'JPEG' or 'WEBP'; quality: JPEG/WebP quality (1-100)
+    max_side: downscale the annotated image so its longer side is at most this many pixels
+    """
+    h, w = annotated_frame.shape[:2]
+    if max_side and max(w, h) > max_side:
+        scale = max_side / max(w, h)
+        annotated_frame = cv2.resize(annotated_frame, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+    pil_img = Image.fromarray(annotated_frame)
+    buffered = io.BytesIO()
+    image_format = image_format.upper()
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    save_args = {} if quality is None or image_format == 'PNG' else {'quality': quality}
+    pil_img.save(buffered, format=image_format, **save_args)
+    return base64.b64encode(buffered.getvalue()).decode('ascii')
+
+
+def render_som(image_source: np.ndarray, filtered_boxes_elem, draw_bbox_config=None, text_scale=0.4, text_padding=5, output_coord_in_ratio=False, image_format='PNG', quality=None, max_side=None):
+    """Draw the numbered element boxes on the image, returns the base64 encoded image and the label coordinates"""
+    annotated_frame, label_coordinates = annotate_som(image_source, filtered_boxes_elem, draw_bbox_config=draw_bbox_config, text_scale=text_scale, text_padding=text_padding, output_coord_in_ratio=output_coord_in_ratio)
+    return encode_som(annotated_frame, image_format=image_format, quality=quality, max_side=max_side), label_coordinates
+
+
+def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128, caption_cache=None):
+    """Process either an image path or Image object
+    
+    Args:
+        image_source: Either a file path (str) or PIL Image object
+        ...
+    """
+    if isinstance(image_source, str):
+        image_source = Image.open(image_source)
+    image_source = image_source.convert("RGB") # for CLIP
+    w, h = image_source.size
+    # print('image size:', w, h)
+    xyxy, logits = detect_icons(model, image_source, BOX_TRESHOLD=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img)
+    image_source = np.asarray(image_source)
+
+    filtered_boxes_elem, starting_idx, ocr_bbox = merge_ocr_and_icons(xyxy, ocr_bbox, ocr_text, w, h, iou_threshold=iou_threshold)
+
+    # get parsed icon local semantics
+    caption_icons(filtered_boxes_elem, starting_idx, image_source, caption_model_processor, ocr_bbox=ocr_bbox, ocr_text=ocr_text, use_local_semantics=use_local_semantics, prompt=prompt, batch_size=batch_size, caption_cache=caption_cache)
+
+    encoded_image, label_coordinates = render_som(image_source, filtered_boxes_elem, draw_bbox_config=draw_bbox_config, text_scale=text_scale, text_padding=text_padding, output_coord_in_ratio=output_coord_in_ratio)
 
     return encoded_image, label_coordinates, filtered_boxes_elem
 
@@ -541,7 +907,8 @@ def get_xywh_yolo(input):
     x, y, w, h = int(x), int(y), int(w), int(h)
     return x, y, w, h
 
-def check_ocr_box(image_source: Union[str, Image.Image], display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False):
+def check_ocr_box(image_source: Union[str, Image.Image], display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False, ocr_engine=None):
+    """ocr_engine: name of a backend registered in util.ocr_engines, defaults to paddleocr/easyocr per use_paddleocr"""
     if isinstance(image_source, str):
         image_source = Image.open(image_source)
     if image_source.mode == 'RGBA':
@@ -549,20 +916,9 @@ def check_ocr_box(image_source: Union[str, Image.Image], display_img = True, out
         image_source = image_source.convert('RGB')
     image_np = np.array(image_source)
     w, h = image_source.size
-    if use_paddleocr:
-        if easyocr_args is None:
-            text_threshold = 0.5
-        else:
-            text_threshold = easyocr_args['text_threshold']
-        result = paddle_ocr.ocr(image_np, cls=False)[0]
-        coord = [item[0] for item in result if item[1][1] > text_threshold]
-        text = [item[1][0] for item in result if item[1][1] > text_threshold]
-    else:  # EasyOCR
-        if easyocr_args is None:
-            easyocr_args = {}
-        result = reader.readtext(image_np, **easyocr_args)
-        coord = [item[0] for item in result]
-        text = [item[1] for item in result]
+    if ocr_engine is None:
+        ocr_engine = 'paddleocr' if use_paddleocr else 'easyocr'
+    coord, text = run_ocr(ocr_engine, image_np, easyocr_args)
     if display_img:
         opencv_img = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
         bb = []